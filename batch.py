@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+#
+# Line Battles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Plays many headless games in parallel, for balancing levels.
+
+Every game is played by a bot (see `Bot.STRATEGIES`) through some list of
+levels, with its own seed, until the player dies, wins or runs out of ticks.
+Games are spread over a pool of processes (one per core by default), and the
+results of the games that finished and of the ones that stalled (ran out of
+ticks) are summed up apart, as:
+
+  survived        simulated seconds until the player died (or the game ended)
+  score           the player's score
+  kills           baddies shot
+  kill_rate       kills per simulated minute
+  upgrades        upgrades picked up
+  levels          levels cleared
+  tick_ms         mean wall-clock cost of a tick
+
+Usage:
+  batch.py [-n GAMES] [-j JOBS] [--levels 1 2 3] [--bot hunt] [-o out.json]
+'''
+
+import sys
+import json
+import math
+import time
+import argparse
+import multiprocessing
+from timeit import default_timer as timer
+
+import numpy
+
+import main
+from bench import percentiles
+
+
+################################################################################
+#                                     Bots                                     #
+################################################################################
+
+class Bot(object):
+  '''Stands in for `main.Input`, playing the player instead of reading the
+  keyboard.'''
+
+  STRATEGIES = ('idle', 'spin', 'hunt')
+  '''idle: does nothing at all.
+     spin: stands still, firing in a slowly turning circle.
+     hunt: shoots at the nearest baddie, backing away from it when it gets
+           within `DANGER` pixels, and otherwise heads for the nearest
+           upgrade (a level only ends once they are picked up, too).'''
+
+  DANGER = 80
+
+  def __init__(self, game, strategy='hunt'):
+    '''Creates a bot.
+
+    Args:
+      game, main.Main: The game to play.
+      strategy, str: One of `STRATEGIES`.
+    '''
+    assert strategy in self.STRATEGIES, 'Unknown strategy: %s' % strategy
+    self.game = game
+    self.strategy = strategy
+
+  @staticmethod
+  def _nearest(pos, objs):
+    '''Finds the nearest of `objs` to `pos`.
+
+    Returns:
+      (float, float): Its direction and distance from `pos`, or None if there
+                      are no `objs`.
+    '''
+    if not objs:
+      return None
+    xy = numpy.array([o.pos for o in objs], dtype=float)
+    d = xy - pos
+    dist = numpy.hypot(d[:,0], d[:,1])
+    k = int(dist.argmin())
+    return math.atan2(d[k,1], d[k,0]), dist[k]
+
+  def tick(self):
+    '''Plays one tick.'''
+    player = self.game.player
+    if self.strategy == 'idle':
+      return
+    elif self.strategy == 'spin':
+      aim = self.game.clock.ticks / 10.
+    else:
+      baddies = self.game.space.baddies
+      baddie = self._nearest(player.pos,
+          [b for b in baddies if isinstance(b, main.Baddie)])
+      upgrade = self._nearest(player.pos,
+          [b for b in baddies if isinstance(b, main.Upgrade)])
+      if baddie is not None and baddie[1] < self.DANGER:
+        player.traj = baddie[0] + math.pi
+        player.move_forward(1.0)
+      elif upgrade is not None:
+        player.traj = upgrade[0]
+        player.move_forward(1.0)
+      if baddie is None:
+        return
+      aim = baddie[0]
+    player.fire(aim, self.game.space.add)
+
+
+################################################################################
+#                                    Games                                     #
+################################################################################
+
+def play(job):
+  '''Plays one game.  This runs in a worker process.
+
+  Args:
+    job, dict: The game\'s "seed", "levels" (indices into `main.Main.levels`,
+               or None for all of them), "bot" strategy, "size" and "ticks"
+               limit.
+
+  Returns:
+    {str: ...}: The results of the game.
+  '''
+  main.Main.MAIN_OBJECT = None
+  game = main.Main.get_main(main.parse_args(
+      ['--headless', '--seed', str(job['seed']), '--size', job['size']]))
+  if job['levels'] is not None:
+    game.levels = [game.levels[i] for i in job['levels']]
+  game.user_input = Bot(game, job['bot'])
+  game.levels[0].start()
+  stats = main.Stats.get_stats()
+
+  kills = upgrades = 0
+  ticks = 0
+  elapsed = 0.
+  while ticks < job['ticks'] and not game.player.exploding and \
+        not game.winner:
+    stats.reset()
+    t0 = timer()
+    game.tick()
+    elapsed += timer() - t0
+    ticks += 1
+    kills += stats.counts.get('kills', 0)
+    upgrades += stats.counts.get('upgrades', 0)
+
+  survived = game.clock.now() / 1000.
+  return { 'seed': job['seed'],
+           'survived': survived,
+           'score': game.player.score,
+           'kills': kills,
+           'kill_rate': 60. * kills / survived if survived > 0 else 0.,
+           'upgrades': upgrades,
+           'levels': game.lev_i,
+           'died': game.player.exploding,
+           'won': game.winner,
+           'stalled': not game.player.exploding and not game.winner,
+           'ticks': ticks,
+           'tick_ms': 1000. * elapsed / ticks if ticks > 0 else 0. }
+
+
+METRICS = ('survived', 'score', 'kills', 'kill_rate', 'upgrades', 'levels',
+           'tick_ms')
+
+
+def _metrics(games):
+  '''The statistics of each of `METRICS` over `games` (see
+  `bench.percentiles`), or None if there are none.'''
+  if not games:
+    return None
+  summary = dict((m, percentiles([g[m] for g in games], ps=(10, 50, 90)))
+                 for m in METRICS)
+  for m in METRICS:
+    values = [g[m] for g in games]
+    summary[m]['min'] = min(values)
+    mean = summary[m]['mean']
+    summary[m]['std'] = math.sqrt(sum((v - mean) ** 2 for v in values) /
+                                  len(values))
+  return summary
+
+
+def summarize(games):
+  '''Sums up the results of many games.
+
+  Games that ran out of ticks before the player died or won have stalled
+  somewhere, so they are summed up apart from the ones that finished.
+
+  Returns:
+    {str: ...}: How many games were won, lost and stalled, and the statistics
+                of the "finished" and the "stalled" games (see `_metrics`).
+  '''
+  return { 'games': len(games),
+           'won': sum(1 for g in games if g['won']),
+           'died': sum(1 for g in games if g['died']),
+           'stalled': sum(1 for g in games if g['stalled']),
+           'finished_metrics': _metrics([g for g in games
+                                         if not g['stalled']]),
+           'stalled_metrics': _metrics([g for g in games if g['stalled']]) }
+
+
+def report(summary):
+  '''Formats a summary as tables.
+
+  Returns:
+    [str]: The lines.
+  '''
+  lines = [ '%d games: %d won, %d died, %d stalled (ran out of ticks)' % (
+                summary['games'], summary['won'], summary['died'],
+                summary['stalled']) ]
+  for name in ('finished', 'stalled'):
+    metrics = summary[name + '_metrics']
+    if metrics is None:
+      continue
+    lines.append('')
+    lines.append('%-10s %10s %10s %10s %10s %10s %10s %10s' % (name, 'mean',
+        'std', 'min', 'p10', 'p50', 'p90', 'max'))
+    for m in METRICS:
+      s = metrics[m]
+      lines.append('%-10s %10.2f %10.2f %10.2f %10.2f %10.2f %10.2f %10.2f' % (
+          m, s['mean'], s['std'], s['min'], s['p10'], s['p50'], s['p90'],
+          s['max']))
+  return lines
+
+
+################################################################################
+#                                     Main                                     #
+################################################################################
+
+def parse_args(argv=None):
+  ap = argparse.ArgumentParser(description='Play many headless games.')
+  ap.add_argument('-n', '--games', type=int, default=32,
+                  help="The number of games to play.")
+  ap.add_argument('-j', '--jobs', type=int,
+                  help="Worker processes (defaults to one per core).")
+  ap.add_argument('-l', '--levels', type=int, nargs='+',
+                  help="The levels to play, by number (defaults to all).")
+  ap.add_argument('-b', '--bot', choices=Bot.STRATEGIES, default='hunt',
+                  help="How the bot plays.")
+  ap.add_argument('-S', '--seed', type=int, default=1,
+                  help="The seed of the first game; game i uses seed + i.")
+  ap.add_argument('-s', '--size', default='800x600',
+                  help="The arena size, as WxH.")
+  ap.add_argument('-t', '--ticks', type=int, default=30 * 60 * 10,
+                  help="Stop a game after this many ticks.")
+  ap.add_argument('-o', '--output',
+                  help="Write every game\'s results and the summary as JSON "
+                       "to this file.")
+  return ap.parse_args(argv)
+
+
+def run(args):
+  levels = [l - 1 for l in args.levels] if args.levels else None
+  jobs = [ { 'seed': args.seed + i, 'levels': levels, 'bot': args.bot,
+             'size': args.size, 'ticks': args.ticks }
+           for i in xrange(args.games) ]
+
+  start = time.time()
+  pool = multiprocessing.Pool(args.jobs)
+  try:
+    games = sorted(pool.imap_unordered(play, jobs), key=lambda g: g['seed'])
+  finally:
+    pool.close()
+    pool.join()
+  secs = time.time() - start
+
+  summary = summarize(games)
+  for line in report(summary): print line
+  print '(%.1fs on %d processes)' % (secs,
+                                     args.jobs or multiprocessing.cpu_count())
+
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({ 'meta': vars(args), 'summary': summary, 'games': games }, f,
+                indent=1, sort_keys=True)
+    print 'Wrote', args.output
+
+
+if __name__ == '__main__':
+  sys.exit(run(parse_args()) or 0)
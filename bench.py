@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+#
+# Line Battles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Benchmarks for the simulation's hot paths.
+
+Builds synthetic scenarios (N baddies of some kind in an arena of some size,
+with the player firing a gun of some power, using some broadphase engine),
+runs them headless and reports
+per-tick latency percentiles, collision comparisons and net allocations
+(GC-tracked objects created minus those freed) for:
+
+  main_tick       `Main.tick`
+  space_tick      `CollisionSpace.tick`
+  calc_global_ps  one `Ship._calc_global_ps` pass over every baddie (each
+                  placed from scratch)
+  gun_fire        one `Gun.fire`
+
+Recorded games (see `main.InputLog`) can be benchmarked too, with --replays:
+they are played back tick for tick as realistic workloads.
+
+Usage:
+  bench.py run [-o baseline.json] [--full] [--kinds ...] [--counts ...] ...
+  bench.py run --replays game.lbil ...
+  bench.py compare baseline.json new.json [--threshold 0.1]
+  bench.py list
+'''
+
+import gc
+import os
+import sys
+import json
+import math
+import time
+import random
+import platform
+import argparse
+import itertools
+from timeit import default_timer as timer
+
+import main
+
+
+################################################################################
+#                                  Scenarios                                   #
+################################################################################
+
+KINDS = {
+  'Wiggler': (main.Wiggler,),
+  'Homer': (main.Homer,),
+  'Shooter': (main.Shooter,),
+  'mix': (main.Wiggler, main.FastWiggler, main.Homer, main.Shooter),
+}
+
+DEFAULTS = dict(kinds=['Wiggler', 'Homer', 'Shooter'], counts=[100, 1000],
+                powers=[0, 20], sizes=['800x600', '3840x2160'],
+                engines=['grid'])
+FULL = dict(kinds=['Wiggler', 'Homer', 'Shooter', 'mix'],
+            counts=[100, 1000, 10000], powers=[0, 5, 10, 20],
+            sizes=['800x600', '1920x1080', '3840x2160'],
+            engines=list(main.CollisionSpace.BROADPHASES))
+
+
+class Scenario(object):
+  '''A synthetic workload: `count` baddies of `kind` in a `size` arena, with
+  the player sitting in the middle firing a gun of `power` in a circle.'''
+
+  def __init__(self, kind, count, power, size, seed=1, engine='grid'):
+    '''Creates a scenario (but does not build it).
+
+    Args:
+      kind, str: One of `KINDS`.
+      count, int: The number of baddies to keep alive.
+      power, int: The player's `Gun.power`.
+      size, str: The arena size, as "WxH".
+      seed, int: The seed for the game and for placing baddies.
+      engine, str: The broadphase (one of `CollisionSpace.BROADPHASES`).
+    '''
+    assert kind in KINDS, 'Unknown kind: %s' % kind
+    self.kind = kind
+    self.count = count
+    self.power = power
+    self.size = size
+    self.seed = seed
+    self.engine = engine
+    self.name = '%s-%d-p%d-%s' % (kind, count, power, size)
+    if engine != 'grid':
+      self.name += '-' + engine
+
+  def build(self):
+    '''Creates a fresh headless game set up for this scenario.
+
+    Returns:
+      main.Main: The game.
+    '''
+    main.Main.MAIN_OBJECT = None
+    game = main.Main.get_main(main.parse_args(
+        ['--headless', '--size', self.size, '--seed', str(self.seed),
+         '--broadphase', self.engine]))
+    # A level with no waves: the only baddies are the ones placed here.
+    game.levels = [main.Level(None, game.size, game.spawn_points, 'bench', [])]
+    game.levels[0].start()
+    game.player.gun.power = self.power
+    game.player.shields = 10**9
+    self.rng = random.Random(self.seed)
+    self.fill(game)
+    return game
+
+  def fill(self, game):
+    '''Tops the baddies back up to `self.count`.'''
+    w, h = game.size
+    kinds = KINDS[self.kind]
+    baddies = [b for b in game.space.baddies if isinstance(b, main.Baddie)]
+    for i in xrange(self.count - len(baddies)):
+      cls = kinds[i % len(kinds)]
+      game.space.baddies.append(main.Pool.of(cls).acquire(
+          (self.rng.uniform(20, w - 20), self.rng.uniform(20, h - 20)),
+          self.rng.uniform(0, 2 * math.pi)))
+
+  def drive(self, game, t):
+    '''Plays the player for tick `t`: fire in a slowly turning circle.'''
+    game.player.fire(t / 10., game.space.add)
+
+
+class ReplayScenario(object):
+  '''A recorded game, played back from its `main.InputLog`.'''
+
+  def __init__(self, path):
+    self.path = path
+    self.name = 'replay-' + os.path.splitext(os.path.basename(path))[0]
+    self.power = 0
+
+  def build(self):
+    '''Creates a fresh headless game set up to replay the log.
+
+    Returns:
+      main.Main: The game.
+    '''
+    main.Main.MAIN_OBJECT = None
+    game = main.Main.get_main(main.parse_args(
+        ['--headless', '--replay', self.path]))
+    game.levels[game.lev_i].start()
+    self.frames = game.replay.frames()
+    return game
+
+  def fill(self, game):
+    pass
+
+  def drive(self, game, t):
+    '''Feeds the game the input for its next tick (skipping paused frames).
+
+    Returns:
+      bool: False once the log has run out.
+    '''
+    for axes, actions in self.frames:
+      game.feed(axes, actions)
+      if not game.paused:
+        return True
+    return False
+
+
+################################################################################
+#                                 Measurement                                  #
+################################################################################
+
+def percentiles(samples, ps=(50, 90, 95, 99)):
+  '''Computes summary statistics of `samples`.
+
+  Returns:
+    {str: float}: The mean, max and the requested percentiles (nearest-rank).
+  '''
+  if len(samples) == 0:
+    return {}
+  ordered = sorted(samples)
+  stats = { 'mean': sum(ordered) / float(len(ordered)), 'max': ordered[-1] }
+  for p in ps:
+    k = max(0, int(math.ceil(p / 100. * len(ordered))) - 1)
+    stats['p%d' % p] = ordered[k]
+  return stats
+
+
+class Recorder(object):
+  '''Collects latency (in ms) and allocation samples for named hot paths.'''
+
+  def __init__(self):
+    self.times = {}
+    self.allocs = {}
+
+  def measure(self, name, fn, *args):
+    '''Calls `fn(*args)`, recording how long it took and how many objects it
+    left allocated.  The garbage collector is paused during the call so that
+    `gc.get_count()` counts net new GC-tracked objects.
+
+    Returns:
+      The return value of `fn`.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    c0 = gc.get_count()[0]
+    t0 = timer()
+    ret = fn(*args)
+    t1 = timer()
+    c1 = gc.get_count()[0]
+    if enabled: gc.enable()
+    self.times.setdefault(name, []).append(1000. * (t1 - t0))
+    self.allocs.setdefault(name, []).append(c1 - c0)
+    return ret
+
+  def wrap(self, name, fn):
+    '''Wraps `fn` so every call to it is measured as `name`.'''
+    def measured(*args):
+      return self.measure(name, fn, *args)
+    return measured
+
+  def summary(self):
+    res = {}
+    for name in self.times:
+      res[name] = percentiles(self.times[name])
+      res[name]['net_allocs'] = (sum(self.allocs[name]) /
+                                 float(len(self.allocs[name])))
+      res[name]['samples'] = len(self.times[name])
+    return res
+
+
+def calc_all_ps(ships):
+  for s in ships:
+    s._calc_global_ps()
+
+
+def unplace(ships):
+  '''Drops each ship's placed shape, so the next `_calc_global_ps` builds it
+  again instead of returning the one placed during the tick.'''
+  for s in ships:
+    s.rect = None
+
+
+def run_scenario(scenario, ticks, warmup):
+  '''Runs one scenario.
+
+  Args:
+    scenario, Scenario: The scenario.
+    ticks, int: The number of ticks to measure.
+    warmup, int: The number of ticks to run before measuring.
+
+  Returns:
+    {str: ...}: The results, keyed by hot path (plus "comparisons").
+  '''
+  game = scenario.build()
+  stats = main.Stats.get_stats()
+  rec = Recorder()
+  space_tick = game.space.tick
+  game.space.tick = rec.wrap('space_tick', space_tick)
+  gun = main.Gun(scenario.power)
+  bullet_pool = main.Pool.of(main.Bullet)
+  comparisons = []
+
+  for t in xrange(warmup + ticks):
+    if t == warmup:
+      rec.times.clear()
+      rec.allocs.clear()
+    if scenario.drive(game, t) is False:
+      break
+    stats.reset()
+    rec.measure('main_tick', game.tick)
+    if t >= warmup:
+      comparisons.append(stats.counts.get('comparisons', 0))
+    ships = [b for b in game.space.baddies if isinstance(b, main.Ship)]
+    unplace(ships)
+    rec.measure('calc_global_ps', calc_all_ps, ships)
+    volley = []
+    rec.measure('gun_fire', gun.fire, game.player.pos, t / 10., volley.append)
+    for bullet in volley:
+      bullet_pool.release(bullet)
+    scenario.fill(game)
+
+  res = rec.summary()
+  res['comparisons'] = percentiles(comparisons)
+  return res
+
+
+################################################################################
+#                                   Commands                                   #
+################################################################################
+
+def scenarios(args):
+  '''Builds the list of scenarios asked for on the command line.'''
+  if args.replays:
+    return [ReplayScenario(p) for p in args.replays]
+  grid = dict(FULL if args.full else DEFAULTS)
+  for key in grid:
+    if getattr(args, key) is not None:
+      grid[key] = getattr(args, key)
+  return [Scenario(k, c, p, s, args.seed, e) for k, c, p, s, e in
+          itertools.product(grid['kinds'], grid['counts'], grid['powers'],
+                            grid['sizes'], grid['engines'])
+          if args.match is None or args.match in
+          Scenario(k, c, p, s, engine=e).name]
+
+
+def cmd_list(args):
+  for s in scenarios(args):
+    print s.name
+
+
+def cmd_run(args):
+  results = {}
+  print '%-36s %9s %9s %9s %9s %11s %10s' % ('scenario', 'tick p50',
+      'tick p95', 'tick p99', 'space p50', 'comparisons', 'net allocs')
+  for s in scenarios(args):
+    res = results[s.name] = run_scenario(s, args.ticks, args.warmup)
+    print '%-36s %9.3f %9.3f %9.3f %9.3f %11.1f %10.1f' % (s.name,
+        res['main_tick']['p50'], res['main_tick']['p95'],
+        res['main_tick']['p99'], res['space_tick']['p50'],
+        res['comparisons']['mean'], res['main_tick']['net_allocs'])
+    sys.stdout.flush()
+
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({ 'meta': { 'time': time.time(),
+                            'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'ticks': args.ticks,
+                            'warmup': args.warmup,
+                            'seed': args.seed },
+                  'results': results }, f, indent=1, sort_keys=True)
+    print 'Wrote', args.output
+
+
+COMPARED = (('main_tick', 'p50', 1e-3), ('main_tick', 'p95', 1e-3),
+            ('main_tick', 'p99', 1e-3), ('space_tick', 'p50', 1e-3),
+            ('space_tick', 'p95', 1e-3), ('calc_global_ps', 'p50', 1e-3),
+            ('gun_fire', 'p50', 1e-3), ('comparisons', 'mean', 1),
+            ('main_tick', 'net_allocs', 1))
+'''(hot path, statistic, smallest absolute increase that matters) to compare.'''
+
+
+def compare(old, new, threshold):
+  '''Compares two sets of results.
+
+  Args:
+    old, {str: ...}: The baseline results (the "results" of a run).
+    new, {str: ...}: The results to check.
+    threshold, float: The relative increase that counts as a regression.
+
+  Returns:
+    [(str,str,str,float,float)]: (scenario, path, stat, old, new) for every
+    regression.
+  '''
+  regressions = []
+  for name in sorted(set(old) & set(new)):
+    for path, stat, eps in COMPARED:
+      if path not in old[name] or path not in new[name]:
+        continue
+      a = old[name][path].get(stat)
+      b = new[name][path].get(stat)
+      if a is None or b is None:
+        continue
+      if b - a > max(threshold * abs(a), eps):
+        regressions.append((name, path, stat, a, b))
+  return regressions
+
+
+def cmd_compare(args):
+  with open(args.old) as f: old = json.load(f)['results']
+  with open(args.new) as f: new = json.load(f)['results']
+  missing = sorted(set(old) ^ set(new))
+  if missing:
+    print 'Only in one run (skipped):', ', '.join(missing)
+  regressions = compare(old, new, args.threshold)
+  for name, path, stat, a, b in regressions:
+    print 'REGRESSION %-36s %s.%s: %.3f -> %.3f (%+.0f%%)' % (name, path,
+        stat, a, b, 100. * (b - a) / abs(a) if a else float('inf'))
+  print '%d regression(s) over %d%% in %d common scenario(s).' % (
+      len(regressions), 100 * args.threshold, len(set(old) & set(new)))
+  return 1 if regressions else 0
+
+
+def parse_args():
+  ap = argparse.ArgumentParser(description='Benchmark the simulation.')
+  sub = ap.add_subparsers()
+
+  for name, fn in (('run', cmd_run), ('list', cmd_list)):
+    sp = sub.add_parser(name)
+    sp.set_defaults(fn=fn)
+    sp.add_argument('--full', action='store_true',
+                    help="Use the full scenario grid.")
+    sp.add_argument('--kinds', nargs='+', choices=sorted(KINDS))
+    sp.add_argument('--counts', nargs='+', type=int)
+    sp.add_argument('--powers', nargs='+', type=int)
+    sp.add_argument('--sizes', nargs='+')
+    sp.add_argument('--engines', nargs='+',
+                    choices=main.CollisionSpace.BROADPHASES,
+                    help="Broadphase engines to run each scenario with.")
+    sp.add_argument('--replays', nargs='+', metavar='LOG',
+                    help="Benchmark these recorded games instead.")
+    sp.add_argument('-k', '--match',
+                    help="Only run scenarios whose name contains this.")
+    sp.add_argument('-S', '--seed', type=int, default=1)
+    sp.add_argument('-n', '--ticks', type=int, default=200,
+                    help="Ticks to measure per scenario (at most).")
+    sp.add_argument('-w', '--warmup', type=int, default=20,
+                    help="Ticks to run before measuring.")
+    sp.add_argument('-o', '--output',
+                    help="Write the results as JSON to this file.")
+
+  sp = sub.add_parser('compare')
+  sp.set_defaults(fn=cmd_compare)
+  sp.add_argument('old', help="Baseline results.")
+  sp.add_argument('new', help="Results to check against the baseline.")
+  sp.add_argument('-t', '--threshold', type=float, default=.1,
+                  help="Relative slowdown that counts as a regression.")
+  return ap.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  sys.exit(args.fn(args) or 0)
@@ -13,14 +13,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import math
+import json
+import mmap
 import time
+import Queue
+import pstats
+import signal
+import struct
+import cProfile
+import threading
 import random
-random.seed(time.time())
+import bisect
+import hashlib
+import collections
+from timeit import default_timer as timer
 
 import argparse
 
+import numpy
+
 #from OpenGL.GL import *
 #from OpenGL.GLU import *
 
@@ -30,18 +44,545 @@ from pygame.locals import *
 
 
 
+################################################################################
+#                              Time and Randomness                             #
+################################################################################
+
+class SimClock(object):
+  '''The simulation\'s clock.  Everything in the game that needs to know what
+  time it is asks this instead of the wall clock, and it only moves forward
+  by a fixed step each time the simulation ticks.  So the game plays the same
+  no matter how fast (or how unevenly) the ticks actually run.
+
+  Speeds and other per-tick amounts throughout the game are given for a tick
+  of `REFERENCE_STEP`; anything that changes every tick scales them by
+  `scale`, so a game ticking at a different rate still plays the same.'''
+
+  REFERENCE_STEP = 1000. / 30
+  '''The step (in ms) that per-tick amounts are given for.'''
+
+  clock_object = None
+  '''The clock in use.'''
+
+  @classmethod
+  def get_clock(cls):
+    '''Gets the clock in use, creating a default one if there is none.
+
+    Returns:
+      The current `SimClock`.
+    '''
+    if cls.clock_object is None:
+      cls.clock_object = cls()
+    return cls.clock_object
+
+  @classmethod
+  def set_clock(cls, clock):
+    '''Replaces the clock in use.
+
+    Args:
+      clock, SimClock: The clock everything should consult from now on.
+    '''
+    cls.clock_object = clock
+
+  def __init__(self, step=REFERENCE_STEP):
+    '''Creates a clock at time 0.
+
+    Args:
+      step, float: The simulated time (in ms) that passes every tick.
+    '''
+    self.step = step
+    self.scale = step / self.REFERENCE_STEP
+    self.ticks = 0
+
+  def now(self):
+    '''Gets the simulated time (in ms) since the clock started.'''
+    return self.ticks * self.step
+
+  def tick(self):
+    '''Advances the clock by one step.'''
+    self.ticks += 1
+
+  def reset(self):
+    '''Sets the clock back to time 0.'''
+    self.ticks = 0
+
+
+class RandomStreams(object):
+  '''Independent random number streams, one per subsystem (e.g., "ai",
+  "spawn", "upgrades" and "cosmetic"), all derived from a single seed.  Since
+  each subsystem draws from its own stream, drawing more or fewer numbers in
+  one (say, by not rendering) does not change what happens in the others.'''
+
+  streams_object = None
+  '''The singleton object.'''
+
+  @classmethod
+  def get_streams(cls):
+    '''Gets the one and only `RandomStreams` object.'''
+    if cls.streams_object is None:
+      cls.streams_object = cls()
+    return cls.streams_object
+
+  @classmethod
+  def stream(cls, name):
+    '''Gets the stream for the subsystem `name`.
+
+    Returns:
+      random.Random: The stream.
+    '''
+    return cls.get_streams().get(name)
+
+  @classmethod
+  def array_stream(cls, name):
+    '''Gets the NumPy stream for the subsystem `name`, for drawing whole
+    arrays of numbers at once.  It is seeded like, but independent of, the
+    `stream` of the same name.
+
+    Returns:
+      numpy.random.RandomState: The stream.
+    '''
+    return cls.get_streams().get_array(name)
+
+  def __init__(self, seed=None):
+    '''Creates the streams.
+
+    Args:
+      seed, int: The seed.  If None, one is made from the current time.
+    '''
+    self.streams = {}
+    self.arrays = {}
+    self.seed(seed)
+
+  def _derive(self, name):
+    return int(hashlib.md5('%d:%s' % (self.base_seed, name)).hexdigest(), 16)
+
+  def _derive_array(self, name):
+    # RandomState wants 32-bit words.
+    seed = self._derive('array:' + name)
+    return [(seed >> (32 * i)) & 0xffffffff for i in xrange(4)]
+
+  def seed(self, seed=None):
+    '''Reseeds every stream.  Streams handed out before stay valid.
+
+    Args:
+      seed, int: The seed.  If None, one is made from the current time.
+    '''
+    if seed is None:
+      seed = int(time.time() * 1000)
+    self.base_seed = seed
+    for name, stream in self.streams.iteritems():
+      stream.seed(self._derive(name))
+    for name, stream in self.arrays.iteritems():
+      stream.seed(self._derive_array(name))
+
+  def get(self, name):
+    '''Gets the stream for the subsystem `name`, creating it if needed.'''
+    if name not in self.streams:
+      self.streams[name] = random.Random(self._derive(name))
+    return self.streams[name]
+
+  def get_array(self, name):
+    '''Gets the NumPy stream for the subsystem `name`, creating it if needed.'''
+    if name not in self.arrays:
+      self.arrays[name] = numpy.random.RandomState(self._derive_array(name))
+    return self.arrays[name]
+
+
+
+################################################################################
+#                                  Rendering                                   #
+################################################################################
+
+def lerp(p0, p1, alpha):
+  '''Gets the point `alpha` of the way from `p0` to `p1`, for drawing between
+  two ticks.
+
+  Args:
+    p0, (float,float): Where it was (or None to just use `p1`).
+    p1, (float,float): Where it is.
+    alpha, float: How far between them (0 to 1).
+  '''
+  if p0 is None or alpha >= 1:
+    return p1
+  return (p0[0] + alpha * (p1[0] - p0[0]), p0[1] + alpha * (p1[1] - p0[1]))
+
+
+class SpriteCache(object):
+  '''Pre-rendered sprites, so that drawing an entity is a single blit instead
+  of rasterizing its polygons, rects and circles every frame.  Sprites are
+  keyed by whatever determines how they look (e.g., shape, color and heading)
+  and the least recently used ones are evicted once there are more than
+  `capacity` of them.'''
+
+  cache_object = None
+  '''The singleton object.'''
+
+  @classmethod
+  def get_cache(cls):
+    '''Gets the one and only `SpriteCache` object.'''
+    if cls.cache_object is None:
+      cls.cache_object = cls()
+    return cls.cache_object
+
+  @staticmethod
+  def surface(w, h):
+    '''Creates a blank, transparent surface to render a sprite onto.'''
+    # 32-bit explicitly: SRCALPHA has no masks at the display's depth unless
+    # that is 32-bit too.
+    surf = pygame.Surface((w, h), SRCALPHA, 32)
+    if pygame.display.get_surface() is not None:
+      surf = surf.convert_alpha()
+    surf.fill((0, 0, 0, 0))
+    return surf
+
+  def __init__(self, capacity=4096):
+    '''Creates an empty cache.
+
+    Args:
+      capacity, int: The most sprites to keep.
+    '''
+    self.capacity = capacity
+    self.sprites = collections.OrderedDict()
+    self.hits = self.misses = self.evictions = 0
+
+  def get(self, key, render):
+    '''Gets the sprite for `key`, rendering it if it is not cached.
+
+    Args:
+      key: Anything hashable that identifies how the sprite looks.
+      render, callable: Called with no arguments to render the sprite on a
+                        miss.  Returns (pygame.Surface, (int,int)): the sprite
+                        and the offset of its top-left corner from the
+                        entity\'s position.
+
+    Returns:
+      (pygame.Surface, (int,int)): The sprite and its offset.
+    '''
+    try:
+      sprite = self.sprites.pop(key)
+      self.hits += 1
+    except KeyError:
+      sprite = render()
+      self.misses += 1
+      if len(self.sprites) >= self.capacity:
+        self.sprites.popitem(last=False)
+        self.evictions += 1
+    self.sprites[key] = sprite
+    return sprite
+
+  def blit(self, screen, pos, key, render):
+    '''Draws the sprite for `key` (see `get`) at `pos` on `screen`.
+
+    Returns:
+      pygame.Rect: The area of the screen drawn on.
+    '''
+    surf, (ox, oy) = self.get(key, render)
+    return screen.blit(surf, (int(pos[0]) + ox, int(pos[1]) + oy))
+
+  def clear(self):
+    self.sprites.clear()
+
+
+class DirtyRects(object):
+  '''Dirty-rectangle screen updates.  Instead of clearing and flipping the
+  whole screen every frame, this erases only the areas drawn on last frame
+  and pushes only those and the areas drawn on this frame to the display.
+  When those cover more than `threshold` of the screen, it falls back to
+  clearing and flipping the whole thing, which is cheaper by then.'''
+
+  def __init__(self, screen, threshold=.5):
+    '''Creates the tracker.
+
+    Args:
+      screen, pygame.Surface: The display surface.
+      threshold, float: The fraction of the screen\'s area above which to do
+                        a full flip instead.
+    '''
+    self.screen = screen
+    self.threshold = threshold
+    self.area = float(screen.get_width() * screen.get_height())
+    self.prev = []
+    self.full = True   # Nothing is known about the screen yet.
+    self.flips = self.updates = 0
+
+  def _coverage(self, rects):
+    '''Gets the fraction of the screen `rects` cover (overlaps counted twice,
+    so this errs toward full flips).'''
+    return sum(r.w * r.h for r in rects) / self.area
+
+  def erase(self):
+    '''Clears whatever was drawn last frame.'''
+    if self.full:
+      self.screen.fill((0,0,0))
+    else:
+      for r in self.prev:
+        self.screen.fill((0,0,0), r)
+
+  def update(self, rects):
+    '''Pushes this frame to the display.
+
+    Args:
+      rects, [pygame.Rect]: The areas drawn on this frame (None and empty
+                            rects are ignored).
+    '''
+    rects = [r for r in rects if r]
+    dirty = self.prev + rects
+    if self.full or self._coverage(dirty) > self.threshold:
+      pygame.display.flip()
+      self.flips += 1
+    else:
+      pygame.display.update(dirty)
+      self.updates += 1
+    self.full = self._coverage(rects) > self.threshold
+    self.prev = rects
+
+
+class TextCache(SpriteCache):
+  '''Rendered text.  Strings that do not change are rendered once and then
+  reused; strings that change all the time (scores, counters) can instead be
+  drawn glyph by glyph from cached single-character surfaces, so that a new
+  value never needs a `font.render`.'''
+
+  WHITE = (255, 255, 255)
+
+  cache_object = None
+  '''The singleton object.'''
+
+  def __init__(self, capacity=512):
+    super(TextCache, self).__init__(capacity)
+
+  def render(self, font, text, antialias=False, color=WHITE):
+    '''Gets the (cached) surface of `text` rendered with `font`.'''
+    return self.get((font, text, antialias, color),
+        lambda: (font.render(text, antialias, color), (0, 0)))[0]
+
+  def size(self, font, text, antialias=False, color=WHITE, glyphs=False):
+    '''Gets the size `text` takes up when drawn.
+
+    Args:
+      font, pygame.font.Font: The font.
+      text, str: The text.
+      antialias, bool: Whether to antialias.
+      color, (int,int,int): The color.
+      glyphs, bool: Whether the text will be drawn glyph by glyph.
+
+    Returns:
+      (int,int): The width and height (in pixels).
+    '''
+    if not glyphs:
+      return self.render(font, text, antialias, color).get_size()
+    w = h = 0
+    for ch in text:
+      gw, gh = self.render(font, ch, antialias, color).get_size()
+      w += gw
+      h = max(h, gh)
+    return w, h
+
+  def draw(self, screen, font, text, pos, antialias=False, color=WHITE,
+           glyphs=False):
+    '''Draws `text` on `screen` with its top-left corner at `pos`.
+
+    Args:
+      glyphs, bool: Whether to compose the text from cached glyphs instead of
+                    caching the whole string.  Use this for text that changes
+                    (nearly) every frame.
+      (The rest are as in `size`.)
+
+    Returns:
+      pygame.Rect: The area of the screen drawn on.
+    '''
+    if not glyphs:
+      return screen.blit(self.render(font, text, antialias, color), pos)
+    x, y = pos
+    h = 0
+    for ch in text:
+      surf = self.render(font, ch, antialias, color)
+      screen.blit(surf, (x, y))
+      x += surf.get_width()
+      h = max(h, surf.get_height())
+    return pygame.Rect(pos, (x - pos[0], h))
+
+
+
+################################################################################
+#                                 Object Pools                                 #
+################################################################################
+
+class Pool(object):
+  '''A free list of instances of one class.  Instead of creating a new object
+  for every bullet, upgrade and baddie and dropping it when it dies (which,
+  under heavy fire, churns through thousands of objects a second and makes
+  the garbage collector hitch), objects are released back to their pool and
+  re-initialized when acquired again.
+
+  Each pool keeps track of how many of its objects are live and the most that
+  have ever been live at once (the high-water mark), so `limit` can be tuned
+  to how many objects are worth keeping around.'''
+
+  pools = {}
+  '''All the pools, by class.'''
+
+  LIMIT = 10000
+  '''The default most free objects to keep per pool.'''
+
+  @classmethod
+  def of(cls, kind):
+    '''Gets the pool for instances of `kind`, creating it if needed.'''
+    if kind not in cls.pools:
+      cls.pools[kind] = cls(kind)
+    return cls.pools[kind]
+
+  @classmethod
+  def report(cls):
+    '''Gets the statistics of every pool.
+
+    Returns:
+      [str]: One line per pool.
+    '''
+    return [ '%-14s live: %5d  high-water: %5d  free: %5d  created: %6d  '
+             'reused: %7d  discarded: %5d' % (kind.__name__, p.live,
+                 p.high_water, len(p.free), p.created, p.reused, p.discarded)
+             for kind, p in sorted(cls.pools.iteritems(),
+                                   key=lambda kp: kp[0].__name__) ]
+
+  def __init__(self, kind, limit=LIMIT):
+    '''Creates an empty pool.
+
+    Args:
+      kind, type: The class of the pooled objects.
+      limit, int: The most free objects to keep; past this, released objects
+                  are simply dropped.
+    '''
+    self.kind = kind
+    self.limit = limit
+    self.free = []
+    self.live = self.high_water = 0
+    self.created = self.reused = self.discarded = 0
+
+  def acquire(self, *args):
+    '''Gets an object initialized with `args`, reusing a free one if there is
+    one.'''
+    if self.free:
+      obj = self.free.pop()
+      obj.__init__(*args)
+      self.reused += 1
+    else:
+      obj = self.kind(*args)
+      self.created += 1
+    self.live += 1
+    if self.live > self.high_water:
+      self.high_water = self.live
+    return obj
+
+  def release(self, obj):
+    '''Gives `obj` back to the pool.  It must not be used after this.'''
+    self.live -= 1
+    if len(self.free) < self.limit:
+      self.free.append(obj)
+    else:
+      self.discarded += 1
+
+
+
 ################################################################################
 #                                    Debug                                     #
 ################################################################################
 
+class PhaseTimer(object):
+  '''Times one phase of a frame, as a context manager, keeping the last few
+  durations (in ms) in a ring buffer.'''
+
+  __slots__ = ('samples', 'i', 'n', 'started')
+
+  def __init__(self, window):
+    '''Creates a timer.
+
+    Args:
+      window, int: How many of the latest durations to keep.
+    '''
+    self.samples = numpy.zeros(window)
+    self.i = self.n = 0
+    self.started = 0.
+
+  def __enter__(self):
+    self.started = timer()
+
+  def __exit__(self, *exc):
+    self.samples[self.i] = 1000. * (timer() - self.started)
+    self.i += 1
+    if self.i == len(self.samples):
+      self.i = 0
+    if self.n < len(self.samples):
+      self.n += 1
+
+  def latest(self):
+    '''Gets the durations kept, oldest first.'''
+    i, n = self.i, self.n
+    return numpy.roll(self.samples, -i)[-n:] if n else self.samples[:0]
+
+  def summary(self):
+    '''Gets statistics of the durations kept.
+
+    Returns:
+      {str: float}: Their mean, max, p50, p95 and p99 (in ms), and how many
+                    there are ("samples").
+    '''
+    n = self.n
+    if not n:
+      return { 'samples': 0 }
+    # A copy, as another thread may be timing the phase (see `Stats.lock`).
+    samples = self.samples[:n].copy()
+    p50, p95, p99 = numpy.percentile(samples, (50, 95, 99)).tolist()
+    return { 'samples': n, 'mean': float(samples.mean()),
+             'max': float(samples.max()), 'p50': p50, 'p95': p95, 'p99': p99 }
+
+
+class NullTimer(object):
+  '''Stands in for every `PhaseTimer` while timing is off.'''
+
+  __slots__ = ()
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    pass
+
+
 class Stats(object):
   '''Keeps track of statistics about the game.  This counts variables
   (distinguished by their string names), incrementing them by 1 for every call
-  to `Stats#inc(varname)`.'''
+  to `Stats#inc(varname)`.
+
+  When timing is on, it also times the phases of each frame (see `PHASES`):
+  the code of a phase runs in `with stats.phase(name):`, which costs only a
+  call to a no-op context manager while timing is off.'''
 
   MARGIN = 20
   '''The margin between HUD and edge of screen.'''
 
+  PHASES = ('wait', 'input', 'tick', 'player', 'levels', 'space', 'ai', 'move',
+            'collide', 'spawns', 'draw', 'flip')
+  '''The phases timed, in the order they are shown:
+       wait     sleeping to keep to the frame rate
+       input    reading (or replaying) and acting on input
+       tick     all of `Main.tick`, which is made up of
+         player   moving the player (or exploding)
+         levels   level progression
+         space    all of `CollisionSpace.tick`, which is made up of
+           ai       the baddies\' and upgrades\' behaviors
+           move     bounding baddies and moving them in the broadphase, and
+                    moving bullets
+           collide  collision detection
+         spawns   the spawn points
+       draw     drawing the frame
+       flip     putting it on the screen'''
+
+  WINDOW = 300
+  '''How many of the latest durations of each phase to keep.'''
+
+  NULL_TIMER = NullTimer()
+
   stats_object = None
   '''The singleton object.'''
 
@@ -64,13 +605,67 @@ class Stats(object):
     '''Creates the statistics object.
 
     Args:
-      screen, pygame.Screen: The screen.
+      screen, pygame.Screen: The screen, or None when running headless.
       size, (int,int): The width and height of the screen (in pixels).
     '''
     self.screen = screen
     self.size = self.width,self.height = size
-    self.font = pygame.font.SysFont("courier", 10, bold=True)
+    self.font = None
+    if screen is not None:
+      self.font = pygame.font.SysFont("courier", 10, bold=True)
     self.counts = {}
+    self.hud = True
+    self.timing = False
+    self.timers = {}
+    # Guards adding to `timers` against reading them: with --pipeline, the
+    # render thread draws the timings while the simulation times its phases.
+    self.lock = threading.Lock()
+
+  def enable_timing(self, on=True):
+    '''Turns timing the phases on or off.  Durations already kept are kept.'''
+    self.timing = on
+
+  def phase(self, name):
+    '''Gets the context manager that times the phase `name`.'''
+    if not self.timing:
+      return self.NULL_TIMER
+    t = self.timers.get(name)
+    if t is None:
+      with self.lock:
+        t = self.timers.setdefault(name, PhaseTimer(self.WINDOW))
+    return t
+
+  def timings(self):
+    '''Gets statistics of every phase timed (see `PhaseTimer.summary`).
+
+    Returns:
+      [(str, {str: float})]: The phases, in the order of `PHASES`, with their
+                             statistics.
+    '''
+    order = dict((p, i) for i, p in enumerate(self.PHASES))
+    with self.lock:
+      timers = sorted(self.timers.items(),
+                      key=lambda (p, t): (order.get(p, len(order)), p))
+    return [ (name, t.summary()) for name, t in timers ]
+
+  def export(self, path):
+    '''Writes the timings to the file `path`: a table of each phase\'s
+    statistics if it ends in ".csv", otherwise JSON that also holds the
+    durations kept.'''
+    timings = self.timings()
+    columns = ('samples', 'mean', 'p50', 'p95', 'p99', 'max')
+    with open(path, 'w') as f:
+      if path.endswith('.csv'):
+        f.write('phase,%s\n' % ','.join(columns))
+        for name, s in timings:
+          f.write('%s,%s\n' % (name, ','.join(str(s.get(c, '')) for c in
+                                                columns)))
+      else:
+        json.dump({ 'window': self.WINDOW,
+                    'phases': [ dict(s, phase=name,
+                                     latest=self.timers[name].latest().tolist())
+                                for name, s in timings ] },
+                  f, indent=1, sort_keys=True)
 
   def reset(self, varname=None):
     '''Resets the variable name `varname` to be 0.
@@ -89,22 +684,280 @@ class Stats(object):
     Args:
       varname, str: The name of the variable.
     '''
-    self.counts[varname] = 1 + (varname in self.counts and
-                                self.counts[varname] or 0)
-    return
+    self.counts[varname] = self.counts.get(varname, 0) + 1
 
-  def draw(self):
-    '''Draw all the variables and their values on the screen.'''
+  def add(self, varname, n):
+    '''Adds `n` to a variable, for counting in bulk: a loop can count in a
+    local and add it once at the end, rather than calling `inc` every time
+    around.'''
+    self.counts[varname] = self.counts.get(varname, 0) + n
+
+  def draw(self, counts=None):
+    '''Draw all the variables and their values on the screen, and the
+    timings (if on) in the bottom left.  Draws nothing if `hud` is off.
+
+    Args:
+      counts, {str: int}: The values to show, if not `self.counts` (e.g. a
+                          copy taken on another thread).
+    '''
+    if not self.hud:
+      return []
+    if counts is None:
+      counts = self.counts
+    text = TextCache.get_cache()
+    rects = []
     x, y = self.width - self.MARGIN, self.MARGIN
-    for key in self.counts:
-      string = "%s: % 8d" % (key, self.counts[key])
-      w, h = self.font.size(string)
-      self.screen.blit(self.font.render(string, True, (255, 255, 255)),
-                       (x-w, y))
+    for key in counts:
+      label = "%s: " % key
+      number = "% 8d" % counts[key]
+      lw, h = text.size(self.font, label, True)
+      w = lw + text.size(self.font, number, True, glyphs=True)[0]
+      rects.append(text.draw(self.screen, self.font, label, (x-w, y), True))
+      rects.append(text.draw(self.screen, self.font, number, (x-w+lw, y),
+                             True, glyphs=True))
       y += h
 
+    if self.timing:
+      lines = ['%-8s %7s %7s %7s' % ('ms', 'p50', 'p95', 'p99')]
+      for name, s in self.timings():
+        if s['samples']:
+          lines.append('%-8s %7.2f %7.2f %7.2f' % (name, s['p50'], s['p95'],
+                                                   s['p99']))
+      h = text.size(self.font, lines[0], True)[1]
+      y = self.height - self.MARGIN - h * len(lines)
+      for line in lines:
+        rects.append(text.draw(self.screen, self.font, line, (self.MARGIN, y),
+                               True, glyphs=True))
+        y += h
+    return rects
+
+
+
+class Profiler(object):
+  '''Profiles the next few frames of a live game on demand.
+
+  While a capture is on, the code run in `with profiler:` (the tick and the
+  drawing) is profiled, either by a statistical sampler, which interrupts
+  the game every `interval` seconds of CPU time to note where it is (and so
+  costs little however deep the calls go), or by cProfile, which hooks
+  every call.  When the capture ends, it writes:
+    PREFIX.collapsed  (sampler) one line per call stack: "f;g;h SAMPLES",
+                      for flamegraph.pl, speedscope and the like
+    PREFIX.prof       (cProfile) the raw stats, for pstats, snakeviz, ...
+    PREFIX.txt        the `top` functions that took the most time'''
+
+  MODES = ('sample', 'cprofile')
+
+  def __init__(self, mode='sample', frames=300, prefix='profile',
+               interval=.001, top=25):
+    '''Creates a profiler (that is not capturing).
+
+    Args:
+      mode, str: One of `MODES`.  Without `signal.setitimer` (on Windows),
+                 "sample" falls back to "cprofile".
+      frames, int: How many frames a capture lasts.
+      prefix, str: The path of the files written, less their extension.
+      interval, float: How often the sampler samples (in seconds of CPU).
+      top, int: How many functions the table lists.
+    '''
+    assert mode in self.MODES, 'Unknown profiler mode: %s' % mode
+    if mode == 'sample' and not hasattr(signal, 'setitimer'):
+      mode = 'cprofile'
+    self.mode = mode
+    self.frames = frames
+    self.prefix = prefix
+    self.interval = interval
+    self.top = top
+    self.capturing = False
+    self.inside = False  # Whether in a `with profiler:` block.
+    self.thread = None   # The thread in it.
+    self.enabled = None  # The cProfile it enabled, if any.
+    self.left = 0
+
+  def start(self):
+    '''Starts a capture of the next `frames` frames (unless one is on).'''
+    if self.capturing:
+      return
+    self.capturing = True
+    self.left = self.frames
+    self.stacks = collections.Counter()  # (code, ...) -> samples
+    self.profile = cProfile.Profile() if self.mode == 'cprofile' else None
+    if self.mode == 'sample':
+      # The timer runs all through the capture (restarting it at every block
+      # would never let it fire in blocks shorter than `interval`), and
+      # samples outside the blocks are dropped.
+      signal.signal(signal.SIGPROF, self._sample)
+      signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    print 'Profiling %d frames (%s)...' % (self.frames, self.mode)
+
+  def __enter__(self):
+    if not self.capturing:
+      return
+    self.inside = True
+    self.thread = threading.current_thread()
+    self.enabled = self.profile
+    if self.enabled is not None:
+      self.enabled.enable()
+
+  def __exit__(self, *exc):
+    # Even if the capture has ended since (e.g. from another thread), so
+    # that cProfile never stays hooked.
+    if not self.inside:
+      return
+    self.inside = False
+    if self.enabled is not None:
+      self.enabled.disable()
+      self.enabled = None
+
+  def _sample(self, signum, frame):
+    if not self.inside:
+      return
+    if self.thread is not threading.current_thread():
+      # Signals always arrive on the main thread, but the block may be
+      # running on another (see `Main.run_pipelined`).
+      frame = sys._current_frames().get(self.thread.ident)
+    stack = []
+    while frame is not None:
+      stack.append(frame.f_code)
+      frame = frame.f_back
+    stack.reverse()
+    self.stacks[tuple(stack)] += 1
+
+  def frame(self):
+    '''Ends a frame, and the capture with the last of its frames.'''
+    if not self.capturing:
+      return
+    self.left -= 1
+    if self.left <= 0:
+      self.stop()
+
+  def stop(self):
+    '''Ends the capture (if one is on) and writes what it caught.'''
+    if not self.capturing:
+      return
+    self.capturing = False
+    if self.profile is None:
+      signal.setitimer(signal.ITIMER_PROF, 0)
+      signal.signal(signal.SIGPROF, signal.SIG_DFL)
+      self._write_samples()
+    else:
+      self._write_profile()
+
+  @staticmethod
+  def _name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+  def _write_samples(self):
+    total = max(1, sum(self.stacks.itervalues()))
+    own = collections.Counter()
+    inclusive = collections.Counter()
+    with open(self.prefix + '.collapsed', 'w') as f:
+      for stack, n in self.stacks.iteritems():
+        f.write('%s %d\n' % (';'.join(self._name(c) for c in stack), n))
+        own[stack[-1]] += n
+        for code in set(stack):
+          inclusive[code] += n
+
+    lines = [ '%d samples every %gms of CPU over %d frames' % (total,
+                  1000. * self.interval, self.frames),
+              '%8s %7s %8s %7s  %s' % ('self', '%', 'total', '%', 'function') ]
+    for code, n in own.most_common(self.top):
+      lines.append('%8d %6.1f%% %8d %6.1f%%  %s' % (n, 100. * n / total,
+          inclusive[code], 100. * inclusive[code] / total, self._name(code)))
+    self._write_table(lines, '.collapsed')
+
+  def _write_profile(self):
+    self.profile.dump_stats(self.prefix + '.prof')
+    with open(self.prefix + '.txt', 'w') as f:
+      ps = pstats.Stats(self.profile, stream=f)
+      ps.sort_stats('tottime').print_stats(self.top)
+    with open(self.prefix + '.txt') as f:
+      lines = f.read().splitlines()
+    self._write_table(lines, '.prof')
+
+  def _write_table(self, lines, ext):
+    with open(self.prefix + '.txt', 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    for line in lines[:12]: print line
+    print 'Wrote %s%s and %s.txt' % (self.prefix, ext, self.prefix)
+
+
+
+class Entity(object):
+  '''The base of everything that lives in a `CollisionSpace`.  Entities are
+  kept compact: every class declares `__slots__` for what actually varies
+  per instance, and constants of the type (color, shape, speed, score) are
+  class attributes.  They all draw on the one `Entity.screen`.'''
+
+  __slots__ = ()
+
+  screen = None
+  '''The surface all entities draw on (None when running headless).'''
+
+  translucent = True
+  '''Whether to draw the translucent fills of ships, shields and upgrades
+  (see `QualityLadder`).'''
+
+  def footprint(self):
+    '''Gets the memory this entity uses: the object itself plus the values it
+    alone owns.  Class attributes, and anything shared such as small ints,
+    strings or the `BulletStore`, are not counted.
+
+    Returns:
+      int: The size in bytes.
+    '''
+    return owned_size(self)
+
+  @classmethod
+  def report(cls, entities):
+    '''Accounts for the memory used by some entities, per type.
+
+    Args:
+      entities, [Entity]: The entities (e.g. everything live in the game).
+
+    Returns:
+      [str]: One line per type, then a total.
+    '''
+    types = {}
+    for e in entities:
+      n, total = types.get(type(e), (0, 0))
+      types[type(e)] = n + 1, total + e.footprint()
+    lines = []
+    for kind, (n, total) in sorted(types.iteritems(),
+                                   key=lambda kt: kt[0].__name__):
+      lines.append('%-14s count: %6d  bytes/each: %6.1f  total: %9d' % (
+          kind.__name__, n, total / float(n), total))
+    lines.append('%-14s count: %6d  %18s  total: %9d' % ('(all)',
+        sum(n for n, _ in types.itervalues()), '',
+        sum(t for _, t in types.itervalues())))
+    return lines
+
+
+def owned_size(value):
+  '''Gets the size of `value` plus everything it owns, following lists,
+  tuples and the slots of slotted objects.
+
+  Returns:
+    int: The size in bytes.
+  '''
+  if isinstance(value, (list, tuple)):
+    return sys.getsizeof(value) + sum(owned_size(v) for v in value)
+  if isinstance(value, (float, long, pygame.Rect)):
+    return sys.getsizeof(value)
+  if isinstance(value, int) and not -5 <= value <= 256:
+    return sys.getsizeof(value)
+  if isinstance(value, (Entity, Gun)):
+    slots = [s for c in type(value).__mro__
+             for s in c.__dict__.get('__slots__', ())]
+    return sys.getsizeof(value) + sum(owned_size(getattr(value, s, None))
+                                      for s in slots)
+  return 0
+
+
+class Positional(Entity):
+  __slots__ = ()
 
-class Positional(object):
   def move(self, *delta):
     '''Moves this element by the specified amount in the X and Y directions.
 
@@ -120,37 +973,98 @@ class Positional(object):
     return self.pos
 
 
+class ShipGeometry(object):
+  '''The shape of a ship (its points, scaled by its size) pre-rotated to
+  every one of `STEPS` headings, along with the bounding box of each rotated
+  copy.  Placing a ship in the world is then just a translation.  There is one
+  of these per distinct (points, size), shared by all ships of that shape.'''
+
+  STEPS = 360
+  '''The number of headings per full turn.'''
+
+  cache = {}
+  '''All the geometries created so far, by (points, size).'''
+
+  @classmethod
+  def get(cls, points, size):
+    '''Gets the geometry of the shape `points` at size `size`.
+
+    Args:
+      points, ((float,float),): The ship\'s points.
+      size, float: The ship\'s size.
+
+    Returns:
+      ShipGeometry: The (shared) geometry.
+    '''
+    key = tuple(map(tuple, points)), size
+    if key not in cls.cache:
+      cls.cache[key] = cls(key[0], size)
+    return cls.cache[key]
+
+  def __init__(self, points, size):
+    self.polys = []
+    self.extents = []
+    for k in xrange(self.STEPS):
+      st = math.sin(2 * math.pi * k / self.STEPS) * size
+      ct = math.cos(2 * math.pi * k / self.STEPS) * size
+      poly = tuple((p[0] * ct - p[1] * st, p[1] * ct + p[0] * st)
+                   for p in points)
+      xs, ys = zip(*poly)
+      self.polys.append(poly)
+      self.extents.append((min(xs), min(ys), max(xs), max(ys)))
+
+  def index(self, traj):
+    '''Gets the index of the heading nearest to `traj` (in radians).'''
+    return int(round(traj * self.STEPS / (2 * math.pi))) % self.STEPS
+
+
 class Ship(Positional):
-  '''This class is used for drawing, mainly.  Just pass it some points
-  and things, and it'll handle the rest!'''
-  def __init__(self, screen, color, points, pos=(0,0), traj=0, size=10):
-    '''Create a ship.
+  '''This class is used for drawing, mainly.  Just give a subclass some points
+  and things, and it'll handle the rest!
+
+  A nontrivial detail: the size is in pixels, but so are the points.  So if the
+  size is 5 but there's a point in the points list that's something like
+  "(40,80)", then the effect will be that the effectual size of the ship will
+  be sqrt(40**2+80**2) * 5 = 447.2, so beware.  It is recommended that you try
+  to keep the values in the points to <= 1.'''
+
+  __slots__ = ('pos', 'traj', 'rect', 'gps', 'heading')
+
+  color = (255,255,255)
+  '''The (R,G,B) color to draw.'''
 
-    A nontrivial detail: the size parameter is in pixels, but so are the points.
-    So if the size is 5 but there's a point in the points list that's something
-    like "(40,80)", then the effect will be that the effectual size of the ship
-    will be sqrt(40**2+80**2) * 5 = 447.2, so beware.  It is recommended that
-    you try to keep the values in the points argument to <= 1.
+  ps = ((1,0), (-1,-1), (-1,1))
+  '''Points consisting of the line-art.'''
+
+  size = 10
+  '''Size of the ship (what `ps` are scaled by).'''
+
+  speed = 2
+  '''Really more like the max speed.'''
+
+  geom = None
+  '''The `ShipGeometry` of `ps` at `size`, set on each class when its first
+  ship is made.'''
+
+  def __init__(self, pos=(0,0), traj=0):
+    '''Create a ship.
 
     Args:
-      screen, pygame.Surface: The screen to draw on.
-      color, (int,int,int): The (R,G,B) color to draw.
-      points, [int]: Points consisting of the line-art
       pos, (int,int): Initial (X,Y) position of the ship
       traj, (int,int): Initial (X,Y) trajectory (0 radians is to the left, 0.5pi
                        is down)
-      size, (int,int): Size (w,h) of the ship.
     '''
-    self.screen = screen
-    self.color = color
-    self.ps = points
+    cls = type(self)
+    if 'geom' not in cls.__dict__:
+      cls.geom = ShipGeometry.get(cls.ps, cls.size)
     self.pos = list(pos)
     self.traj = traj
-    self.size = size
-    self.speed = 2  # really more like the max speed
 
-    # `rect ensures the `bbox` for this is calculated at most once per tick.
+    # `rect ensures the `bbox` (and the points in `gps`) for this are
+    # calculated at most once per tick.
     self.rect = None   # i.e., not up-to-date
+    self.gps = None
+    self.heading = 0
 
   def move_forward(self, amt=1.0):
     '''Moves forward relative to this ship's trajectory, `self.traj`.
@@ -164,7 +1078,7 @@ class Ship(Positional):
     '''
     assert amt >= 0 and amt <= 1, "amt out of range: %d" % amt
     self.rect = None
-    speed = self.speed * amt
+    speed = self.speed * amt * SimClock.get_clock().scale
     self.pos[0] += math.cos(self.traj) * speed
     self.pos[1] += math.sin(self.traj) * speed
 
@@ -176,28 +1090,59 @@ class Ship(Positional):
     while self.traj < 0:
       self.traj += 2 * math.pi
 
+  def _place(self):
+    '''Translates the cached, rotated shape for the current heading to the
+    current position, setting both `self.gps` and `self.rect`.'''
+    k = self.heading = self.geom.index(self.traj)
+    x, y = self.pos[0], self.pos[1]
+    self.gps = [(x + dx, y + dy) for dx, dy in self.geom.polys[k]]
+    l, t, r, b = self.geom.extents[k]
+    l, t = int(x + l), int(y + t)
+    self.rect = pygame.Rect(l, t, int(x + r) - l, int(y + b) - t)
+
   def _calc_global_ps(self):
-    st = math.sin(self.traj) * self.size
-    ct = math.cos(self.traj) * self.size
-    return [(self.pos[0] + p[0] * ct - p[1] * st,
-             self.pos[1] + p[1] * ct + p[0] * st)
-            for p in self.ps]
+    if self.rect is None:
+      self._place()
+    return self.gps
 
   def _build_rect(self):
     if self.rect is None:
-      ps = self._calc_global_ps()
-      self.rect = pygame.Rect(ps[0], (0, 0))
-      for p in ps[1:]:
-        self.rect.union_ip(pygame.Rect(p, (0, 0)))
+      self._place()
     return self.rect
 
   def center(self):
     return self._build_rect().center
 
-  def draw(self):
-    pygame.gfxdraw.filled_polygon(self.screen,
-            self._calc_global_ps(), self.color + (80,))
-    pygame.draw.lines(self.screen, self.color, True, self._calc_global_ps())
+  @classmethod
+  def _render(cls, heading):
+    '''Renders this class\'s shape at `heading` as a sprite.'''
+    l, t, r, b = cls.geom.extents[heading]
+    ox, oy = int(math.floor(l)) - 1, int(math.floor(t)) - 1
+    surf = SpriteCache.surface(int(math.ceil(r)) - ox + 2,
+                               int(math.ceil(b)) - oy + 2)
+    ps = [(dx - ox, dy - oy) for dx, dy in cls.geom.polys[heading]]
+    if cls.translucent:
+      pygame.gfxdraw.filled_polygon(surf, ps, cls.color + (80,))
+    pygame.draw.lines(surf, cls.color, True, ps)
+    return surf, (ox, oy)
+
+  def look(self):
+    '''Gets what the ship looks like, for `draw_look`: its heading.'''
+    self._build_rect()
+    return self.heading
+
+  @classmethod
+  def draw_look(cls, screen, pos, heading):
+    '''Draws a ship of this class at `pos` that looks like `heading` (see
+    `look`).  This only reads constants of the class, so it can draw a
+    `RenderFrame` while the ship itself moves on.'''
+    return SpriteCache.get_cache().blit(screen, pos,
+        ('ship', cls.geom, cls.color, heading, cls.translucent),
+        lambda: cls._render(heading))
+
+  def draw(self, pos=None):
+    '''Draws the ship, at `pos` if given (else where it is).'''
+    return self.draw_look(self.screen, pos or self.pos, self.look())
 
   def collides(self, that):
     if isinstance(that, Ship) or isinstance(that, Upgrade):
@@ -215,12 +1160,20 @@ class Ship(Positional):
 class Player(Ship):
   '''This should be unique in that it's the only ship that can also fire guns
   and stuff.'''
-  def __init__(self, screen):
-    super(Player, self).__init__(screen, (200, 200, 255),
-                                 ((0, -1), (2, -1), (0, -2), (-2, -1),
-                                  (-2, 1), (0, 2), (2, 1), (0, 1)),
-                                 size = 5)
-    self.screen = screen
+
+  __slots__ = ('last_fire_time', 'fire_delay', 'exploding', 'expl_prog',
+               'gun', 'speed', 'score', 'shields', 'radius')
+
+  color = (200, 200, 255)
+  ps = ((0, -1), (2, -1), (0, -2), (-2, -1), (-2, 1), (0, 2), (2, 1), (0, 1))
+  size = 5
+
+  SHIELD_ALPHA_STEP = 8
+  '''The shield\'s pulsing opacity is rounded down to a multiple of this, so
+  that only a few shield sprites are ever rendered.'''
+
+  def __init__(self):
+    super(Player, self).__init__()
     self.reset()
     self.shields = 0
     self.radius = int(self.size * max([(i*i + j*j)**.5 for i,j in self.ps]))
@@ -230,38 +1183,70 @@ class Player(Ship):
     self.fire_delay = 100 # ms
     self.exploding = False
     self.expl_prog = 0
-    self.gun = Gun(self.screen, 0)
+    self.gun = Gun(0)
     self.speed = 4
     self.score = 0
 
   def okay_to_fire(self):
-    ticks = pygame.time.get_ticks()
+    ticks = SimClock.get_clock().now()
     if self.last_fire_time + self.fire_delay <= ticks:
       self.last_fire_time = ticks
       return True
     return False
 
-  def draw(self):
-    if self.exploding:
-      self.expl_prog += .5
-      pygame.draw.circle(self.screen, (255,0,0),
-          map(int, self.pos), int(self.expl_prog))
+  def look(self):
+    '''Gets what the player looks like, for `draw_look`: (heading,
+    exploding, expl_prog, shields, radius).'''
+    return (super(Player, self).look(), self.exploding, self.expl_prog,
+            self.shields, self.radius)
+
+  @classmethod
+  def draw_look(cls, screen, pos, look):
+    heading, exploding, expl_prog, shields, radius = look
+    if exploding:
+      return [ pygame.draw.circle(screen, (255,0,0),
+                   map(int, pos), int(expl_prog)) ]
     else:
-      Ship.draw(self)
-      if self.shields > 0:
+      rects = [ super(Player, cls).draw_look(screen, pos, heading) ]
+      if shields > 0:
         r = 255
-        g = min(128 * ((self.shields / self.radius) % 3), 255)
-        b = min(128 * ((self.shields / (3 * self.radius))), 255)
+        g = min(128 * ((shields / radius) % 3), 255)
+        b = min(128 * ((shields / (3 * radius))), 255)
         if b == 255: g = 255
-        freq = .5 + 1.5 * ((self.shields % self.radius) - 1) / self.radius
-        a = 40 * (1 + math.sin(time.time() * math.pi * 2 * freq))
-        pygame.gfxdraw.filled_circle(self.screen, int(self.pos[0]),
-                int(self.pos[1]), self.radius, (r,g,b,a))
-        pygame.draw.circle(self.screen, (r,g,b), map(int, self.pos),
-                                                self.radius, 1)
+        if cls.translucent:
+          freq = .5 + 1.5 * ((shields % radius) - 1) / radius
+          a = 40 * (1 + math.sin(time.time() * math.pi * 2 * freq))
+          a = int(a) / cls.SHIELD_ALPHA_STEP * cls.SHIELD_ALPHA_STEP
+        else:
+          a = 0
+        rects.append(SpriteCache.get_cache().blit(screen, pos,
+            ('shield', radius, (r,g,b), a),
+            lambda: cls._render_shield(radius, (r,g,b), a)))
+      return rects
+
+  def draw(self, pos=None):
+    return self.draw_look(self.screen, pos or self.pos, self.look())
+
+  @staticmethod
+  def _render_shield(radius, color, alpha):
+    '''Renders a shield bubble of `radius` in `color` with fill opacity
+    `alpha`.'''
+    surf = SpriteCache.surface(2 * radius + 1, 2 * radius + 1)
+    if alpha > 0:
+      pygame.gfxdraw.filled_circle(surf, radius, radius, radius,
+                                   color + (alpha,))
+    pygame.draw.circle(surf, color, (radius, radius), radius, 1)
+    return surf, (-radius, -radius)
+
+  def fire(self, traj, add, max_power=None):
+    '''Fires the gun along `traj`, if it is ready (see `Gun.fire`).
 
-  def fire(self, traj):
-    return self.okay_to_fire() and self.gun.fire(self.pos, traj) or ()
+    Returns:
+      int: The number of bullets fired.
+    '''
+    if not self.okay_to_fire():
+      return 0
+    return self.gun.fire(self.pos, traj, add, max_power)
 
   def hit(self):
     if self.shields <= 0:
@@ -273,8 +1258,8 @@ class Player(Ship):
     self.exploding = True
 
   @classmethod
-  def spawn_at(cls, screen, x, y):
-    ship = cls(screen)
+  def spawn_at(cls, x, y):
+    ship = cls()
     ship.pos = [x,y]
     return ship
 
@@ -287,19 +1272,40 @@ class Player(Ship):
 class Baddie(Ship):
   '''A basic "bad guy".  This doesn't actually do anything, it just sets
   up a ship in a "bad guy" kind of a way.'''
-  def __init__(self, screen, color, pos, traj, size, geom):
-    super(Baddie, self).__init__(screen, color, geom, size = size)
-    self.pos = list(pos)
-    self.traj = traj
-    self.speed = 1
-    self.score = 100
+
+  __slots__ = ()
+
+  speed = 1
+  score = 100
+  '''What the player scores for killing one.'''
+
+  def __init__(self, pos, traj):
+    super(Baddie, self).__init__(pos, traj)
 
   def upgrade(self):
     '''Returns a tuple of upgrades (baddie-specific), which may be empty.'''
     assert False, "Can't make instances of this class."
 
-  def tick(self):
-    '''Perform one frame of action.'''
+  def tick(self, max_power=None):
+    '''Perform one frame of action.
+
+    Returns:
+      [Bullet]: Any bullets fired.
+    '''
+    return self.tick_all([self], max_power)
+
+  @classmethod
+  def tick_all(cls, ships, max_power=None):
+    '''Performs one frame of action for a whole group of ships of this class
+    at once (see `AIStage`).
+
+    Args:
+      ships, [Baddie]: The ships, all of exactly this class.
+      max_power, int: If not None, the most power their guns fire with.
+
+    Returns:
+      [Bullet]: Any bullets fired.
+    '''
     assert False, "Can't make instances of this class."
 
   def _calc_upgrade(self, **kwargs):
@@ -312,17 +1318,20 @@ class Baddie(Ship):
     Args:
       kwargs: The names and changes of spawning specific classes.
     '''
-    return [eval("%s(self.screen, self.pos)" % k)
+    return [Pool.of(globals()[k]).acquire(self.pos)
             for k, v in kwargs.iteritems()
-            if random.randrange(v) < 1]
+            if RandomStreams.stream('upgrades').randrange(v) < 1]
 
 
 class Wiggler(Baddie):
   '''A random walker "bad guy".'''
-  def __init__(self, screen, pos, traj):
-    super(Wiggler, self).__init__(screen, (0,255,0), pos, traj, 5,
-            ((1,1), (1,-1), (-1,-1), (-1, 1)))
-    self.score = 200
+
+  __slots__ = ()
+
+  color = (0,255,0)
+  ps = ((1,1), (1,-1), (-1,-1), (-1, 1))
+  size = 5
+  score = 200
 
   def upgrade(self):
     '''Returns one or many upgrades based on probability.
@@ -334,31 +1343,37 @@ class Wiggler(Baddie):
                                               SpeedUpgrade=200,
                                               ShieldUpgrade=200)
 
-  def tick(self):
-    '''Perform one frame of action.'''
-    self.traj += random.randrange(-100,100,1) / 1000.
-    while self.traj > 2 * math.pi:
-      self.traj -= 2 * math.pi
-    while self.traj < 0:
-      self.traj += 2 * math.pi
-    self.move_forward(1)
+  @classmethod
+  def tick_all(cls, ships, max_power=None):
+    '''Random walk: turn each a little either way, then move forward.'''
+    traj = numpy.array([s.traj for s in ships], dtype=float)
+    # The turns add up like a random walk, so over any stretch of time they
+    # spread as far at any tick rate when scaled by the root of the step.
+    traj += RandomStreams.array_stream('ai').randint(-100, 100,
+        len(ships)) / 1000. * math.sqrt(SimClock.get_clock().scale)
+    move_forward_all(ships, traj % (2 * math.pi), cls.speed)
+    return ()
 
 
 class FastWiggler(Wiggler):
   '''Same as wiggler, but goes faster.'''
-  def __init__(self, screen, pos, traj):
-    super(FastWiggler, self).__init__(screen, pos, traj)
-    self.color = (255,127,127)
-    self.speed = 2
-    self.score = 400
+
+  __slots__ = ()
+
+  color = (255,127,127)
+  speed = 2
+  score = 400
 
 
 class Homer(Baddie):
   '''A fast "bad guy" that follows the player.'''
-  def __init__(self, screen, pos, traj):
-    super(Homer, self).__init__(screen, (255,0,255), pos, traj, 5,
-            ((2,0), (0,-1), (-2,0), (0,1)))
-    self.speed = 2
+
+  __slots__ = ()
+
+  color = (255,0,255)
+  ps = ((2,0), (0,-1), (-2,0), (0,1))
+  size = 5
+  speed = 2
 
   def upgrade(self):
     '''Returns one or many upgrades based on probability.
@@ -370,21 +1385,28 @@ class Homer(Baddie):
                                             SpeedUpgrade=100,
                                             ShieldUpgrade=200)
 
-  def tick(self):
-    '''Perform one frame of action.'''
-    dx = Main.get_main().player.pos[0] - self.pos[0]
-    dy = Main.get_main().player.pos[1] - self.pos[1]
-    self.traj = math.atan2(dy, dx)
-    self.move_forward()
+  @classmethod
+  def tick_all(cls, ships, max_power=None):
+    '''Turn each straight towards the player, then move forward.'''
+    px, py = Main.get_main().player.pos
+    xy = numpy.array([s.pos for s in ships])
+    move_forward_all(ships, numpy.arctan2(py - xy[:,1], px - xy[:,0]),
+                     cls.speed)
+    return ()
 
 class Shooter(Baddie):
+  __slots__ = ('gun', 'last_fired')
+
   FIRE_RATE = 4000
-  def __init__(self, screen, pos, traj):
-    super(Shooter, self).__init__(screen, (255,0,127), pos, traj, 5,
-            ((1,0), (-1,-1), (-1,1)))
-    self.speed = 2
-    self.score = 200
-    self.gun = Gun(screen, 0, 'bad')
+  color = (255,0,127)
+  ps = ((1,0), (-1,-1), (-1,1))
+  size = 5
+  speed = 2
+  score = 200
+
+  def __init__(self, pos, traj):
+    super(Shooter, self).__init__(pos, traj)
+    self.gun = Gun(0, 'bad')
     self.last_fired = 0
 
   def upgrade(self):
@@ -397,19 +1419,86 @@ class Shooter(Baddie):
                                               SpeedUpgrade=400,
                                               ShieldUpgrade=200)
 
-  def _fire(self):
-    self.last_fired = pygame.time.get_ticks()
-    return self.gun.fire(self.pos, self.traj)
+  def _fire(self, add, max_power=None):
+    self.last_fired = SimClock.get_clock().now()
+    return self.gun.fire(self.pos, self.traj, add, max_power)
 
   def okay_to_fire(self):
-    return self.last_fired + self.FIRE_RATE <= pygame.time.get_ticks()
+    return self.last_fired + self.FIRE_RATE <= SimClock.get_clock().now()
 
-  def tick(self):
-    if random.randrange(100) < 1:
-      self.traj = random.randrange(200) * math.pi / 100
-    self.move_forward()
-    if self.okay_to_fire():
-      return self._fire()
+  @classmethod
+  def tick_all(cls, ships, max_power=None):
+    '''Now and then turn to a random direction, move forward, and fire
+    whenever the gun is ready.'''
+    n = len(ships)
+    rng = RandomStreams.array_stream('ai')
+    # About one in 100 reference ticks.
+    turn = rng.randint(max(1, int(round(100 / SimClock.get_clock().scale))),
+                       size=n) < 1
+    turns = rng.randint(200, size=n) * math.pi / 100
+    traj = numpy.array([s.traj for s in ships], dtype=float)
+    move_forward_all(ships, numpy.where(turn, turns, traj), cls.speed)
+
+    last = numpy.array([s.last_fired for s in ships])
+    ready = numpy.flatnonzero(last + cls.FIRE_RATE <=
+                              SimClock.get_clock().now())
+    fired = []
+    for i in ready.tolist():
+      ships[i]._fire(fired.append, max_power)
+    return fired
+
+
+def move_forward_all(objs, traj, speed):
+  '''Vectorized `Ship#move_forward`: sets the trajectories of `objs` and
+  moves each of them forward along it.
+
+  Args:
+    objs, [Entity]: Entities with a `pos`, `traj` and `rect`.
+    traj, numpy.ndarray: Their new trajectories.
+    speed, float: How far to move them (in pixels per tick of
+                  `SimClock.REFERENCE_STEP`).
+  '''
+  speed *= SimClock.get_clock().scale
+  xy = numpy.array([o.pos for o in objs], dtype=float)
+  xy[:,0] += numpy.cos(traj) * speed
+  xy[:,1] += numpy.sin(traj) * speed
+  for o, t, p in zip(objs, traj.tolist(), xy.tolist()):
+    o.traj = t
+    o.pos = p
+    o.rect = None
+
+
+class AIStage(object):
+  '''Ticks entities a whole behavior at a time.  Entities are grouped by
+  class, and each group is advanced with a single (vectorized) call to its
+  class\'s `tick_all`, so the per-entity cost of a tick is a few array
+  elements rather than a method call and a handful of RNG and clock calls.'''
+
+  def __init__(self):
+    self.groups = {}  # class -> [entity], reused from tick to tick
+
+  def tick(self, entities, max_power=None):
+    '''Ticks every one of `entities`, capping the power of any guns they fire
+    at `max_power` (if not None).
+
+    Returns:
+      [Bullet]: Any bullets fired.
+    '''
+    groups = self.groups
+    for group in groups.itervalues():
+      del group[:]
+    for e in entities:
+      group = groups.get(type(e))
+      if group is None:
+        group = groups[type(e)] = []
+      group.append(e)
+    fired = []
+    # In a fixed order, so that the random streams are drawn from in the same
+    # order on every run.
+    for kind in sorted(groups, key=lambda k: k.__name__):
+      if groups[kind]:
+        fired.extend(kind.tick_all(groups[kind], max_power))
+    return fired
 
 
 
@@ -418,31 +1507,97 @@ class Shooter(Baddie):
 #                                Guns / Bullets                                #
 ################################################################################
 
-class Bullet(object):
-  def __init__(self, screen, pos, traj, side):
-    self.screen = screen
-    self.pos = list(pos)
-    self.traj = traj
+class Bullet(Entity):
+  '''A single bullet.  Until it is added to a `BulletStore` a bullet keeps its
+  own position and trajectory; afterwards it is only a thin view onto its row
+  in the store\'s arrays, so reading or writing `pos`/`traj` goes straight to
+  the store.'''
+
+  __slots__ = ('store', 'idx', '_pos', '_traj', 'side')
+
+  speed = 8
+  length = 10
+  color = 255,0,0
+
+  def __init__(self, pos, traj, side):
+    self.store = None  # The `BulletStore` this is a view into, if any.
+    self.idx = -1      # Row of this bullet in `self.store`.
+    self._pos = list(pos)
+    self._traj = traj
     self.side = side
-    self.speed = 8
-    self.length = 10
-    self.color = 255,0,0
+
+  @property
+  def pos(self):
+    if self.store is None:
+      return self._pos
+    return self.store.pos[self.idx]
+
+  @pos.setter
+  def pos(self, pos):
+    if self.store is None:
+      self._pos = list(pos)
+    else:
+      self.store.pos[self.idx] = pos
+
+  @property
+  def traj(self):
+    if self.store is None:
+      return self._traj
+    return float(self.store.traj[self.idx])
+
+  @traj.setter
+  def traj(self, traj):
+    if self.store is None:
+      self._traj = traj
+    else:
+      self.store.set_traj(self.idx, traj)
+
+  def footprint(self):
+    size = super(Bullet, self).footprint()
+    if self.store is not None:
+      size += self.store.row_size()
+    return size
 
   def collides(self, that):
-    return isinstance(that, Ship) and \
-        that._build_rect().collidepoint(self.pos)
+    if not isinstance(that, Ship):
+      return False
+    x1, y1 = self.pos
+    x0, y0 = self.store.prev[self.idx] if self.store is not None else (x1, y1)
+    return segment_enters_rect(x0, y0, x1, y1, that._build_rect()) is not None
 
   def _calc_shift(self):
-    return [ self.speed * math.cos(self.traj),
-             self.speed * math.sin(self.traj) ]
+    speed = self.speed * SimClock.get_clock().scale
+    return [ speed * math.cos(self.traj),
+             speed * math.sin(self.traj) ]
 
-  def _calc_tail_pos(self):
-    return [ self.pos[0] - self.length * math.cos(self.traj),
-             self.pos[1] - self.length * math.sin(self.traj) ]
+  def _calc_tail_pos(self, pos=None):
+    pos = self.pos if pos is None else pos
+    return [ pos[0] - self.length * math.cos(self.traj),
+             pos[1] - self.length * math.sin(self.traj) ]
 
-  def draw(self):
-    pygame.draw.line(self.screen, self.color,
-                     self.pos, self._calc_tail_pos(), 2)
+  def draw(self, pos=None):
+    '''Draws the bullet, with its head at `pos` if given.'''
+    pos = self.pos if pos is None else pos
+    return pygame.draw.line(self.screen, self.color,
+                            tuple(pos), self._calc_tail_pos(pos), 2)
+
+  @classmethod
+  def draw_all(cls, screen, heads, trajs):
+    '''Draws many bullets at once.
+
+    Args:
+      screen, pygame.Surface: Where to draw them.
+      heads, numpy.ndarray: The (N,2) positions of their heads.
+      trajs, numpy.ndarray: Their trajectories.
+
+    Returns:
+      [pygame.Rect]: The areas drawn on.
+    '''
+    tails = heads - cls.length * numpy.column_stack((numpy.cos(trajs),
+                                                      numpy.sin(trajs)))
+    line, color = pygame.draw.line, cls.color
+    return [line(screen, color, h, t, 2) for h, t in
+            zip(heads.tolist(), tails.tolist())]
 
   def tick(self):
     self.move_forward()
@@ -452,20 +1607,239 @@ class Bullet(object):
     self.pos[0] += shift[0]
     self.pos[1] += shift[1]
 
+
+class BulletStore(object):
+  '''Struct-of-arrays storage for every live bullet in a `CollisionSpace`.
+
+  Positions, trajectories, velocities and sides live in contiguous NumPy
+  arrays so that advancing, culling and binning all bullets is a handful of
+  vectorized operations per tick instead of a Python method call (and a
+  `math.cos`/`math.sin` pair) per bullet.  Rows are kept packed: removing a
+  bullet moves the last row into its place.  `Bullet` objects are kept as
+  views of their rows for drawing and for existing callers.'''
+
+  SIDES = {'good': 0, 'bad': 1}
+
+  def __init__(self, capacity=256):
+    '''Creates an empty store.
+
+    Args:
+      capacity, int: Initial number of rows to allocate.  The arrays double in
+                     size whenever they fill up.
+    '''
+    self.n = 0
+    self.views = []
+    self._alloc(capacity)
+
+  def _alloc(self, capacity):
+    pos = numpy.zeros((capacity, 2))
+    prev = numpy.zeros((capacity, 2))
+    vel = numpy.zeros((capacity, 2))
+    traj = numpy.zeros(capacity)
+    side = numpy.zeros(capacity, dtype=numpy.int8)
+    if self.n > 0:
+      pos[:self.n] = self.pos[:self.n]
+      prev[:self.n] = self.prev[:self.n]
+      vel[:self.n] = self.vel[:self.n]
+      traj[:self.n] = self.traj[:self.n]
+      side[:self.n] = self.side[:self.n]
+    self.pos, self.prev, self.vel = pos, prev, vel
+    self.traj, self.side = traj, side
+    self.capacity = capacity
+
+  def __len__(self):
+    return self.n
+
+  def __iter__(self):
+    return iter(list(self.views))
+
+  def row_size(self):
+    '''Gets the bytes one bullet takes up in the arrays (plus its slot in
+    `views`).'''
+    arrays = self.pos, self.prev, self.vel, self.traj, self.side
+    return (sum(a.itemsize * a[0].size for a in arrays) +
+            numpy.dtype(numpy.intp).itemsize)
+
+  def add(self, bullet):
+    '''Appends `bullet` to the store and turns it into a view of its row.
+
+    Args:
+      bullet, Bullet: A bullet that is not in any store yet.
+    '''
+    assert bullet.store is None, "Bullet already in a store."
+    if self.n == self.capacity:
+      self._alloc(2 * self.capacity)
+    i = self.n
+    self.pos[i] = self.prev[i] = bullet._pos
+    self.side[i] = self.SIDES[bullet.side]
+    self.n += 1
+    bullet.store, bullet.idx = self, i
+    self.views.append(bullet)
+    self.set_traj(i, bullet._traj)
+
+  def set_traj(self, i, traj):
+    '''Sets the trajectory of row `i` and recomputes its velocity.'''
+    speed = self.views[i].speed * SimClock.get_clock().scale
+    self.traj[i] = traj
+    self.vel[i] = speed * math.cos(traj), speed * math.sin(traj)
+
+  def _detach(self, bullet):
+    bullet._pos = self.pos[bullet.idx].tolist()
+    bullet._traj = float(self.traj[bullet.idx])
+    bullet.store, bullet.idx = None, -1
+
+  def remove(self, bullet):
+    '''Removes a single bullet by moving the last row into its place.'''
+    assert bullet.store is self, "Bullet not in this store."
+    self.remove_indices([bullet.idx])
+
+  def remove_indices(self, idxs):
+    '''Removes all the rows in `idxs` at once.  Surviving rows past the new
+    end of the arrays are moved into the holes, so this costs O(len(idxs)).
+
+    Args:
+      idxs, [int]: Row indices to remove (duplicates are allowed).
+    '''
+    if len(idxs) == 0:
+      return
+    dead = numpy.unique(numpy.asarray(idxs, dtype=numpy.intp))
+    k = self.n - len(dead)
+    holes = dead[dead < k]
+    movers = numpy.setdiff1d(numpy.arange(k, self.n), dead,
+                             assume_unique=True)
+    pool = Pool.of(Bullet)
+    for i in dead:
+      self._detach(self.views[i])
+      pool.release(self.views[i])
+    if len(holes) > 0:
+      self.pos[holes] = self.pos[movers]
+      self.prev[holes] = self.prev[movers]
+      self.vel[holes] = self.vel[movers]
+      self.traj[holes] = self.traj[movers]
+      self.side[holes] = self.side[movers]
+      for h, m in zip(holes.tolist(), movers.tolist()):
+        self.views[h] = self.views[m]
+        self.views[h].idx = h
+    del self.views[k:]
+    self.n = k
+
+  def load(self, pos, prev, traj, side):
+    '''Replaces every bullet with the ones in the given arrays (e.g. from a
+    `Snapshot`), copying them in bulk.
+
+    Args:
+      pos, prev, numpy.ndarray: (N,2) arrays of positions this and last tick.
+      traj, numpy.ndarray: The trajectories.
+      side, numpy.ndarray: The sides (values of `SIDES`).
+    '''
+    self.clear()
+    n = len(traj)
+    if n > self.capacity:
+      self._alloc(max(n, 2 * self.capacity))
+    self.pos[:n] = pos
+    self.prev[:n] = prev
+    self.traj[:n] = traj
+    self.side[:n] = side
+    speed = Bullet.speed * SimClock.get_clock().scale
+    self.vel[:n,0] = speed * numpy.cos(self.traj[:n])
+    self.vel[:n,1] = speed * numpy.sin(self.traj[:n])
+    names = dict((v, k) for k, v in self.SIDES.iteritems())
+    pool = Pool.of(Bullet)
+    for i, s in enumerate(self.side[:n].tolist()):
+      b = pool.acquire((0, 0), 0, names[s])
+      b.store, b.idx = self, i
+      self.views.append(b)
+    self.n = n
+
+  def clear(self):
+    '''Removes every bullet.'''
+    pool = Pool.of(Bullet)
+    for b in self.views:
+      self._detach(b)
+      pool.release(b)
+    self.views = []
+    self.n = 0
+
+  def advance(self):
+    '''Moves every bullet forward by one tick, remembering where it was in
+    `self.prev` so that collisions can be checked along the whole path.'''
+    self.prev[:self.n] = self.pos[:self.n]
+    self.pos[:self.n] += self.vel[:self.n]
+
+  def out_of_bounds(self, width, height):
+    '''Finds every bullet outside of the (0,0)-(`width`,`height`) box.
+
+    Returns:
+      [int]: Row indices of the bullets.
+    '''
+    pos = self.pos[:self.n]
+    oob = ((pos[:,0] < 0) | (pos[:,1] < 0) |
+           (pos[:,0] > width) | (pos[:,1] > height))
+    return numpy.flatnonzero(oob).tolist()
+
+  def cull(self, width, height):
+    '''Removes every bullet outside of the (0,0)-(`width`,`height`) box.'''
+    self.remove_indices(self.out_of_bounds(width, height))
+
+  def paths(self):
+    '''Gets the bounding box of each bullet\'s path this tick (from
+    `self.prev` to `self.pos`).
+
+    Returns:
+      (left, top, right, bottom): Arrays of the edges of the boxes.
+    '''
+    p0, p1 = self.prev[:self.n], self.pos[:self.n]
+    lo = numpy.minimum(p0, p1)
+    hi = numpy.maximum(p0, p1)
+    return lo[:,0], lo[:,1], hi[:,0], hi[:,1]
+
+  def hits(self, side, rect):
+    '''Finds the bullets of `side` whose paths this tick cross `rect`.
+
+    Args:
+      side, str: One of `Gun.SIDES`.
+      rect, pygame.Rect: The rectangle to test against.
+
+    Returns:
+      [int]: Row indices of the bullets that hit.
+    '''
+    hit = sweep_rect(self.prev[:self.n], self.pos[:self.n], rect) <= 1
+    return numpy.flatnonzero((self.side[:self.n] == self.SIDES[side]) &
+                             hit).tolist()
+
+  def draw(self, alpha=1.):
+    '''Draws every bullet `alpha` of the way from where it was last tick to
+    where it is.'''
+    p0, p1 = self.prev[:self.n], self.pos[:self.n]
+    heads = p1 if alpha >= 1 else p0 + alpha * (p1 - p0)
+    return Bullet.draw_all(Entity.screen, heads, self.traj[:self.n])
+
 class Gun(object):
+  __slots__ = ('power', 'side')
+
   SIDES = ('good', 'bad')
 
-  def __init__(self, screen, num_bullets, side = 'good'):
+  def __init__(self, num_bullets, side = 'good'):
     assert side in self.SIDES, 'Invalid side: %s' % side
-    self.screen = screen
     self.power = num_bullets
     self.side = side
 
-  def fire(self, pos, traj):
-    bullets = []
-    for i in xrange(-self.power, self.power + 1, 2):
-      bullets.append(Bullet(self.screen, pos, traj + i / 50., self.side))
-    return bullets
+  def fire(self, pos, traj, add, max_power=None):
+    '''Fires a volley of `self.power` + 1 bullets (from the `Bullet` pool)
+    fanned out around `traj`, handing each to `add` (e.g.
+    `CollisionSpace.add`).  The power is capped at `max_power`, if given
+    (see `CollisionSpace.max_power`).
+
+    Returns:
+      int: The number of bullets fired.
+    '''
+    pool = Pool.of(Bullet)
+    power = self.power
+    if max_power is not None and power > max_power:
+      power = max_power
+    for i in xrange(-power, power + 1, 2):
+      add(pool.acquire(pos, traj + i / 50., self.side))
+    return power + 1
 
 
 
@@ -474,6 +1848,11 @@ class Gun(object):
 ################################################################################
 
 class SpawnPoint(object):
+  SPAWN_CHANCE = 20
+  '''The chance (in %) each tick (of `SimClock.REFERENCE_STEP`) that a spawn
+  point with baddies queued spawns one, at full quality (see
+  `QualityLadder`).'''
+
   def __init__(self, screen, size, x, y, baddies_array):
     self.screen = screen
     self.pos = [x,y]
@@ -481,6 +1860,7 @@ class SpawnPoint(object):
     self.traj = math.atan2(size[0] / 2 - y, size[1] / 2 - x)
     self.queue = []
     self.paused = False
+    self.spawn_chance = self.SPAWN_CHANCE  # The chance in use.
 
   def pause(self):
     self.paused = True
@@ -489,14 +1869,16 @@ class SpawnPoint(object):
     self.paused = False
 
   def spawn(self, baddie_type = Wiggler):
-    self.baddies.append(baddie_type(self.screen, self.pos, self.traj))
+    self.baddies.append(Pool.of(baddie_type).acquire(self.pos, self.traj))
 
   def queue_spawn(self, baddie_type):
     self.queue.append(baddie_type)
 
   def tick(self):
     if self.paused: return
-    if len(self.queue) > 0 and random.randrange(100) < 20:
+    if len(self.queue) > 0 and \
+       RandomStreams.stream('spawn').randrange(100) < \
+           self.spawn_chance * SimClock.get_clock().scale:
       self.spawn(self.queue[0])
       del self.queue[0]
 
@@ -521,10 +1903,11 @@ class Level(object):
     self.screen = screen
     self.spawns = spawn_point_array
 
-    self.font = pygame.font.SysFont("courier", 30, bold = True)
     self.greeting = greeting
-    w,h = self.font.size(self.greeting)
-    self.greeting_pos = (size[0] - w) / 2, (size[1] - h) / 2
+    if screen is not None:
+      self.font = pygame.font.SysFont("courier", 30, bold = True)
+      w,h = self.font.size(self.greeting)
+      self.greeting_pos = (size[0] - w) / 2, (size[1] - h) / 2
 
     self.progression = progression
     self.prog_i = -1
@@ -534,18 +1917,19 @@ class Level(object):
     return self.prog_i >= 0
 
   def pause(self):
-    self.paused = pygame.time.get_ticks()
+    self.paused = True
+    self.pause_time = SimClock.get_clock().now()
     for sp in self.spawns: sp.pause()
 
   def resume(self):
     for sp in self.spawns: sp.resume()
-    self.start_time += pygame.time.get_ticks() - self.paused
+    self.start_time += SimClock.get_clock().now() - self.pause_time
     self.paused = False
 
   def start(self):
     self.paused = False
     self.prog_i = 0
-    self.start_time = pygame.time.get_ticks()
+    self.start_time = SimClock.get_clock().now()
 
   def _p(self):
     if self.prog_i < len(self.progression):
@@ -558,179 +1942,946 @@ class Level(object):
 
     # Check/spawn queue
     if self.prog_i < len(self.progression):
-      while self._p()[0] <= pygame.time.get_ticks() - self.start_time:
+      while self._p()[0] <= SimClock.get_clock().now() - self.start_time:
         for i in xrange(self._p()[3]):
           self.spawns[self._p()[1]].queue_spawn(self._p()[2])
         self.prog_i += 1
 
   def jump_to_next_wave(self):
     if self.prog_i != 0 and self.prog_i < len(self.progression):
-      self.start_time = pygame.time.get_ticks() - self._p()[0]
+      self.start_time = SimClock.get_clock().now() - self._p()[0]
     self.tick()
 
+  def look(self):
+    '''Gets the text the level shows: its greeting as it starts, else
+    None.'''
+    return self.greeting if self.prog_i == 0 else None
+
   def draw(self):
-    if self.prog_i == 0:
-      self.screen.blit(self.font.render(self.greeting, False,
-              (255,255,255)), self.greeting_pos)
+    if self.look() is not None:
+      return TextCache.get_cache().draw(self.screen, self.font,
+                                        self.greeting, self.greeting_pos)
 
   def done(self):
     return self.prog_i >= len(self.progression)
 
 
 
-################################################################################
-#                                  User Input                                  #
-################################################################################
+################################################################################
+#                                  User Input                                  #
+################################################################################
+
+class Input(object):
+  def __init__(self, player, space, devices=True):
+    '''
+
+    Args:
+      player, Player: The player.
+      space, CollisionSpace: The space where collisions are computed..
+      devices, bool: Whether to read the keyboard and joystick at all.  If not,
+                     `tick` does nothing.
+    '''
+    self.player = player
+    self.space = space
+    self.devices = devices
+    self.axes = None  # (move X, move Y, fire X, fire Y), or None for no input
+    if not devices:
+      self.js = None
+    elif pygame.joystick.get_count() > 0:
+      self.js = pygame.joystick.Joystick(0)
+      self.js.init()
+      if self.js.get_numaxes() < 4:
+        self.js.quit()
+        self.js = None
+        logger.wrn("Could joystick does not have at least 4 axes. (%d)" %
+            self.js.get_numaxes())
+        return
+      print 'using %d axes' % self.js.get_numaxes()
+    else:
+      self.js = None
+
+  def poll(self):
+    '''Reads the keyboard or joystick (for `Main.feed` to hand to `tick`).
+
+    Returns:
+      (float,float,float,float): The movement and firing axes (each in
+                                 [-1,1]), or None if there are no devices.
+    '''
+    if not self.devices: return None
+    keys = pygame.key.get_pressed() if self.js is None else None
+    return (self._get_mx(keys), self._get_my(keys),
+            self._get_fx(keys), self._get_fy(keys))
+
+  def tick(self):
+    '''Do one tick; acts on the axes last fed (see `Main.feed`).'''
+    if self.axes is None: return
+    js_dx, js_dy, js_fx, js_fy = self.axes
+    self.player.traj = math.atan2(js_dy, js_dx)
+    self.player.rect = None
+    if abs(js_dx) > 0.1 or abs(js_dy) > 0.1:
+      amt = math.sqrt(js_dx * js_dx + js_dy * js_dy)
+      self.player.move_forward(1.0 if amt > 1 else -1.0 if amt < -1 else amt)
+
+    if abs(js_fx) > 0.1 or abs(js_fy) > 0.1:
+      self.player.fire(math.atan2(js_fy, js_fx), self.space.add,
+                       self.space.max_power)
+
+  def _get_mx(self, keys):
+    '''Gets movement in the X direction (in [-1,1] for [left,right]).
+
+    Args:
+      keys, [bool]: Array of key states.
+    '''
+    if self.js is None:
+      return 1.0 if keys[pygame.K_f] else -1.0 if keys[pygame.K_s] else 0.0
+    return self.js.get_axis(0)
+
+  def _get_my(self, keys):
+    '''Gets movement in the Y direction (in [-1,1] for [top,bottom]).
+
+    Args:
+      keys, [bool]: Array of key states.
+    '''
+    if self.js is None:
+      return 1.0 if keys[pygame.K_d] else -1.0 if keys[pygame.K_e] else 0.0
+    return self.js.get_axis(1)
+
+  def _get_fx(self, keys):
+    '''Gets fire direction in X (in [-1,1] for [left,right]).
+
+    Args:
+      keys, [bool]: Array of key states.
+    '''
+    if self.js is None:
+      return 1.0 if keys[pygame.K_l] else -1.0 if keys[pygame.K_j] else 0.0
+    return self.js.get_axis(3)
+
+  def _get_fy(self, keys):
+    '''Gets fire direction in Y (in [-1,1] for [top,bottom]).
+
+    Args:
+      keys, [bool]: Array of key states.
+    '''
+    if self.js is None:
+      return 1.0 if keys[pygame.K_k] else -1.0 if keys[pygame.K_i] else 0.0
+    return self.js.get_axis(2)
+
+
+
+class InputLog(object):
+  '''A compact binary recording of a game: the seed, the settings that
+  affect the simulation, and for every tick (and every frame while paused)
+  the `Input` axes and the special actions (see `Main.ACTIONS`).  Replaying
+  it plays the same game again, tick for tick.
+
+  The format is (all little-endian): the header "LBIL", a uint16 version, an
+  int64 seed and a uint32 length followed by that many bytes of JSON
+  settings; then, per frame, the four axes as int8 (scaled by 127; -128 means
+  "no input"), a uint8 count of actions and that many uint8 action codes.'''
+
+  MAGIC = 'LBIL'
+  VERSION = 2
+  HEADER = struct.Struct('<4sHqI')
+  FRAME = struct.Struct('<4bB')
+  NONE = -128
+
+  SETTINGS = ('size', 'tick_rate', 'seed', 'broadphase')
+  '''The `parse_args` options a replay takes from the log.'''
+
+  @classmethod
+  def record(cls, path, seed, settings):
+    '''Starts recording to the file `path`.
+
+    Args:
+      path, str: The file to write.
+      seed, int: The seed of the random streams.
+      settings, {str: ...}: The options to record (see `SETTINGS`).
+
+    Returns:
+      InputLog: The log to `write` frames to.
+    '''
+    log = cls(seed, settings)
+    log.file = open(path, 'wb')
+    text = json.dumps(settings, sort_keys=True)
+    log.file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, seed, len(text)))
+    log.file.write(text)
+    return log
+
+  @classmethod
+  def load(cls, path):
+    '''Reads the whole log in the file `path`.
+
+    Returns:
+      InputLog: The log, to read `frames` from.
+
+    Throws:
+      ValueError: If the file is not an input log this version can read.
+    '''
+    with open(path, 'rb') as f:
+      data = f.read()
+    if len(data) < cls.HEADER.size:
+      raise ValueError('Not an input log: %s' % path)
+    magic, version, seed, n = cls.HEADER.unpack_from(data)
+    if magic != cls.MAGIC or version != cls.VERSION:
+      raise ValueError('Not a version %d input log: %s' % (cls.VERSION, path))
+    start = cls.HEADER.size + n
+    log = cls(seed, json.loads(data[cls.HEADER.size:start]))
+    log.data = data
+    log.start = start
+    return log
+
+  def __init__(self, seed, settings):
+    self.seed = seed
+    self.settings = settings
+    self.file = None
+    self.data = None
+
+  @classmethod
+  def pack(cls, axes, actions):
+    '''Encodes one frame, as the log stores it (and as `server.py` sends it).
+
+    Args:
+      axes, (float,float,float,float): The input axes (or None).
+      actions, [int]: The codes of the actions taken this frame.
+
+    Returns:
+      (str, (float,float,float,float)): The bytes, and `axes` as they will be
+                                        decoded (8 bits of each are kept).
+    '''
+    if axes is None:
+      q = (cls.NONE,) * 4
+    else:
+      q = tuple(int(round(max(-1., min(1., a)) * 127)) for a in axes)
+    data = cls.FRAME.pack(*(q + (len(actions),)))
+    if actions:
+      data += struct.pack('%dB' % len(actions), *actions)
+    return data, None if axes is None else tuple(v / 127. for v in q)
+
+  @classmethod
+  def unpack_from(cls, data, off=0):
+    '''Decodes the frame at `off` in `data` (see `pack`).
+
+    Returns:
+      (axes, actions, int): The frame, and the offset just past it.
+
+    Throws:
+      struct.error: If `data` ends before the frame does.
+    '''
+    a0, a1, a2, a3, n = cls.FRAME.unpack_from(data, off)
+    off += cls.FRAME.size
+    actions = struct.unpack_from('%dB' % n, data, off)
+    off += n
+    if a0 == cls.NONE:
+      return None, actions, off
+    return (a0 / 127., a1 / 127., a2 / 127., a3 / 127.), actions, off
+
+  def write(self, axes, actions):
+    '''Records one frame.
+
+    Args:
+      axes, (float,float,float,float): The input axes (or None).
+      actions, [int]: The codes of the actions taken this frame.
+
+    Returns:
+      (float,float,float,float): `axes` as they will be replayed (the log
+                                 keeps 8 bits of each).
+    '''
+    data, axes = self.pack(axes, actions)
+    self.file.write(data)
+    return axes
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  def frames(self):
+    '''Replays the frames.
+
+    Returns:
+      generator: Of (axes, actions) for every frame, as `write` got them.
+    '''
+    data, off = self.data, self.start
+    while off < len(data):
+      axes, actions, off = self.unpack_from(data, off)
+      yield axes, actions
+
+
+
+################################################################################
+#                             Collision Detection                              #
+################################################################################
+
+def segment_enters_rect(x0, y0, x1, y1, rect):
+  '''Finds where the segment from (`x0`,`y0`) to (`x1`,`y1`) first enters
+  `rect`, by clipping it against the rect\'s slabs (Liang-Barsky).
+
+  Returns:
+    float: How far along the segment (0 to 1) it enters, or None if it misses.
+  '''
+  t0, t1 = 0., 1.
+  for p, d, lo, hi in ((x0, x1 - x0, rect.left, rect.right),
+                       (y0, y1 - y0, rect.top, rect.bottom)):
+    if d == 0:
+      if p < lo or p >= hi:
+        return None
+      continue
+    a = (lo - p) / float(d)
+    b = (hi - p) / float(d)
+    if a > b: a, b = b, a
+    if a > t0: t0 = a
+    if b < t1: t1 = b
+    if t0 > t1:
+      return None
+  return t0
+
+
+def sweep_rect(p0, p1, rect):
+  '''Vectorized `segment_enters_rect` for many segments against one rect.
+
+  Args:
+    p0, numpy.ndarray: (N,2) array of the start points.
+    p1, numpy.ndarray: (N,2) array of the end points.
+    rect, pygame.Rect: The rectangle.
+
+  Returns:
+    numpy.ndarray: How far along each segment it enters `rect`, or infinity
+                   where it misses.
+  '''
+  lo = numpy.array([rect.left, rect.top], dtype=float)
+  hi = numpy.array([rect.right, rect.bottom], dtype=float)
+  d = p1 - p0
+  still = d == 0
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    a = (lo - p0) / d
+    b = (hi - p0) / d
+  inside = (p0 >= lo) & (p0 < hi)
+  a = numpy.where(still, numpy.where(inside, -numpy.inf, numpy.inf), a)
+  b = numpy.where(still, numpy.inf, b)
+  enter = numpy.maximum(numpy.minimum(a, b).max(axis=1), 0)
+  leave = numpy.minimum(numpy.maximum(a, b).min(axis=1), 1)
+  return numpy.where(enter <= leave, enter, numpy.inf)
+
+
+class Broadphase(object):
+  '''The interface `CollisionSpace` uses to find which baddies and upgrades
+  are near a point or box, before testing them exactly.  Engines implement:
+
+    update(obj)       Adds `obj`, or takes note that it has moved.  Entities
+                      are handed to it every tick after they move.
+    remove(obj)       Removes `obj`, if it is in here.
+    clear()           Removes every entity.
+    query(x, y)       Gets the buckets of entities that may touch the point
+                      (`x`,`y`).
+    query_boxes(left, top, right, bottom)
+                      Vectorized `query` for many boxes at once: takes the
+                      edges of the boxes as numpy.ndarrays and returns a list
+                      of buckets, one per box.
+
+  Queries return "buckets": sequences of lists of entities, which together
+  hold (at least) every entity that may touch the query.  They may also hold
+  entities removed since the last `update`.'''
+
+
+class SpatialHash(Broadphase):
+  '''A persistent uniform grid of bins.  Entities stay in their bin from one
+  tick to the next and are only moved to another bin when the bin their
+  position falls in changes, so keeping the grid up to date costs
+  O(moved entities) instead of rebuilding every bin every tick.
+
+  Each bin is split into 3x3 buffer zones: the middle, and the `bufsize` wide
+  strips along its edges and corners that overlap the neighboring bins.  The
+  list of bins to search for every (bin, zone) pair is computed up front.'''
+
+  def __init__(self, size, binsize, bufsize):
+    '''Creates an empty grid.
+
+    Args:
+      size, (int,int): The width and height of the space (in pixels).
+      binsize, int: 1-D size of each bin (in pixels).
+      bufsize, float: 1-D percentage of overlapping space.
+    '''
+    self.size = self.width,self.height = size
+    self.cols = max(1, size[0] / binsize)
+    self.rows = max(1, size[1] / binsize)
+    self.bufsize = bufsize
+    self.sx = float(self.cols) / size[0]
+    self.sy = float(self.rows) / size[1]
+    self.cells = [[] for c in xrange(self.cols * self.rows)]
+    self.where = {}   # entity -> (bin, index in bin)
+    self.neighbors = [self._calc_neighbors(c)
+                      for c in xrange(len(self.cells))]
+
+  def _calc_neighbors(self, c):
+    '''Computes the bins to search for each buffer zone of bin `c`.
+
+    Returns:
+      [(list,)]: For each zone, a tuple of the bins (lists) that overlap it.
+    '''
+    i, j = divmod(c, self.rows)
+    zones = []
+    for di in (-1, 0, 1):
+      if not 0 <= i + di < self.cols: di = 0
+      for dj in (-1, 0, 1):
+        if not 0 <= j + dj < self.rows: dj = 0
+        idxs = [(i, j)]
+        if di: idxs.append((i+di, j))
+        if dj: idxs.append((i, j+dj))
+        if di and dj: idxs.append((i+di, j+dj))
+        zones.append(tuple(self.cells[a * self.rows + b] for a, b in idxs))
+    return zones
+
+  def locate1(self, x, y):
+    '''Finds the bin and buffer zone of the point (`x`,`y`).
+
+    Returns:
+      (int,int): The bin and the buffer zone (an index into
+                 `self.neighbors[bin]`).
+    '''
+    fi = x * self.sx
+    fj = y * self.sy
+    i = min(max(int(fi), 0), self.cols - 1)
+    j = min(max(int(fj), 0), self.rows - 1)
+    fi -= i
+    fj -= j
+    return (i * self.rows + j,
+            3 * (1 + (fi > 1 - self.bufsize) - (fi < self.bufsize)) +
+            (1 + (fj > 1 - self.bufsize) - (fj < self.bufsize)))
+
+  def locate(self, xs, ys):
+    '''Vectorized `locate1` for arrays of points.
+
+    Args:
+      xs, numpy.ndarray: The X coordinates of the points.
+      ys, numpy.ndarray: The Y coordinates of the points.
 
-class Input(object):
-  def __init__(self, player, space):
+    Returns:
+      (numpy.ndarray,numpy.ndarray): The bins and buffer zones of the points.
     '''
+    fi = xs * self.sx
+    fj = ys * self.sy
+    i = numpy.clip(fi.astype(numpy.intp), 0, self.cols - 1)
+    j = numpy.clip(fj.astype(numpy.intp), 0, self.rows - 1)
+    fi -= i
+    fj -= j
+    zi = 1 + (fi > 1 - self.bufsize).astype(numpy.intp) - (fi < self.bufsize)
+    zj = 1 + (fj > 1 - self.bufsize).astype(numpy.intp) - (fj < self.bufsize)
+    return i * self.rows + j, 3 * zi + zj
+
+  def cover(self, left, top, right, bottom):
+    '''Vectorized: finds the ranges of bins to search for entities touching
+    each box (e.g. the bounding box of a bullet\'s path).  Like the buffer
+    zones, the ranges reach `bufsize` into the neighboring bins.
 
     Args:
-      player, Player: The player.
-      space, CollisionSpace: The space where collisions are computed..
+      left, top, right, bottom, numpy.ndarray: The edges of the boxes.
+
+    Returns:
+      (i0, i1, j0, j1): Arrays of the first and last columns and rows (both
+                        inclusive) of bins to search for each box.
     '''
-    self.player = player
-    self.space = space
-    if pygame.joystick.get_count() > 0:
-      self.js = pygame.joystick.Joystick(0)
-      self.js.init()
-      if self.js.get_numaxes() < 4:
-        self.js.quit()
-        self.js = None
-        logger.wrn("Could joystick does not have at least 4 axes. (%d)" %
-            self.js.get_numaxes())
-        return
-      print 'using %d axes' % self.js.get_numaxes()
-    else:
-      self.js = None
+    b = self.bufsize
+    last_i, last_j = self.cols - 1, self.rows - 1
+    return (numpy.clip((left * self.sx - b).astype(numpy.intp), 0, last_i),
+            numpy.clip((right * self.sx + b).astype(numpy.intp), 0, last_i),
+            numpy.clip((top * self.sy - b).astype(numpy.intp), 0, last_j),
+            numpy.clip((bottom * self.sy + b).astype(numpy.intp), 0, last_j))
 
-  def tick(self):
-    '''Do one tick; handles input.'''
-    keys = pygame.key.get_pressed() if self.js is None else None
+  def query(self, x, y):
+    '''Gets the bins that may hold entities touching the point (`x`,`y`).
 
-    js_dx = self._get_mx(keys)
-    js_dy = self._get_my(keys)
-    self.player.traj = math.atan2(js_dy, js_dx)
-    if abs(js_dx) > 0.1 or abs(js_dy) > 0.1:
-      amt = math.sqrt(js_dx * js_dx + js_dy * js_dy)
-      self.player.move_forward(1.0 if amt > 1 else -1.0 if amt < -1 else amt)
+    Returns:
+      (list,): The bins (lists of entities) to search.
+    '''
+    c, z = self.locate1(x, y)
+    return self.neighbors[c][z]
+
+  def query_boxes(self, left, top, right, bottom):
+    i0, i1, j0, j1 = [a.tolist() for a in self.cover(left, top, right, bottom)]
+    cells, rows = self.cells, self.rows
+    return [[cells[c] for i in xrange(i0[k], i1[k] + 1)
+                      for c in xrange(i * rows + j0[k], i * rows + j1[k] + 1)]
+            for k in xrange(len(i0))]
+
+  def _insert(self, obj, c):
+    self.where[obj] = c, len(self.cells[c])
+    self.cells[c].append(obj)
+
+  def remove(self, obj):
+    '''Removes `obj` from its bin, if it is in one.  The last entity in the
+    bin takes its place.'''
+    if obj not in self.where:
+      return
+    c, k = self.where.pop(obj)
+    cell = self.cells[c]
+    last = cell.pop()
+    if last is not obj:
+      cell[k] = last
+      self.where[last] = c, k
+
+  def update(self, obj):
+    '''Puts `obj` in the bin its position falls in, moving it there only if
+    it is not already in it.'''
+    c = self.locate1(obj.pos[0], obj.pos[1])[0]
+    w = self.where.get(obj)
+    if w is None:
+      self._insert(obj, c)
+    elif w[0] != c:
+      self.remove(obj)
+      self._insert(obj, c)
 
-    js_fx = self._get_fx(keys)
-    js_fy = self._get_fy(keys)
-    if abs(js_fx) > 0.1 or abs(js_fy) > 0.1:
-      for b in self.player.fire(math.atan2(js_fy, js_fx)):
-        self.space.add(b)
+  def clear(self):
+    '''Removes every entity from the grid.'''
+    for cell in self.cells: del cell[:]
+    self.where.clear()
 
-  def _get_mx(self, keys):
-    '''Gets movement in the X direction (in [-1,1] for [left,right]).
+
+class SweepAndPrune(Broadphase):
+  '''Sort-and-sweep on the X axis.  Entities are kept in a list sorted by
+  the left edges of their rects; a query finds the run of entities whose
+  X extent overlaps it by bisecting on the left edges.  Unlike a grid this
+  does not care how entities are spread out, so it copes with clusters
+  (like a whole wave coming out of one spawn point).
+
+  Entities barely move from one tick to the next, so the list is nearly
+  sorted already and is re-sorted with an insertion sort, which is close to
+  O(n) in that case.  The sort happens lazily, before the first query after
+  any entity moved.'''
+
+  def __init__(self, size):
+    '''Creates an empty index.
 
     Args:
-      keys, [bool]: Array of key states.
+      size, (int,int): The width and height of the space (in pixels).
     '''
-    if self.js is None:
-      return 1.0 if keys[pygame.K_f] else -1.0 if keys[pygame.K_s] else 0.0
-    return self.js.get_axis(0)
+    self.size = self.width,self.height = size
+    self.entities = []  # Sorted by left edge, as of the last sort.
+    self.lefts = []     # The left edges of `self.entities`, as sorted.
+    self.extents = {}   # entity -> (left, right), as of its last update
+    self.removed = set()  # Removed, but still in `entities` until a sort.
+    self.widest = 0     # The widest X extent seen.
+    self.stale = False  # Whether anything moved since the last sort.
+
+  def update(self, obj):
+    rect = obj._build_rect()
+    if obj in self.removed:
+      self.removed.discard(obj)
+    elif obj not in self.extents:
+      self.entities.append(obj)
+      self.lefts.append(rect.left)
+    self.extents[obj] = rect.left, rect.right
+    if rect.width > self.widest:
+      self.widest = rect.width
+    self.stale = True
+
+  def remove(self, obj):
+    # Dropped from `entities` by the next sort.
+    if self.extents.pop(obj, None) is not None:
+      self.removed.add(obj)
 
-  def _get_my(self, keys):
-    '''Gets movement in the Y direction (in [-1,1] for [top,bottom]).
+  def clear(self):
+    del self.entities[:]
+    del self.lefts[:]
+    self.extents.clear()
+    self.removed.clear()
+    self.widest = 0
+    self.stale = False
+
+  def _sort(self):
+    '''Insertion sorts the entities by their current left edges.'''
+    extents = self.extents
+    if self.removed:
+      self.entities = [e for e in self.entities if e in extents]
+      self.removed.clear()
+    ents = self.entities
+    keys = self.lefts = [extents[e][0] for e in ents]
+    for i in xrange(1, len(keys)):
+      k = keys[i]
+      if keys[i-1] <= k:
+        continue
+      e = ents[i]
+      j = i - 1
+      while j >= 0 and keys[j] > k:
+        keys[j+1] = keys[j]
+        ents[j+1] = ents[j]
+        j -= 1
+      keys[j+1] = k
+      ents[j+1] = e
+    self.stale = False
+
+  def query(self, x, y):
+    if self.stale: self._sort()
+    # Like the grid's buffer zones, this also finds entities up to one
+    # entity-width away, which may touch whatever is at (x,y).
+    a = bisect.bisect_left(self.lefts, x - 2 * self.widest)
+    b = bisect.bisect_right(self.lefts, x + self.widest)
+    return (self.entities[a:b],)
+
+  def query_boxes(self, left, top, right, bottom):
+    if self.stale: self._sort()
+    lefts = numpy.asarray(self.lefts)
+    a = numpy.searchsorted(lefts, left - self.widest, 'left').tolist()
+    b = numpy.searchsorted(lefts, right, 'right').tolist()
+    ents = self.entities
+    return [(ents[a[k]:b[k]],) for k in xrange(len(a))]
+
+
+class EntityRegistry(object):
+  '''Packed storage for the baddies and upgrades of a `CollisionSpace`, with
+  O(1) adds, lookups and removals.
+
+  Every entity gets a handle that keeps referring to it, whatever happens to
+  the others, until it is removed.  Removing an entity only leaves a hole (a
+  None) in `items`, so indices into it stay put while a tick is still looping
+  over it; `compact` fills the holes with the last entities at the end of the
+  tick.  Holes are never counted, iterated or `in` the registry.'''
+
+  def __init__(self):
+    self.items = []      # The entities, and None for removed ones.
+    self.handles = []    # The handle of each of `items`.
+    self.index = {}      # entity -> index in `items`
+    self.by_handle = {}  # handle -> entity
+    self.holes = []      # Indices of the removed entities, until compacted.
+    self.next_handle = 0
+
+  def __len__(self):
+    return len(self.items) - len(self.holes)
+
+  def __iter__(self):
+    if not self.holes:
+      return iter(self.items)
+    return (e for e in self.items if e is not None)
+
+  def __contains__(self, obj):
+    return obj in self.index
 
-    Args:
-      keys, [bool]: Array of key states.
+  def add(self, obj):
+    '''Adds `obj`.
+
+    Returns:
+      int: The handle of `obj`.
     '''
-    if self.js is None:
-      return 1.0 if keys[pygame.K_d] else -1.0 if keys[pygame.K_e] else 0.0
-    return self.js.get_axis(1)
+    handle = self.next_handle
+    self.next_handle += 1
+    self.index[obj] = len(self.items)
+    self.items.append(obj)
+    self.handles.append(handle)
+    self.by_handle[handle] = obj
+    return handle
+
+  append = add
+
+  def get(self, handle):
+    '''Gets the entity with `handle`, or None if it has been removed.'''
+    return self.by_handle.get(handle)
+
+  def handle(self, obj):
+    '''Gets the handle of `obj` (which must be in the registry).'''
+    return self.handles[self.index[obj]]
+
+  def remove(self, obj):
+    '''Removes `obj`, leaving a hole until the next `compact`.'''
+    i = self.index.pop(obj)
+    del self.by_handle[self.handles[i]]
+    self.items[i] = None
+    self.holes.append(i)
+
+  def compact(self):
+    '''Fills every hole by moving the last entity into it.'''
+    if not self.holes:
+      return
+    items, handles, index = self.items, self.handles, self.index
+    # From the back, so that the last item is never itself a hole.
+    for i in sorted(self.holes, reverse=True):
+      obj = items.pop()
+      handle = handles.pop()
+      if i < len(items):
+        items[i] = obj
+        handles[i] = handle
+        index[obj] = i
+    del self.holes[:]
 
-  def _get_fx(self, keys):
-    '''Gets fire direction in X (in [-1,1] for [left,right]).
+  def clear(self):
+    '''Removes every entity.'''
+    del self.items[:]
+    del self.handles[:]
+    del self.holes[:]
+    self.index.clear()
+    self.by_handle.clear()
+
+
+class QuadNode(object):
+  '''A node of a `LooseQuadtree`.'''
+
+  __slots__ = ('x', 'y', 'w', 'h', 'depth', 'parent', 'children', 'items',
+               'count', 'loose')
+
+  def __init__(self, x, y, w, h, depth, parent):
+    '''Creates an empty leaf.
 
     Args:
-      keys, [bool]: Array of key states.
+      x, y, w, h, float: The (tight) bounds of the node.
+      depth, int: How deep in the tree it is (the root is 0).
+      parent, QuadNode: The parent node (None for the root).
     '''
-    if self.js is None:
-      return 1.0 if keys[pygame.K_l] else -1.0 if keys[pygame.K_j] else 0.0
-    return self.js.get_axis(3)
-
-  def _get_fy(self, keys):
-    '''Gets fire direction in Y (in [-1,1] for [top,bottom]).
+    self.x, self.y, self.w, self.h = x, y, w, h
+    self.depth = depth
+    self.parent = parent
+    self.children = None
+    self.items = []
+    self.count = 0  # Items in this node and all of its descendants.
+    # The loose bounds (left, top, right, bottom): half again as big as the
+    # tight bounds on every side.
+    self.loose = x - w / 2., y - h / 2., x + 1.5 * w, y + 1.5 * h
+
+  def fits(self, half):
+    '''Whether an entity `half` pixels from its center to its farthest edge
+    stays in the loose bounds when its center is in the tight bounds.'''
+    return 2 * half <= min(self.w, self.h)
+
+  def child(self, cx, cy):
+    '''Gets the child whose tight bounds hold the point (`cx`,`cy`).'''
+    return self.children[2 * (cx >= self.x + self.w / 2.) +
+                         (cy >= self.y + self.h / 2.)]
+
+  def holds(self, cx, cy):
+    '''Whether the point (`cx`,`cy`) is in the tight bounds.'''
+    return (self.x <= cx < self.x + self.w) and (self.y <= cy < self.y + self.h)
+
+
+class LooseQuadtree(Broadphase):
+  '''A loose quadtree.  Nodes only split where entities crowd together (so
+  a wave bunched up in one corner gets a deep subtree while open space stays
+  a few big leaves), and merge back once they thin out.
+
+  Each entity lives in the deepest node that holds its center and that its
+  rect fits in with the node\'s "loose" bounds, which are twice the size of
+  its tight bounds.  So an entity is never in more than one node, and moving
+  it only touches the tree when it leaves its node.'''
+
+  CAPACITY = 8
+  '''A leaf with more entities than this splits (a node whose subtree holds
+  half as many merges).'''
+
+  MAX_DEPTH = 6
+
+  def __init__(self, size, capacity=CAPACITY, max_depth=MAX_DEPTH):
+    '''Creates an empty tree.
 
     Args:
-      keys, [bool]: Array of key states.
+      size, (int,int): The width and height of the space (in pixels).
+      capacity, int: See `CAPACITY`.
+      max_depth, int: The deepest a node can be.
     '''
-    if self.js is None:
-      return 1.0 if keys[pygame.K_k] else -1.0 if keys[pygame.K_i] else 0.0
-    return self.js.get_axis(2)
+    self.size = self.width,self.height = size
+    self.capacity = capacity
+    self.max_depth = max_depth
+    self.root = QuadNode(0., 0., float(size[0]), float(size[1]), 0, None)
+    self.where = {}   # entity -> node
+    self.widest = 0   # Biggest half-size seen.
+
+  def _center(self, obj):
+    rect = obj._build_rect()
+    half = max(rect.width, rect.height) / 2.
+    if half > self.widest:
+      self.widest = half
+    # Keep the centers in the tree (entities are kept in bounds anyway).
+    cx = min(max(rect.centerx, 0), self.width - 1)
+    cy = min(max(rect.centery, 0), self.height - 1)
+    return cx, cy, half
+
+  def _insert(self, obj, cx, cy, half):
+    node = self.root
+    node.count += 1
+    while node.children is not None:
+      child = node.child(cx, cy)
+      if not child.fits(half):
+        break
+      node = child
+      node.count += 1
+    node.items.append(obj)
+    self.where[obj] = node
+    if (node.children is None and len(node.items) > self.capacity and
+        node.depth < self.max_depth):
+      self._split(node)
+
+  def _split(self, node):
+    w, h = node.w / 2., node.h / 2.
+    node.children = [QuadNode(node.x + i * w, node.y + j * h, w, h,
+                              node.depth + 1, node)
+                     for i in (0, 1) for j in (0, 1)]
+    stay = []
+    for obj in node.items:
+      cx, cy, half = self._center(obj)
+      child = node.child(cx, cy)
+      if child.fits(half):
+        child.items.append(obj)
+        child.count += 1
+        self.where[obj] = child
+      else:
+        stay.append(obj)
+    node.items = stay
+
+  def _merge(self, node):
+    '''Pulls every entity of the subtree of `node` up into it.'''
+    stack = list(node.children)
+    while stack:
+      n = stack.pop()
+      for obj in n.items:
+        node.items.append(obj)
+        self.where[obj] = node
+      if n.children is not None:
+        stack.extend(n.children)
+    node.children = None
+
+  def update(self, obj):
+    cx, cy, half = self._center(obj)
+    node = self.where.get(obj)
+    if node is not None:
+      if node.holds(cx, cy) and node.fits(half) and \
+         (node.children is None or not node.child(cx, cy).fits(half)):
+        return
+      self.remove(obj)
+    self._insert(obj, cx, cy, half)
 
+  def remove(self, obj):
+    node = self.where.pop(obj, None)
+    if node is None:
+      return
+    node.items.remove(obj)
+    merge = None
+    while node is not None:
+      node.count -= 1
+      if node.children is not None and node.count <= self.capacity / 2:
+        merge = node
+      node = node.parent
+    if merge is not None:
+      self._merge(merge)
 
+  def clear(self):
+    self.root = QuadNode(0., 0., float(self.width), float(self.height), 0,
+                         None)
+    self.where.clear()
+
+  def _query(self, left, top, right, bottom):
+    buckets = []
+    stack = [self.root]
+    while stack:
+      node = stack.pop()
+      l, t, r, b = node.loose
+      if l > right or r < left or t > bottom or b < top:
+        continue
+      if node.items:
+        buckets.append(node.items)
+      if node.children is not None:
+        stack.extend(node.children)
+    return buckets
+
+  def query(self, x, y):
+    # Like the grid's buffer zones, this also finds entities up to one
+    # entity-width away, which may touch whatever is at (x,y).
+    pad = 2 * self.widest
+    return self._query(x - pad, y - pad, x + pad, y + pad)
+
+  def query_boxes(self, left, top, right, bottom):
+    return [self._query(*box) for box in
+            zip(left.tolist(), top.tolist(), right.tolist(), bottom.tolist())]
 
-################################################################################
-#                             Collision Detection                              #
-################################################################################
 
 class CollisionSpace(object):
   '''This is an implementation of sub-space partitioning collision
-  detection.'''
+  detection.  Which baddies to test exactly is left to a `Broadphase`.'''
 
   BINSIZE = 50  # 1-D size of each sub-space (bin)
   BUFSIZE = .2  # 1-D percentage of overlapping space
 
-  def __init__(self, size, player):
+  BROADPHASES = ('grid', 'sap', 'quadtree')
+  '''The broadphase engines: a `SpatialHash`, a `SweepAndPrune` or a
+  `LooseQuadtree`.'''
+
+  def __init__(self, size, player, broadphase='grid'):
+    '''Creates an empty space.
+
+    Args:
+      size, (int,int): The width and height of the space (in pixels).
+      player, Player: The player.
+      broadphase, str: The broadphase engine to use (one of `BROADPHASES`).
+    '''
+    assert broadphase in self.BROADPHASES, \
+        'Invalid broadphase: %s' % broadphase
     self.size = self.width,self.height = size
     self.player = player
-    self.cols = size[0] / self.BINSIZE
-    self.rows = size[1] / self.BINSIZE
-    self.baddies = []
-    self.bullets = []
+    if broadphase == 'grid':
+      self.broadphase = SpatialHash(size, self.BINSIZE, self.BUFSIZE)
+    elif broadphase == 'sap':
+      self.broadphase = SweepAndPrune(size)
+    else:
+      self.broadphase = LooseQuadtree(size)
+    self.baddies = EntityRegistry()
+    self.bullets = BulletStore()
+    self.ai = AIStage()
+    self.max_power = None  # If not None, the most power guns fire with.
+    self.prev = {}  # baddie -> where it was before the last tick (see `draw`)
 
   def empty(self):
-    while len(self.baddies) > 0: del self.baddies[0]
-    while len(self.bullets) > 0: del self.bullets[0]
-
-  def _tick_baddie(self, baddie):
-    buls = baddie.tick()
-    if buls is not None:
-      for b in buls:
-        self.add(b)
-
+    for b in self.baddies:
+      Pool.of(type(b)).release(b)
+    self.baddies.clear()
+    self.bullets.clear()
+    self.broadphase.clear()
+    self.prev.clear()
+
+  def remember(self):
+    '''Notes where every baddie and upgrade is, before a tick, so that `draw`
+    can draw them between there and where the tick moves them.  (Bullets
+    keep their own `BulletStore.prev`.)'''
+    self.prev = dict((b, (b.pos[0], b.pos[1])) for b in self.baddies)
+
+  def _bound_baddie(self, baddie):
     # Bounce off the walls.
     rect = baddie._build_rect()
     if rect.left <= 0 or rect.right >= self.width:
       baddie.traj = math.pi - baddie.traj
+      baddie.rect = None
       while baddie._build_rect().left <= 0:
         baddie.move(1,0)
       while baddie._build_rect().right >= self.width:
         baddie.move(-1,0)
     if rect.top <= 0 or rect.bottom >= self.height:
       baddie.traj = -baddie.traj
+      baddie.rect = None
       while baddie._build_rect().top <= 0:
         baddie.move(0,1)
       while baddie._build_rect().bottom >= self.height:
         baddie.move(0,-1)
 
-    self._insert_baddie(baddie)
+    self.broadphase.update(baddie)
 
   def tick(self):
-    self.bins = []
-    for i in xrange(self.cols):
-      self.bins.append([])
-      for j in xrange(self.rows):
-        self.bins[i].append([])
-
-    # update baddies and put them in their bins
-    for b in xrange(len(self.baddies)-1,-1,-1):
-      baddie = self.baddies[b]
-      if isinstance(baddie, Baddie) or isinstance(baddie, Upgrade):
-        self._tick_baddie(baddie)
-      elif isinstance(baddie, Bullet):
-        baddie.tick()
-        if baddie.pos[0] < 0 or baddie.pos[0] > self.width or \
-           baddie.pos[1] < 0 or baddie.pos[1] > self.height:
-          del self.baddies[b]
+    stats = Stats.get_stats()
+    # update baddies and move them between bins
+    self.baddies.compact()
+    with stats.phase('ai'):
+      for b in self.ai.tick(self.baddies, self.max_power):
+        self.add(b)
+    with stats.phase('move'):
+      for baddie in self.baddies.items:
+        if isinstance(baddie, Baddie) or isinstance(baddie, Upgrade):
+          self._bound_baddie(baddie)
         else:
-          self._insert_baddie(baddie)
-      else:
-        assert False, "Unrecognized type: %s" % str(type(baddie))
+          assert False, "Unrecognized type: %s" % str(type(baddie))
+
+      # Move the bullets.  Ones that leave the space are only removed after
+      # the collision checks, as their paths may have crossed something on the
+      # way.
+      self.bullets.advance()
+
+    with stats.phase('collide'):
+      self._collide()
+
+  def _collide(self):
+    '''Finds and handles every collision of this tick.'''
+    stats = Stats.get_stats()
 
     # Ensure the player is in bounds.
     while self.player._build_rect().left <= 0:
@@ -742,149 +2893,107 @@ class CollisionSpace(object):
     while self.player._build_rect().bottom >= self.height:
       self.player.move(0,-1)
 
-    # update ship, bound in the square, and check collisions
-    for i,j in self._get_bins_idxs(self.player):
-      for b in xrange(len(self.bins[i][j])-1,-1,-1):
-        if self.bins[i][j][b].collides(self.player):
-          if isinstance(self.bins[i][j][b], Baddie) or \
-              isinstance(self.bins[i][j][b], Bullet):
-            self.player.hit()
-            self._remove_baddie(self.bins[i][j][b])
-            break
-          elif isinstance(self.bins[i][j][b], Upgrade):
-            self.bins[i][j][b].apply(self.player)
-            self._remove_baddie(self.bins[i][j][b])
-          else:
-            assert False, "Unrecognized type: %s" % \
-                    str(type(self.bins[i][j][b]))
-      if self.player.exploding: break
-
-    # update bullets and delete when O.O.B.
-    for b1 in xrange(len(self.bullets)-1,-1,-1):
-      self.bullets[b1].tick()
-      pos = self.bullets[b1].pos
-      w,h = self.size
-      if pos[0] < 0 or pos[1] < 0 or pos[0] > w or pos[1] > h:
-        del self.bullets[b1]
+    # update ship, bound in the square, and check collisions.  What touches
+    # the player is handled in registry order rather than in the order the
+    # broadphase happens to keep, which depends on its history (and so is not
+    # the same after restoring a `Snapshot`).
+    index = self.baddies.index
+    touching = set()
+    for cell in self.broadphase.query(*self.player.pos):
+      for b in cell:
+        if b in index and b.collides(self.player):
+          touching.add(b)
+    for b in sorted(touching, key=index.get):
+      if isinstance(b, Baddie):
+        self.player.hit()
+        self._remove_baddie(b)
+        break
+      elif isinstance(b, Upgrade):
+        b.apply(self.player)
+        stats.inc("upgrades")
+        self._remove_baddie(b)
       else:
-        removed = False
-        for i,j in self._get_bins_idxs(self.bullets[b1]):
-          for b2 in xrange(len(self.bins[i][j])-1,-1,-1):
-            Stats.get_stats().inc("comparisons")
-            if not isinstance(self.bins[i][j][b2], Upgrade) and \
-               self.bins[i][j][b2].collides(self.bullets[b1]):
-              if isinstance(self.bins[i][j][b2], Baddie):
-                for u in self.bins[i][j][b2].upgrade():
-                  self.baddies.append(u)
-              self.player.score += self.bins[i][j][b2].score
-              self._remove_bullet(self.bullets[b1])
-              self._remove_baddie(self.bins[i][j][b2])
-              removed = True
-              break
-          if removed: break
-
-  def _get_simple_bins_idxs(self, obj):
-    pos = ( float(obj.pos[0]) / self.size[0] * self.cols,
-            float(obj.pos[1]) / self.size[1] * self.rows )
-    bin_i = int(pos[0])
-    bin_j = int(pos[1])
-    i_pos = pos[0] - bin_i
-    j_pos = pos[1] - bin_j
-
-    if bin_i < 0:
-      bin_i = 0
-    elif bin_i >= self.cols:
-      bin_i = self.cols - 1
-    if bin_j < 0:
-      bin_j = 0
-    elif bin_j >= self.rows:
-      bin_j = self.rows - 1
-
-    return bin_i,bin_j
-
-  def _get_bins_idxs(self, obj):
-    pos = ( float(obj.pos[0]) / self.size[0] * self.cols,
-            float(obj.pos[1]) / self.size[1] * self.rows )
-    bin_i = int(pos[0])
-    bin_j = int(pos[1])
-    i_pos = pos[0] - bin_i
-    j_pos = pos[1] - bin_j
-
-    skip_col_ovrlp = skip_row_ovrlp = False
-    if bin_i < 0:
-      bin_i = 0
-      skip_col_ovrlp = True
-    elif bin_i >= self.cols:
-      bin_i = self.cols - 1
-      skip_col_ovrlp = True
-    if bin_j < 0:
-      bin_j = 0
-      skip_row_ovrlp = True
-    elif bin_j >= self.rows:
-      bin_j = self.rows - 1
-      skip_row_ovrlp = True
-
-    l_bin = r_bin = False
-    bins = [(bin_i, bin_j)]
-    if not skip_col_ovrlp:
-      if i_pos < self.BUFSIZE:
-        if bin_i > 0:
-          l_bin = True
-          bins.append((bin_i-1, bin_j))
-      elif i_pos > 1 - self.BUFSIZE:
-        if bin_i < self.cols - 1:
-          r_bin = True
-          bins.append((bin_i+1, bin_j))
-
-    if not skip_row_ovrlp:
-      if j_pos < self.BUFSIZE:
-        if bin_j > 0:
-          bins.append((bin_i, bin_j-1))
-          if l_bin:
-            bins.append((bin_i-1, bin_j-1))
-          elif r_bin:
-            bins.append((bin_i+1, bin_j-1))
-      elif j_pos > 1 - self.BUFSIZE:
-        if bin_j < self.rows - 1:
-          bins.append((bin_i, bin_j))
-          if l_bin:
-            bins.append((bin_i-1, bin_j+1))
-          elif r_bin:
-            bins.append((bin_i+1, bin_j+1))
-
-    return bins
-
-  def _insert_baddie(self, b):
-    i,j = self._get_simple_bins_idxs(b)
-    self.bins[i][j].append(b)
+        assert False, "Unrecognized type: %s" % str(type(b))
+
+    # Enemy bullets hitting the player.
+    dead = []
+    if not self.player.exploding:
+      for b in self.bullets.hits('bad', self.player._build_rect()):
+        self.player.hit()
+        dead.append(b)
+        if self.player.exploding: break
+
+    # Player bullets hitting baddies: each bullet is swept from where it was
+    # to where it is now, so fast bullets cannot skip over small baddies, and
+    # it hits the first baddie along its path (the first registered one, if
+    # several are hit at once).
+    good = numpy.flatnonzero(self.bullets.side[:len(self.bullets)] ==
+                             BulletStore.SIDES['good'])
+    buckets = self.broadphase.query_boxes(
+        *[a[good] for a in self.bullets.paths()])
+    x0s, y0s = self.bullets.prev[good].T.tolist()
+    x1s, y1s = self.bullets.pos[good].T.tolist()
+    baddies = self.baddies
+    comparisons = 0
+    for k, b1 in enumerate(good.tolist()):
+      x0, y0, x1, y1 = x0s[k], y0s[k], x1s[k], y1s[k]
+      path = pygame.Rect(min(x0, x1), min(y0, y1),
+                         abs(x1 - x0) + 1, abs(y1 - y0) + 1)
+      first, first_t = None, 2
+      for cell in buckets[k]:
+        comparisons += len(cell)
+        for b2 in cell:
+          if isinstance(b2, Upgrade) or b2 not in baddies: continue
+          rect = b2._build_rect()
+          if not rect.colliderect(path): continue
+          t = segment_enters_rect(x0, y0, x1, y1, rect)
+          if t is not None and (t < first_t or t == first_t and
+                                baddies.index[b2] < baddies.index[first]):
+            first, first_t = b2, t
+      if first is not None:
+        for u in first.upgrade():
+          self.baddies.append(u)
+        self.player.score += first.score
+        stats.inc("kills")
+        dead.append(b1)
+        self._remove_baddie(first)
+    stats.add("comparisons", comparisons)
+
+    dead.extend(self.bullets.out_of_bounds(self.width, self.height))
+    self.bullets.remove_indices(dead)
+    self.baddies.compact()
 
   def _remove_bullet(self, b):
     self.bullets.remove(b)
 
-  def _remove_baddie(self, b, idxs = None):
-    if idxs is None:
-      idxs = self._get_simple_bins_idxs(b)
-    self.bins[idxs[0]][idxs[1]].remove(b)
+  def _remove_baddie(self, b):
+    self.broadphase.remove(b)
     self.baddies.remove(b)
+    self.prev.pop(b, None)  # It may be reused for a new one.
+    Pool.of(type(b)).release(b)
 
   def add(self, obj):
     if isinstance(obj, Bullet):
-      if obj.side is 'good':
-        self.bullets.append(obj)
-      else:
-        self.baddies.append(obj)
+      self.bullets.add(obj)
     elif isinstance(obj, Baddie):
       self.baddies.append(obj)
     else:
       print 'Unrecognized type in CollisionSpace.add():', type(obj)
 
-  def draw(self):
+  def draw(self, alpha=1.):
+    '''Draws everything `alpha` of the way from where it was before the last
+    tick (see `remember`) to where it is now.'''
     #for x in xrange(self.BINSIZE, self.size[0], self.BINSIZE):
     #  pygame.draw.line(Main.get_main().screen, (0,0,255), (x,0), (x,self.size[1]), 1)
     #for y in xrange(self.BINSIZE, self.size[1], self.BINSIZE):
     #  pygame.draw.line(Main.get_main().screen, (0,0,255), (0,y), (self.size[0],y), 1)
-    for b in self.baddies: b.draw()
-    for b in self.bullets: b.draw()
+    if alpha >= 1:
+      rects = [b.draw() for b in self.baddies]
+    else:
+      prev = self.prev
+      rects = [b.draw(lerp(prev.get(b), b.pos, alpha)) for b in self.baddies]
+    rects.extend(self.bullets.draw(alpha))
+    return rects
 
 
 
@@ -892,14 +3001,16 @@ class CollisionSpace(object):
 #                                   Upgrades                                   #
 ################################################################################
 
-class Upgrade(object):
-  def __init__(self, screen, pos):
-    self.screen = screen
+class Upgrade(Entity):
+  __slots__ = ('pos', 'color', 'traj', 'rect')
+
+  def __init__(self, pos):
     self.pos = list(pos)
-    self.color = ( random.randrange(256),
-                   random.randrange(256),
-                   random.randrange(256) )
-    self.traj = random.randrange(200) * math.pi / 100
+    rng = RandomStreams.stream('cosmetic')
+    self.color = ( rng.randrange(256),
+                   rng.randrange(256),
+                   rng.randrange(256) )
+    self.traj = RandomStreams.stream('upgrades').randrange(200) * math.pi / 100
     self.rect = None
 
   def move(self, *delta):
@@ -927,63 +3038,528 @@ class Upgrade(object):
   def apply(self, player):
     assert False, "Unimplemented upgrade!"
 
-  def tick(self):
-    self.rect = None
-    self.pos[0] += math.cos(self.traj)
-    self.pos[1] += math.sin(self.traj)
+  def tick(self, max_power=None):
+    return self.tick_all([self], max_power)
+
+  @classmethod
+  def tick_all(cls, upgrades, max_power=None):
+    '''Moves a group of upgrades forward (see `AIStage`).'''
+    traj = numpy.array([u.traj for u in upgrades], dtype=float)
+    move_forward_all(upgrades, traj, 1)
+    return ()
 
-  def _draw_one(self, rect):
-    pygame.draw.rect(self.screen, self.color, rect, 1)
-    pygame.draw.rect(self.screen, self.color + (80,), rect)
+  COLOR_STEP = 16
+  '''The cycling color is rounded down to a multiple of this per channel when
+  picking a sprite, so an upgrade reuses a sprite for several frames.'''
 
-  def draw(self):
-    '''Just draws the common outline.'''
-    self.color = ( (self.color[0] + random.randrange(-2, 2)) % 256,
-                   (self.color[1] + random.randrange(-2, 2)) % 256,
-                   (self.color[2] + random.randrange(-2, 2)) % 256 )
-    self._draw_one(pygame.Rect(self.pos[0] -10, self.pos[1] - 5,  2, 10))
-    self._draw_one(pygame.Rect(self.pos[0] + 8, self.pos[1] - 5,  2, 10))
-    self._draw_one(pygame.Rect(self.pos[0] - 5, self.pos[1] -10, 10,  2))
-    self._draw_one(pygame.Rect(self.pos[0] - 5, self.pos[1] + 8, 10,  2))
+  @classmethod
+  def _draw_one(cls, surf, rect, color):
+    pygame.draw.rect(surf, color, rect, 1)
+    if cls.translucent:
+      pygame.draw.rect(surf, color + (80,), rect)
+
+  @classmethod
+  def _draw_frame(cls, surf, x, y, color):
+    '''Draws the common outline in `color` centered at (`x`,`y`) on
+    `surf`.'''
+    cls._draw_one(surf, pygame.Rect(x -10, y - 5,  2, 10), color)
+    cls._draw_one(surf, pygame.Rect(x + 8, y - 5,  2, 10), color)
+    cls._draw_one(surf, pygame.Rect(x - 5, y -10, 10,  2), color)
+    cls._draw_one(surf, pygame.Rect(x - 5, y + 8, 10,  2), color)
+
+  @classmethod
+  def _draw_icon(cls, surf, x, y):
+    '''Draws the upgrade-specific icon centered at (`x`,`y`) on `surf`.'''
+    pass
+
+  @classmethod
+  def _render(cls, color):
+    surf = SpriteCache.surface(21, 21)
+    cls._draw_frame(surf, 10, 10, color)
+    cls._draw_icon(surf, 10, 10)
+    return surf, (-10, -10)
+
+  cycle_colors = True
+  '''Whether upgrades slowly change color (see `QualityLadder`).'''
+
+  def look(self):
+    '''Cycles the color a bit, and gets what the upgrade looks like, for
+    `draw_look`: its color, rounded to `COLOR_STEP`.'''
+    if self.cycle_colors:
+      rng = RandomStreams.stream('cosmetic')
+      self.color = ( (self.color[0] + rng.randrange(-2, 2)) % 256,
+                     (self.color[1] + rng.randrange(-2, 2)) % 256,
+                     (self.color[2] + rng.randrange(-2, 2)) % 256 )
+    return tuple(c / self.COLOR_STEP * self.COLOR_STEP for c in self.color)
+
+  @classmethod
+  def draw_look(cls, screen, pos, color):
+    '''Draws an upgrade of this class at `pos` in `color` (see `look`).'''
+    return SpriteCache.get_cache().blit(screen, pos,
+        ('upgrade', cls, color, cls.translucent), lambda: cls._render(color))
+
+  def draw(self, pos=None):
+    '''Cycles the color a bit and draws the sprite for it (at `pos` if
+    given).'''
+    return self.draw_look(self.screen, pos or self.pos, self.look())
 
 class BulletUpgrade(Upgrade):
+  __slots__ = ()
+
   def apply(self, player):
     player.gun.power += 1
 
-  def draw(self):
-    Upgrade.draw(self)
-    pygame.draw.line(self.screen, (255,0,0),
-        (self.pos[0], self.pos[1] - 5),
-        (self.pos[0], self.pos[1] + 5))
-    pygame.draw.line(self.screen, (255,0,0),
-        (self.pos[0] - 3, self.pos[1] - 6),
-        (self.pos[0] - 1, self.pos[1] + 4))
-    pygame.draw.line(self.screen, (255,0,0),
-        (self.pos[0] + 3, self.pos[1] - 6),
-        (self.pos[0] + 1, self.pos[1] + 4))
+  @classmethod
+  def _draw_icon(cls, surf, x, y):
+    pygame.draw.line(surf, (255,0,0), (x, y - 5), (x, y + 5))
+    pygame.draw.line(surf, (255,0,0), (x - 3, y - 6), (x - 1, y + 4))
+    pygame.draw.line(surf, (255,0,0), (x + 3, y - 6), (x + 1, y + 4))
 
 class SpeedUpgrade(Upgrade):
+  __slots__ = ()
+
   def apply(self, player):
     player.speed += 1
 
-  def draw(self):
-    Upgrade.draw(self)
-    pygame.draw.lines(self.screen, (255,0,0), False,
-        [ (self.pos[0] - 5, self.pos[1] - 5),
-          (self.pos[0], self.pos[1]),
-          (self.pos[0] - 5, self.pos[1] + 5) ] )
-    pygame.draw.lines(self.screen, (255,0,0), False,
-        [ (self.pos[0], self.pos[1] - 5),
-          (self.pos[0] + 5, self.pos[1]),
-          (self.pos[0], self.pos[1] + 5) ] )
+  @classmethod
+  def _draw_icon(cls, surf, x, y):
+    pygame.draw.lines(surf, (255,0,0), False,
+        [ (x - 5, y - 5), (x, y), (x - 5, y + 5) ] )
+    pygame.draw.lines(surf, (255,0,0), False,
+        [ (x, y - 5), (x + 5, y), (x, y + 5) ] )
 
 class ShieldUpgrade(Upgrade):
+  __slots__ = ()
+
   def apply(self, player):
     player.shields += 1
 
-  def draw(self):
-    Upgrade.draw(self)
-    pygame.draw.circle(self.screen, (255,0,0), map(int, self.pos), 5, 1)
+  @classmethod
+  def _draw_icon(cls, surf, x, y):
+    pygame.draw.circle(surf, (255,0,0), (x, y), 5, 1)
+
+
+
+################################################################################
+#                                 Save States                                  #
+################################################################################
+
+class Snapshot(object):
+  '''The whole state of a game, saved to or loaded from a compact binary
+  file.
+
+  Entities are stored as flat arrays (type, position, heading, ...) rather
+  than one record each, so saving and loading are bulk copies: the file is
+  a small JSON header followed by the raw arrays, each aligned to `ALIGN`
+  bytes, which `load` maps into memory instead of reading.  The layout is:
+  "LBSS", a uint16 version, 2 reserved bytes, a uint32 header length, the
+  header, then the arrays at the offsets the header gives.'''
+
+  MAGIC = 'LBSS'
+  VERSION = 1
+  PREFIX = struct.Struct('<4sHHI')
+  ALIGN = 16
+
+  KINDS = ('Wiggler', 'FastWiggler', 'Homer', 'Shooter', 'BulletUpgrade',
+           'SpeedUpgrade', 'ShieldUpgrade')
+  '''The entity types, by the codes in the "kind" arrays.'''
+
+  PLAYER = ('traj', 'speed', 'score', 'shields', 'fire_delay',
+            'last_fire_time', 'exploding', 'expl_prog')
+  '''The `Player` attributes saved as they are.'''
+
+  def __init__(self, state, arrays):
+    '''Creates a snapshot.
+
+    Args:
+      state, {str: ...}: Everything that is not an array (JSON-able).
+      arrays, {str: numpy.ndarray}: The arrays, by name.
+    '''
+    self.state = state
+    self.arrays = arrays
+
+  @classmethod
+  def capture(cls, game):
+    '''Takes a snapshot of `game`.
+
+    Args:
+      game, Main: The game.
+
+    Returns:
+      Snapshot: The snapshot.
+    '''
+    codes = dict((k, i) for i, k in enumerate(cls.KINDS))
+    space = game.space
+    space.baddies.compact()
+    baddies = list(space.baddies)
+    n = len(baddies)
+    player = game.player
+
+    state = {
+      'size': list(game.size),
+      'ticks': game.clock.ticks,
+      'step': game.clock.step,
+      'tier': game.quality.tier,
+      'lev_i': game.lev_i,
+      'paused': game.paused,
+      'winner': game.winner,
+      'player': dict([(k, getattr(player, k)) for k in cls.PLAYER] +
+                     [('pos', list(player.pos)),
+                      ('power', player.gun.power)]),
+      'levels': [ { 'prog_i': l.prog_i, 'paused': l.paused,
+                    'start_time': getattr(l, 'start_time', None),
+                    'pause_time': getattr(l, 'pause_time', None) }
+                  for l in game.levels ],
+      'spawns': [ { 'paused': sp.paused, 'queued': len(sp.queue) }
+                  for sp in game.spawn_points ],
+      'random': {},
+    }
+    arrays = {
+      'baddies/kind': numpy.array([codes[type(b).__name__] for b in baddies],
+                                  dtype=numpy.uint8),
+      'baddies/pos': numpy.array([b.pos for b in baddies],
+                                 dtype=float).reshape(n, 2),
+      'baddies/traj': numpy.array([b.traj for b in baddies], dtype=float),
+      # When a `Shooter` last fired, and the color of an `Upgrade`.
+      'baddies/fired': numpy.array([getattr(b, 'last_fired', 0)
+                                    for b in baddies], dtype=float),
+      'baddies/color': numpy.array([getattr(b, 'color', (0,0,0))
+                                    if isinstance(b, Upgrade) else (0,0,0)
+                                    for b in baddies],
+                                   dtype=numpy.uint8).reshape(n, 3),
+      'spawns/queue': numpy.array([codes[t.__name__]
+                                   for sp in game.spawn_points
+                                   for t in sp.queue], dtype=numpy.uint8),
+    }
+    bullets = space.bullets
+    for k in ('pos', 'prev', 'traj', 'side'):
+      arrays['bullets/' + k] = getattr(bullets, k)[:bullets.n]
+
+    streams = RandomStreams.get_streams()
+    for name, rng in streams.streams.iteritems():
+      version, internal, gauss = rng.getstate()
+      state['random'][name] = { 'version': version, 'gauss': gauss }
+      arrays['random/' + name] = numpy.array(internal, dtype=numpy.uint32)
+    for name, rng in streams.arrays.iteritems():
+      kind, keys, pos, has_gauss, gauss = rng.get_state()
+      state['random']['array:' + name] = { 'kind': kind, 'pos': pos,
+          'has_gauss': has_gauss, 'gauss': gauss }
+      arrays['random/array:' + name] = keys
+    return cls(state, arrays)
+
+  def save(self, path):
+    '''Writes the snapshot to the file `path`.'''
+    names = sorted(self.arrays)
+    index = {}
+    offset = 0
+    for name in names:
+      a = numpy.ascontiguousarray(self.arrays[name])
+      index[name] = [a.dtype.str, list(a.shape), offset]
+      offset += -(-a.nbytes // self.ALIGN) * self.ALIGN
+    header = json.dumps({ 'state': self.state, 'arrays': index },
+                        sort_keys=True)
+    # Pad so that the arrays start aligned.
+    header += ' ' * (-(self.PREFIX.size + len(header)) % self.ALIGN)
+    with open(path, 'wb') as f:
+      f.write(self.PREFIX.pack(self.MAGIC, self.VERSION, 0, len(header)))
+      f.write(header)
+      for name in names:
+        a = numpy.ascontiguousarray(self.arrays[name])
+        a.tofile(f)
+        f.write('\0' * (-a.nbytes % self.ALIGN))
+
+  @classmethod
+  def load(cls, path):
+    '''Maps the snapshot in the file `path` into memory.
+
+    Returns:
+      Snapshot: The snapshot; its arrays are read-only views of the file.
+
+    Throws:
+      ValueError: If the file is not a snapshot this version can read.
+    '''
+    with open(path, 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < cls.PREFIX.size:
+      raise ValueError('Not a snapshot: %s' % path)
+    magic, version, _, n = cls.PREFIX.unpack_from(data)
+    if magic != cls.MAGIC or version != cls.VERSION:
+      raise ValueError('Not a version %d snapshot: %s' % (cls.VERSION, path))
+    start = cls.PREFIX.size + n
+    header = json.loads(data[cls.PREFIX.size:start])
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].iteritems():
+      dtype = numpy.dtype(str(dtype))
+      count = int(numpy.prod(shape))
+      arrays[name] = numpy.frombuffer(data, dtype, count,
+                                      start + offset).reshape(shape)
+    return cls(header['state'], arrays)
+
+  def restore(self, game):
+    '''Puts `game` into the state of the snapshot.
+
+    Args:
+      game, Main: The game.  It must have the same size and levels as the
+                  game the snapshot was taken of.  It may tick at another
+                  rate: its clock is set to the same time (to the nearest
+                  tick).
+    '''
+    state, arrays = self.state, self.arrays
+    assert list(game.size) == state['size'], \
+        'Snapshot is of a %dx%d game.' % tuple(state['size'])
+    assert len(game.levels) == len(state['levels']), \
+        'Snapshot has %d levels.' % len(state['levels'])
+    kinds = [globals()[k] for k in self.KINDS]
+
+    # Times (e.g. when the player last fired) are saved in ms, so keep the
+    # time rather than the tick count.
+    game.clock.ticks = int(round(state['ticks'] * state['step'] /
+                                 game.clock.step))
+    game.quality.set(state['tier'])
+    game.player_prev = None
+    game.lev_i = state['lev_i']
+    game.paused = state['paused']
+    game.winner = state['winner']
+
+    player = game.player
+    p = state['player']
+    for k in self.PLAYER:
+      setattr(player, k, p[k])
+    player.pos = list(p['pos'])
+    player.gun.power = p['power']
+    player.rect = None
+
+    for l, s in zip(game.levels, state['levels']):
+      l.prog_i, l.paused = s['prog_i'], s['paused']
+      if s['start_time'] is not None: l.start_time = s['start_time']
+      if s['pause_time'] is not None: l.pause_time = s['pause_time']
+    queue = [kinds[k] for k in arrays['spawns/queue'].tolist()]
+    for sp, s in zip(game.spawn_points, state['spawns']):
+      sp.paused = s['paused']
+      sp.queue, queue = queue[:s['queued']], queue[s['queued']:]
+
+    space = game.space
+    space.empty()
+    pos = arrays['baddies/pos'].tolist()
+    traj = arrays['baddies/traj'].tolist()
+    fired = arrays['baddies/fired'].tolist()
+    color = arrays['baddies/color'].tolist()
+    for i, k in enumerate(arrays['baddies/kind'].tolist()):
+      kind = kinds[k]
+      if issubclass(kind, Upgrade):
+        b = Pool.of(kind).acquire(pos[i])
+        b.color = tuple(color[i])
+        b.traj = traj[i]
+      else:
+        b = Pool.of(kind).acquire(pos[i], traj[i])
+        if isinstance(b, Shooter):
+          b.last_fired = fired[i]
+      space.baddies.add(b)
+    space.bullets.load(arrays['bullets/pos'], arrays['bullets/prev'],
+                       arrays['bullets/traj'], arrays['bullets/side'])
+
+    # Last, since making upgrades above draws from the streams.
+    streams = RandomStreams.get_streams()
+    for name, s in state['random'].iteritems():
+      keys = arrays['random/' + name]
+      if name.startswith('array:'):
+        streams.get_array(name[len('array:'):]).set_state((str(s['kind']),
+            keys, s['pos'], s['has_gauss'], s['gauss']))
+      else:
+        streams.get(name).setstate((s['version'], tuple(keys.tolist()),
+                                    s['gauss']))
+
+
+
+################################################################################
+#                                   Quality                                    #
+################################################################################
+
+class QualityLadder(object):
+  '''Trades quality for speed when the game cannot keep up its frame rate,
+  instead of stalling the level.
+
+  Each tier down the ladder sheds more work: first optional drawing, then
+  some of the simulation itself.  It steps down a tier once the frame rate
+  has stayed under `low` for `DOWN_AFTER` frames in a row, and back up only
+  once it has stayed at or over `high` (which is higher) for `UP_AFTER`
+  frames, so that it does not flap between two tiers.'''
+
+  TIERS = ('full', 'no_hud', 'flat', 'few_bullets', 'slow_spawns')
+  '''Each tier sheds what the ones above it do, and:
+       full         nothing
+       no_hud       the statistics HUD (and timings overlay)
+       flat         translucent fills, shield pulsing and upgrade color
+                    cycling
+       few_bullets  volleys over `MAX_POWER` power
+       slow_spawns  half the spawn rate'''
+
+  DOWN_AFTER = 15
+  UP_AFTER = 90
+  MAX_POWER = 4
+
+  def __init__(self, low, high, space, spawn_points):
+    '''Creates a ladder at the top tier.
+
+    Args:
+      low, float: The frame rate under which to step down.
+      high, float: The frame rate at or over which to step back up.
+      space, CollisionSpace: The space whose guns to cap.
+      spawn_points, [SpawnPoint]: The spawn points to slow.
+    '''
+    assert low <= high, 'Stepping up below stepping down: %g < %g' % (high,
+                                                                       low)
+    self.low = low
+    self.high = high
+    self.frames = [0] * len(self.TIERS)
+    self.changes = 0  # Tier changes so far.
+    self.space = space
+    self.spawn_points = spawn_points
+    self.set(0)
+
+  def frame(self):
+    '''Counts a frame at the current tier.'''
+    self.frames[self.tier] += 1
+
+  def check(self, fps):
+    '''Notes the frame rate of the latest frame.
+
+    Returns:
+      int: 1 if it is time to step down a tier, -1 if it is time to step back
+           up, otherwise 0.
+    '''
+    if fps <= 0:
+      return 0  # Not measured yet.
+    if fps < self.low:
+      self.below += 1
+      self.above = 0
+      if self.below >= self.DOWN_AFTER and self.tier < len(self.TIERS) - 1:
+        return 1
+    elif fps >= self.high:
+      self.above += 1
+      self.below = 0
+      if self.above >= self.UP_AFTER and self.tier > 0:
+        return -1
+    else:
+      self.below = self.above = 0
+    return 0
+
+  def set(self, tier):
+    '''Switches to `tier` (an index of `TIERS`), logging the change.'''
+    tier = max(0, min(tier, len(self.TIERS) - 1))
+    if tier != getattr(self, 'tier', tier):
+      print 'Quality: %s -> %s at %.1fs' % (self.TIERS[self.tier],
+          self.TIERS[tier], SimClock.get_clock().now() / 1000.)
+      self.changes += 1
+    self.tier = tier
+    self.below = self.above = 0
+    Stats.get_stats().hud = tier < 1
+    Entity.translucent = tier < 2
+    Upgrade.cycle_colors = tier < 2
+    self.space.max_power = self.MAX_POWER if tier >= 3 else None
+    for sp in self.spawn_points:
+      sp.spawn_chance = SpawnPoint.SPAWN_CHANCE / (2 if tier >= 4 else 1)
+
+  def report(self):
+    '''Reports how many frames were spent at each tier.
+
+    Returns:
+      [str]: The lines of the report.
+    '''
+    total = max(1, sum(self.frames))
+    return [ '%-12s frames: %7d  (%5.1f%%)' % (name, n, 100. * n / total)
+             for name, n in zip(self.TIERS, self.frames) ]
+
+
+
+################################################################################
+#                                  Pipelining                                  #
+################################################################################
+
+class RenderFrame(object):
+  '''A compact picture of the game after a tick: what each entity is
+  (its class), where it was and is, and what it looks like (see
+  `Ship.look`), plus the bullets and the HUD.  It holds no references to
+  anything the simulation changes, so it can be drawn while the next tick
+  runs.'''
+
+  __slots__ = ('published', 'kinds', 'looks', 'prev', 'pos', 'bullet_prev',
+               'bullet_pos', 'bullet_traj', 'player_prev', 'player_pos',
+               'player_look', 'greeting', 'score', 'winner', 'exploding',
+               'paused', 'counts')
+
+  @classmethod
+  def capture(cls, game):
+    '''Takes a picture of `game`.  Things are drawn between where they were
+    at the last `Main.remember` and where they are now.
+
+    Returns:
+      RenderFrame: The picture.
+    '''
+    f = cls()
+    f.published = timer()
+    space = game.space
+    baddies = list(space.baddies)
+    prev = space.prev
+    f.kinds = [type(b) for b in baddies]
+    f.looks = [b.look() for b in baddies]
+    f.prev = [prev.get(b) for b in baddies]
+    f.pos = [(b.pos[0], b.pos[1]) for b in baddies]
+    n = space.bullets.n
+    f.bullet_prev = space.bullets.prev[:n].copy()
+    f.bullet_pos = space.bullets.pos[:n].copy()
+    f.bullet_traj = space.bullets.traj[:n].copy()
+    player = game.player
+    f.player_prev = game.player_prev
+    f.player_pos = (player.pos[0], player.pos[1])
+    f.player_look = player.look()
+    f.greeting = game.levels[game.lev_i].look() \
+                 if game.lev_i < len(game.levels) else None
+    f.score = player.score
+    f.winner = game.winner
+    f.exploding = player.exploding
+    f.paused = game.paused
+    f.counts = dict(game.stats.counts, FPS=game.fps_timer.get_fps())
+    return f
+
+
+class FrameBuffer(object):
+  '''A double buffer of `RenderFrame`s between a simulation thread, which
+  publishes one after every tick, and a render thread, which draws the
+  newest.  The front frame is the one being drawn; the back one is the
+  newest not yet taken.  Publishing never waits: a frame published before
+  the last one was taken replaces it (and is counted in `dropped`), so the
+  simulation never waits on drawing, nor piles up frames.'''
+
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.front = None
+    self.back = None
+    self.published = self.dropped = 0
+
+  def publish(self, frame):
+    '''Makes `frame` the newest frame.'''
+    with self.cond:
+      if self.back is not None:
+        self.dropped += 1
+      self.back = frame
+      self.published += 1
+      self.cond.notify()
+
+  def take(self, timeout=None):
+    '''Gets the newest frame, waiting up to `timeout` seconds for one newer
+    than the last taken.
+
+    Returns:
+      RenderFrame: The frame to draw: the last one taken if none is newer, or
+                   None if nothing has been published yet.
+    '''
+    with self.cond:
+      if self.back is None:
+        self.cond.wait(timeout)
+      if self.back is not None:
+        self.front, self.back = self.back, None
+      return self.front
 
 
 
@@ -992,44 +3568,93 @@ class ShieldUpgrade(Upgrade):
 ################################################################################
 
 class Main(object):
+  ACTIONS = ('spawn', 'power_up', 'power_down', 'shield_up', 'shield_down',
+             'pause', 'quality_down', 'quality_up')
+  '''What a frame of input can do besides moving and firing (see `act`).  An
+  `InputLog` records them by index.'''
+
+  KEY_ACTIONS = { pygame.K_F7: 'spawn',
+                  pygame.K_RIGHTBRACKET: 'power_up',
+                  pygame.K_LEFTBRACKET: 'power_down',
+                  pygame.K_0: 'shield_up',
+                  pygame.K_9: 'shield_down',
+                  pygame.K_p: 'pause' }
+
   def __init__(self, options):
     assert self.MAIN_OBJECT is None, "Another Main object is being created!"
 
+    self.headless = options.headless
+    if self.headless:
+      # No window, sound or fonts: only the clock and the simulation.
+      os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+      os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
     pygame.init()
 
     self.size = self.width, self.height = options.size
-    self.screen = pygame.display.set_mode(self.size, HWSURFACE | DOUBLEBUF)
+    self.screen = None
+    self.dirty = None
+    if options.dirty_rects and not self.headless:
+      # Partial updates need a single-buffered display.
+      self.screen = pygame.display.set_mode(self.size)
+      self.dirty = DirtyRects(self.screen, options.dirty_threshold)
+    elif not self.headless:
+      self.screen = pygame.display.set_mode(self.size, HWSURFACE | DOUBLEBUF)
     self.stats = Stats.get_stats(self.screen, self.size)
-
-    self.player = Player.spawn_at(self.screen, self.width/2, self.height/2)
+    self.timings = options.timings_out
+    self.stats.enable_timing(options.timings or self.timings is not None)
+    self.profiler = Profiler(options.profile_mode, options.profile or 300,
+                             options.profile_out)
+    if options.profile:
+      self.profiler.start()
+
+    Entity.screen = self.screen
+    self.player = Player.spawn_at(self.width/2, self.height/2)
+    self.player_prev = None  # Where it was before the last tick.
+    self.lock = threading.Lock()  # Held while ticking (see `run_pipelined`).
+    self.frame_buffer = None  # The `FrameBuffer` of `run_pipelined`.
 
     self.paused = False
     self.winner = False
 
     self.fps_timer = pygame.time.Clock()
     self.fps = options.fps
+    self.clock = SimClock(1000. / options.tick_rate)
+    SimClock.set_clock(self.clock)
+    RandomStreams.get_streams().seed(options.seed)
+    self.recorder = self.replay = None
+    if options.record is not None:
+      self.recorder = InputLog.record(options.record,
+          RandomStreams.get_streams().base_seed,
+          dict((k, getattr(options, k)) for k in InputLog.SETTINGS))
+    if options.replay is not None:
+      self.replay = InputLog.load(options.replay)
+    self.load_state = options.load_state
+    self.save_state = options.save_state
     self.min_fps = options.min_fps
     assert self.min_fps <= self.fps, "min FPS larger than FPS: %d > %d" % \
         (self.min_fps, self.fps)
 
     # fonts
-    self.score_font = pygame.font.SysFont('courier', 25, bold = True)
-    self.debug_font = pygame.font.SysFont('arial', 8)
-    self.gameover_font = pygame.font.SysFont('arial', 18, bold = True)
-    self.gameover_pos = self.gameover_font.size('GAME OVER')
-    self.gameover_pos = (self.width - self.gameover_pos[0]) / 2, \
-                        (self.height - self.gameover_pos[1]) / 2
-    self.winner_font = pygame.font.SysFont('arial', 18, bold = True)
-    self.winner_pos = self.winner_font.size('WINNER')
-    self.winner_pos = (self.width - self.winner_pos[0]) / 2, \
-                      (self.height - self.winner_pos[1]) / 2
-    self.pause_font = pygame.font.SysFont('arial', 18, bold = True)
-    self.pause_pos = self.pause_font.size('Pause')
-    self.pause_pos = (self.width - self.pause_pos[0]) / 2, \
-                     (self.height - self.pause_pos[1]) / 2
-
-    self.space = CollisionSpace(self.size, self.player)
-    self.user_input = Input(self.player, self.space)
+    if not self.headless:
+      self.score_font = pygame.font.SysFont('courier', 25, bold = True)
+      self.debug_font = pygame.font.SysFont('arial', 8)
+      self.gameover_font = pygame.font.SysFont('arial', 18, bold = True)
+      self.gameover_pos = self.gameover_font.size('GAME OVER')
+      self.gameover_pos = (self.width - self.gameover_pos[0]) / 2, \
+                          (self.height - self.gameover_pos[1]) / 2
+      self.winner_font = pygame.font.SysFont('arial', 18, bold = True)
+      self.winner_pos = self.winner_font.size('WINNER')
+      self.winner_pos = (self.width - self.winner_pos[0]) / 2, \
+                        (self.height - self.winner_pos[1]) / 2
+      self.pause_font = pygame.font.SysFont('arial', 18, bold = True)
+      self.pause_pos = self.pause_font.size('Pause')
+      self.pause_pos = (self.width - self.pause_pos[0]) / 2, \
+                       (self.height - self.pause_pos[1]) / 2
+      # As `Level` draws its greeting, for drawing it from a `RenderFrame`.
+      self.greeting_font = pygame.font.SysFont('courier', 30, bold = True)
+
+    self.space = CollisionSpace(self.size, self.player, options.broadphase)
+    self.user_input = Input(self.player, self.space, not self.headless)
 
     dw, dh = .1 * self.width, .1 * self.height
     self.spawn_points = [
@@ -1040,6 +3665,8 @@ class Main(object):
                 self.width, 0, self.space.baddies),
         SpawnPoint(self.screen, self.size,
                 self.width, self.height, self.space.baddies) ]
+    self.quality = QualityLadder(self.min_fps, (self.min_fps + self.fps) / 2.,
+                                 self.space, self.spawn_points)
 
     self.lev_i = 0
     self.levels = [ Level(self.screen, self.size, self.spawn_points,
@@ -1084,125 +3711,500 @@ class Main(object):
                                        (4e4, 3, FastWiggler, 100) ]) ]
 
   def tick(self):
+    with self.stats.phase('tick'):
+      self._tick()
+
+  def _tick(self):
+    stats = self.stats
     # Movement
-    if self.player.exploding:
-      # explode and restart
-      if self.player.expl_prog >= 30:
-        for s in self.spawn_points: s.clear()
-        self.player.reset()
-        self.player.pos = [ self.width / 2, self.height / 2 ]
-        self.space.empty()
-        self.lev_i = 0
-        self.levels[self.lev_i].start()
-    else:
-      self.user_input.tick()
+    with stats.phase('player'):
+      if self.player.exploding:
+        # explode and restart
+        self.player.expl_prog += .5 * self.clock.scale
+        if self.player.expl_prog >= 30:
+          for s in self.spawn_points: s.clear()
+          self.player.reset()
+          self.player.pos = [ self.width / 2, self.height / 2 ]
+          self.player.rect = None
+          self.space.empty()
+          self.lev_i = 0
+          self.levels[self.lev_i].start()
+      else:
+        self.user_input.tick()
 
 
     ########################################################################
     #                          Level Progression                           #
     ########################################################################
 
-    if self.lev_i < len(self.levels) and self.no_more_baddies():
-      if self.levels[self.lev_i].done():
-        self.lev_i += 1
-        if self.lev_i < len(self.levels):
-          self.levels[self.lev_i].start()
+    with stats.phase('levels'):
+      if self.lev_i < len(self.levels) and self.no_more_baddies():
+        if self.levels[self.lev_i].done():
+          self.lev_i += 1
+          if self.lev_i < len(self.levels):
+            self.levels[self.lev_i].start()
+          else:
+            self.winner = True
         else:
-          self.winner = True
-      else:
-        self.levels[self.lev_i].jump_to_next_wave()
-    elif not self.winner:
-      self.levels[self.lev_i].tick()
+          self.levels[self.lev_i].jump_to_next_wave()
+      elif not self.winner:
+        self.levels[self.lev_i].tick()
 
-    self.space.tick()
+    with stats.phase('space'):
+      self.space.tick()
     #for b in self.baddies: b.tick()
     #for b in self.bullets: b.tick()
-    for s in self.spawn_points: s.tick()
+    with stats.phase('spawns'):
+      for s in self.spawn_points: s.tick()
+
+    self.clock.tick()
+
+
+  def act(self, action):
+    '''Does one of `ACTIONS`.'''
+    if action == 'spawn':
+      RandomStreams.stream('spawn').choice(self.spawn_points).spawn()
+    elif action == 'power_up':
+      self.player.gun.power += 1
+    elif action == 'power_down':
+      if self.player.gun.power > 0:
+        self.player.gun.power -= 1
+    elif action == 'shield_up':
+      self.player.shields += 1
+    elif action == 'shield_down':
+      if self.player.shields > 0:
+        self.player.shields -= 1
+    elif action == 'pause':
+      self.paused = not self.paused
+    elif action == 'quality_down':
+      self.quality.set(self.quality.tier + 1)
+    elif action == 'quality_up':
+      self.quality.set(self.quality.tier - 1)
+    else:
+      assert False, 'Unknown action: %s' % action
 
+  def feed(self, axes, actions):
+    '''Hands one frame of input to the game: sets the axes `Input` acts on
+    next tick and does every action (see `act`).
 
-  def run(self):
-    '''Runs the game's main loop.'''
+    Args:
+      axes, (float,float,float,float): The axes, or None for no input.
+      actions, [int]: Indices of `ACTIONS`.
+    '''
+    self.user_input.axes = axes
+    for a in actions:
+      self.act(self.ACTIONS[a])
+
+  STATE_FILE = 'quicksave.lbss'
+  '''Where F8 saves and F9 restores when no --save-state file is given.'''
+
+  def start(self):
+    '''Starts the current level, or restores the --load-state snapshot.'''
     self.levels[self.lev_i].start()
-    while True:
-      self.stats.reset()
-
-      self.fps_timer.tick(self.fps)
-      if self.lev_i < len(self.levels):
-        if self.levels[self.lev_i].paused:
-          if self.fps_timer.get_fps() >= self.min_fps:
-            self.levels[self.lev_i].resume()
+    if self.load_state is not None:
+      Snapshot.load(self.load_state).restore(self)
+
+  MAX_TICKS_PER_FRAME = 5
+  '''The most ticks a frame runs to catch up.  Past that, the game slows down
+  rather than spending ever longer catching up.'''
+
+  def run(self):
+    '''Runs the game's main loop.
+
+    The simulation ticks at a fixed rate (--tick-rate) whatever the frame
+    rate: each frame runs as many ticks as the time since the last frame
+    calls for (maybe none), then draws everything between where it was
+    before the last tick and where it is now, as far between as the time
+    left over.  When replaying, this ticks once a frame, as fast as it can,
+    until the log runs out.'''
+    self.start()
+    frames = self.replay.frames() if self.replay is not None else None
+    step = self.clock.step / 1000.
+    lag = 0.
+    last = timer()
+    pending = []  # Actions read in frames that ran no ticks.
+    try:
+      while True:
+        stats = self.stats
+        stats.reset()
+        with stats.phase('wait'):
+          self.fps_timer.tick(self.fps if frames is None else 0)
+        now = timer()
+        lag += now - last
+        last = now
+
+        with stats.phase('input'):
+          if frames is None:
+            axes, actions = self._read_input()
+            pending.extend(actions)
+          else:
+            for event in pygame.event.get(pygame.QUIT): sys.exit()
+            axes, actions = next(frames, (None, None))
+            if actions is None:
+              return
+          pygame.event.clear()
+
+        alpha = 1.
+        if frames is not None:
+          self.step(axes, actions)
+        elif self.paused:
+          # No time passes, but input still does (and may unpause the game).
+          lag = 0.
+          self.step(axes, pending)
+          pending = []
         else:
-          if self.fps_timer.get_fps() < self.min_fps:
-            self.levels[self.lev_i].pause()
+          ticks = min(int(lag / step), self.MAX_TICKS_PER_FRAME)
+          for i in xrange(ticks):
+            if i == ticks - 1:
+              self.remember()
+            self.step(axes, pending)
+            pending = []
+            lag -= step
+            if self.paused:
+              break
+          lag = min(lag, step)
+          alpha = lag / step
+
+
+
+        ####################################################################
+        #                         Drawing Process                          #
+        ####################################################################
+
+        with self.profiler:
+          self._show(alpha)
+        self.profiler.frame()
+    finally:
+      self._finish()
 
+  def _show(self, alpha, frame=None):
+    '''Draws a frame (see `draw`) and puts it on the screen.'''
+    stats = self.stats
+    with stats.phase('draw'):
+      if self.dirty is None:
+        self.screen.fill((0,0,0))
+      else:
+        self.dirty.erase()
+      rects = self.draw(alpha, frame)
+    with stats.phase('flip'):
+      if self.dirty is None:
+        pygame.display.flip()
+      else:
+        self.dirty.update(rects)
+    self.quality.frame()
+
+  def _finish(self):
+    '''Reports on and closes everything at the end of `run`.'''
+    if self.quality.changes:
+      print 'quality:'
+      for line in self.quality.report(): print ' ', line
+    self.profiler.stop()
+    if self.recorder is not None:
+      self.recorder.close()
+    if self.timings is not None:
+      self.stats.export(self.timings)
+
+  def run_pipelined(self):
+    '''Runs the game's main loop as a pipeline of two threads: this one reads
+    input and draws, while a simulation thread (see `_simulate`) ticks at the
+    tick rate.  After each tick the simulation publishes a `RenderFrame` to a
+    `FrameBuffer`, and this thread draws the newest, so drawing one frame
+    overlaps with simulating the next instead of waiting for it.
+
+    Anything this thread does to the game itself (e.g. saving or restoring
+    it) is done holding `self.lock`, which the simulation holds for each
+    tick.  A profile (see `Profiler`) covers only the ticks.'''
+    self.start()
+    inbox = Queue.Queue()
+    frames = self.frame_buffer = FrameBuffer()
+    stop = threading.Event()
+    errors = []
+    sim = threading.Thread(target=self._simulate, name='simulation',
+                           args=(inbox, frames, stop, errors))
+    sim.daemon = True
+    step = self.clock.step / 1000.
+    sim.start()
+    try:
+      while sim.is_alive():
+        stats = self.stats
+        with stats.phase('wait'):
+          self.fps_timer.tick(self.fps)
+        with stats.phase('input'):
+          with self.lock:
+            inbox.put(self._read_input())
+          pygame.event.clear()
+        frame = frames.take(step)
+        if frame is not None:
+          self._show(min((timer() - frame.published) / step, 1.), frame)
+        with self.lock:
+          # Not mid-tick, so a capture never ends inside the profiled block.
+          self.profiler.frame()
+      if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    finally:
+      stop.set()
+      sim.join()
+      if self.stats.timing:
+        print self.pipeline_report()
+      self._finish()
+
+  def pipeline_report(self):
+    '''Reports how many frames `run_pipelined` published and how many of
+    them it never drew.'''
+    return 'pipeline: %d frames published, %d dropped undrawn' % (
+        self.frame_buffer.published, self.frame_buffer.dropped)
+
+  def _simulate(self, inbox, frames, stop, errors):
+    '''The simulation thread of `run_pipelined`.  Once per tick, this takes
+    the input read since the last tick (see `step`), ticks, and publishes
+    the result.
 
-      ####################################################################
-      #                            User Input                            #
-      ####################################################################
+    Args:
+      inbox, Queue.Queue: The (axes, actions) of each frame of input.
+      frames, FrameBuffer: Where to publish frames.
+      stop, threading.Event: Set to stop the thread.
+      errors, list: Where to put the `sys.exc_info()` of an error that stops
+                    the thread.
+    '''
+    step = self.clock.step / 1000.
+    axes, actions = None, []
+    due = timer()
+    try:
+      while not stop.is_set():
+        while True:
+          try:
+            axes, more = inbox.get_nowait()
+          except Queue.Empty:
+            break
+          actions.extend(more)
+        with self.lock:
+          self.stats.reset()
+          self.remember()
+          self.step(axes, actions)
+          frames.publish(RenderFrame.capture(self))
+        actions = []
+
+        due += step
+        delay = due - timer()
+        if delay > 0:
+          time.sleep(delay)
+        elif delay < -self.MAX_TICKS_PER_FRAME * step:
+          due = timer()  # Too far behind to catch up: slow down instead.
+    except BaseException:
+      errors.append(sys.exc_info())
+
+  def step(self, axes, actions):
+    '''Feeds (see `feed`) and records one frame of input, then ticks unless
+    the game is paused.  A replay does the same with each frame of the log.'''
+    if self.recorder is not None:
+      axes = self.recorder.write(axes, actions)
+    self.feed(axes, actions)
+    if not self.paused:
+      with self.profiler:
+        self.tick()
+
+  def remember(self):
+    '''Notes where everything is before a tick, to draw between there and
+    where the tick moves it.'''
+    self.player_prev = (self.player.pos[0], self.player.pos[1])
+    self.space.remember()
+
+  def _read_input(self):
+    '''Reads one frame of input from the devices.
 
-      # Quitting and special keys.
-      for event in pygame.event.get([pygame.QUIT, pygame.KEYUP]):
-        if event.type == pygame.QUIT:
+    Returns:
+      (axes, actions): See `feed`.
+    '''
+    actions = []
+    # Shed (or restore) work to keep up the frame rate.  This is an action so
+    # that a replay sheds the same simulation work at the same time.
+    step = self.quality.check(self.fps_timer.get_fps())
+    if step:
+      actions.append(self.ACTIONS.index('quality_down' if step > 0 else
+                                        'quality_up'))
+
+
+    ####################################################################
+    #                            User Input                            #
+    ####################################################################
+
+    # Quitting and special keys.
+    for event in pygame.event.get([pygame.QUIT, pygame.KEYUP]):
+      if event.type == pygame.QUIT:
+        sys.exit()
+      if event.type == pygame.KEYUP:
+        if ((event.key == pygame.K_q or event.key == pygame.K_w) and
+            (event.mod == pygame.K_RCTRL or event.mod == pygame.K_LCTRL)):
           sys.exit()
-        if event.type == pygame.KEYUP:
-          if ((event.key == pygame.K_q or event.key == pygame.K_w) and
-              (event.mod == pygame.K_RCTRL or event.mod == pygame.K_LCTRL)):
-            sys.exit()
-          elif event.key == pygame.K_F7:
-            random.choice(self.spawn_points).spawn()
-          elif event.key == pygame.K_RIGHTBRACKET:
-            self.player.gun.power += 1
-          elif event.key == pygame.K_LEFTBRACKET:
-            if self.player.gun.power > 0:
-              self.player.gun.power -= 1
-          elif event.key == pygame.K_0:
-            self.player.shields += 1
-          elif event.key == pygame.K_9:
-            if self.player.shields > 0:
-              self.player.shields -= 1
-          elif event.key == pygame.K_p:
-            self.paused = not self.paused
-          elif event.key == pygame.K_F6:
-            print 'stats:'
-            print '  Num Baddies:', len(self.space.baddies)
-            print '  Num Bullets:', len(self.space.bullets)
-      pygame.event.clear()
-
-      if not self.paused: self.tick()
-
-
-
-      ####################################################################
-      #                         Drawing Process                          #
-      ####################################################################
+        elif event.key in self.KEY_ACTIONS:
+          actions.append(self.ACTIONS.index(self.KEY_ACTIONS[event.key]))
+        elif event.key == pygame.K_F6:
+          print 'stats:'
+          print '  Num Baddies:', len(self.space.baddies)
+          print '  Num Bullets:', len(self.space.bullets)
+          if self.frame_buffer is not None:
+            print self.pipeline_report()
+          print 'pools:'
+          for line in Pool.report(): print ' ', line
+          print 'memory:'
+          for line in Entity.report(self.entities()): print ' ', line
+        elif event.key == pygame.K_F10:
+          self.profiler.start()
+        elif event.key == pygame.K_F5:
+          self.stats.enable_timing(not self.stats.timing)
+        elif event.key in (pygame.K_F8, pygame.K_F9) and \
+             (self.recorder is not None or self.replay is not None):
+          # Neither is in the input log, and both change the game (saving
+          # compacts the baddies, changing the order they tick in).
+          print "Can't save or restore while recording or replaying."
+        elif event.key == pygame.K_F8:
+          path = self.save_state or self.STATE_FILE
+          Snapshot.capture(self).save(path)
+          print 'Saved', path
+        elif event.key == pygame.K_F9:
+          path = self.save_state or self.load_state or self.STATE_FILE
+          if os.path.exists(path):
+            Snapshot.load(path).restore(self)
+            print 'Restored', path
+    return self.user_input.poll(), actions
+
+  def draw(self, alpha=1., frame=None):
+    '''Draws everything onto the screen (but does not flip it).
 
-      self.screen.fill((0,0,0))
+    Args:
+      alpha, float: How far between the last two ticks to draw things (see
+                    `remember`).
+      frame, RenderFrame: What to draw (see `run_pipelined`).  Defaults to
+                          the game as it is now, drawn straight from it.
 
-      for s in self.spawn_points: s.draw()
-
-      self.space.draw()
-
-      if self.lev_i < len(self.levels):
-        self.levels[self.lev_i].draw()
-
-      if self.winner:
-        self.screen.blit(self.winner_font.render("WINNER", False,
-            (255,255,255)), self.winner_pos)
-      elif self.player.exploding:
-        self.screen.blit(self.gameover_font.render("GAME OVER", False,
-            (255,255,255)), self.gameover_pos)
-      elif self.paused:
-        self.screen.blit(self.pause_font.render("Paused", False,
-            (255,255,255)), self.pause_pos)
-      self.screen.blit(self.score_font.render('%d' % self.player.score,
-          False, (255,255,255)), (10,10))
-      #self.screen.blit(self.score_font.render('{:,}'.format(self.score),
-      #    False, (255,255,255)), (10,10))
-
-      self.player.draw()
-      self.stats.counts['FPS'] = self.fps_timer.get_fps()
-      self.stats.draw()
-      pygame.display.flip()
+    Returns:
+      [pygame.Rect]: The areas of the screen drawn on (some may be None).
+    '''
+    if frame is not None:
+      return self._draw_frame(alpha, frame)
+    rects = []
+    for s in self.spawn_points: s.draw()
+
+    rects.extend(self.space.draw(alpha))
+
+    if self.lev_i < len(self.levels):
+      rects.append(self.levels[self.lev_i].draw())
+
+    rects.extend(self._draw_hud(self.winner, self.player.exploding,
+                                self.paused, self.player.score))
+    rects.extend(self.player.draw(lerp(self.player_prev, self.player.pos,
+                                       alpha)))
+    self.stats.counts['FPS'] = self.fps_timer.get_fps()
+    rects.extend(self.stats.draw())
+    return rects
+
+  def _draw_frame(self, alpha, frame):
+    '''Draws a `RenderFrame` (see `draw`).'''
+    screen = self.screen
+    rects = []
+    for s in self.spawn_points: s.draw()
+
+    for kind, look, p0, p1 in zip(frame.kinds, frame.looks, frame.prev,
+                                  frame.pos):
+      rects.append(kind.draw_look(screen, lerp(p0, p1, alpha), look))
+    p0, p1 = frame.bullet_prev, frame.bullet_pos
+    rects.extend(Bullet.draw_all(screen,
+        p1 if alpha >= 1 else p0 + alpha * (p1 - p0), frame.bullet_traj))
+
+    if frame.greeting is not None:
+      w, h = self.greeting_font.size(frame.greeting)
+      rects.append(TextCache.get_cache().draw(screen, self.greeting_font,
+          frame.greeting, ((self.width - w) / 2, (self.height - h) / 2)))
+
+    rects.extend(self._draw_hud(frame.winner, frame.exploding, frame.paused,
+                                frame.score))
+    rects.extend(Player.draw_look(screen, lerp(frame.player_prev,
+        frame.player_pos, alpha), frame.player_look))
+    rects.extend(self.stats.draw(frame.counts))
+    return rects
+
+  def _draw_hud(self, winner, exploding, paused, score):
+    '''Draws the banner for how the game stands (if any) and the score.
+
+    Returns:
+      [pygame.Rect]: The areas of the screen drawn on.
+    '''
+    text = TextCache.get_cache()
+    rects = []
+    if winner:
+      rects.append(text.draw(self.screen, self.winner_font, "WINNER",
+                             self.winner_pos))
+    elif exploding:
+      rects.append(text.draw(self.screen, self.gameover_font, "GAME OVER",
+                             self.gameover_pos))
+    elif paused:
+      rects.append(text.draw(self.screen, self.pause_font, "Paused",
+                             self.pause_pos))
+    rects.append(text.draw(self.screen, self.score_font,
+                           '%d' % score, (10,10), glyphs=True))
+    #self.screen.blit(self.score_font.render('{:,}'.format(self.score),
+    #    False, (255,255,255)), (10,10))
+    return rects
+
+  def run_headless(self, ticks=None):
+    '''Runs the simulation with no display and no frame cap, as fast as it
+    will go, then reports the tick rate.
+
+    Args:
+      ticks, int: The number of ticks to run for.  If None, runs until the
+                  game is won, the replay (if any) runs out, or until
+                  interrupted.
+
+    Returns:
+      float: The number of ticks per second achieved.
+    '''
+    self.start()
+    frames = self.replay.frames() if self.replay is not None else None
+    n = 0
+    start = time.time()
+    try:
+      while (ticks is None or n < ticks) and not self.winner:
+        if frames is not None:
+          axes, actions = next(frames, (None, None))
+          if actions is None:
+            break
+        else:
+          axes, actions = None, ()
+        # Through `step`, so that --record logs the frame.
+        self.step(axes, actions)
+        if self.paused:
+          if frames is None:
+            break  # Nothing will unpause it.
+          continue
+        self.profiler.frame()
+        n += 1
+    except KeyboardInterrupt:
+      pass
+    self.profiler.stop()
+    if self.recorder is not None:
+      self.recorder.close()
+    secs = time.time() - start
+    tps = n / secs if secs > 0 else float('inf')
+    print '%d ticks in %.3fs: %.1f ticks/s' % (n, secs, tps)
+    for line in Pool.report(): print line
+    for line in Entity.report(self.entities()): print line
+    if self.stats.timing:
+      print '%-8s %8s %8s %8s %8s' % ('ms', 'mean', 'p50', 'p95', 'p99')
+      for name, s in self.stats.timings():
+        print '%-8s %8.3f %8.3f %8.3f %8.3f' % (name, s['mean'], s['p50'],
+                                                s['p95'], s['p99'])
+    if self.timings is not None:
+      self.stats.export(self.timings)
+      print 'Wrote', self.timings
+    if self.save_state is not None:
+      Snapshot.capture(self).save(self.save_state)
+      print 'Saved', self.save_state
+    return tps
+
+  def entities(self):
+    '''Gets every live entity: the player, baddies, upgrades and bullets.'''
+    return ([self.player] + list(self.space.baddies) +
+            list(self.space.bullets))
 
   def spawn_points_empty(self):
     for sp in self.spawn_points:
@@ -1224,10 +4226,21 @@ class Main(object):
     return cls.MAIN_OBJECT
 
 
-def parse_args():
-  '''Parses the command line arguments and returns an option object.'''
+def parse_args(argv=None):
+  '''Parses the command line arguments and returns an option object.
+
+  Args:
+    argv, [str]: The arguments to parse.  Defaults to `sys.argv[1:]`.
+  '''
   ap = argparse.ArgumentParser()
-  ap.set_defaults(size='800x600', fps=30, min_fps=25)
+  ap.set_defaults(size='800x600', fps=30, tick_rate=30, min_fps=25,
+                  headless=False,
+                  ticks=None, seed=None, dirty_rects=False,
+                  dirty_threshold=.5, broadphase='grid', record=None,
+                  replay=None, load_state=None, save_state=None,
+                  timings=False, timings_out=None, profile=None,
+                  profile_mode='sample', profile_out='profile',
+                  pipeline=False)
 
   #ap.add_argument('-C', '--config', help="Use a different config file.")
   #ap.add_argument('-j', '--input', dest='input_type',
@@ -1236,10 +4249,63 @@ def parse_args():
   ap.add_argument('-s', '--size', type=str,
                   help="Set the window resolution.")
   ap.add_argument('-f', '--fps', type=int,
-                  help="Set the frame rate.")
+                  help="Set the (most) frames drawn per second.")
+  ap.add_argument('--tick-rate', type=int,
+                  help="Set the simulation ticks per second.  The game "
+                       "plays the same at any rate; lower rates cost less, "
+                       "higher ones move more smoothly.")
   ap.add_argument('-m', '--min-fps', type=int,
-                  help="Set the minimum frame rate.")
-  args = ap.parse_args()
+                  help="Set the minimum frame rate: below it, drawing and "
+                       "then simulation detail are shed until it recovers.")
+  ap.add_argument('-H', '--headless', action='store_true',
+                  help="Run the simulation only: no display, no frame cap.")
+  ap.add_argument('-t', '--ticks', type=int,
+                  help="Stop a headless run after this many ticks.")
+  ap.add_argument('-S', '--seed', type=int,
+                  help="Seed the random number streams (for reproducible runs).")
+  ap.add_argument('-d', '--dirty-rects', action='store_true',
+                  help="Only redraw and update the parts of the screen that "
+                       "changed.")
+  ap.add_argument('--dirty-threshold', type=float,
+                  help="Fraction of the screen that, once changed, makes a "
+                       "dirty-rects frame do a full flip instead.")
+  ap.add_argument('-b', '--broadphase', choices=CollisionSpace.BROADPHASES,
+                  help="How to find what may collide: a uniform grid (grid), "
+                       "sort-and-sweep on the X axis (sap) or a loose "
+                       "quadtree (quadtree).")
+  ap.add_argument('-r', '--record', metavar='FILE',
+                  help="Record the game's input to this file.")
+  ap.add_argument('-R', '--replay', metavar='FILE',
+                  help="Replay the game recorded in this file, as fast as "
+                       "possible (with --headless, without drawing).")
+  ap.add_argument('-L', '--load-state', metavar='FILE',
+                  help="Start from the game saved in this snapshot (see "
+                       "--save-state).")
+  ap.add_argument('--save-state', metavar='FILE',
+                  help="Save a snapshot of the game to this file at the end "
+                       "of a headless run, or when F8 is pressed (F9 "
+                       "restores it).")
+  ap.add_argument('-T', '--timings', action='store_true',
+                  help="Time each phase of every frame, showing the latest "
+                       "p50/p95/p99 on screen (F5 toggles this).")
+  ap.add_argument('--timings-out', metavar='FILE',
+                  help="Time each phase (as --timings) and write the timings "
+                       "to this file on exit: CSV if it ends in .csv, "
+                       "otherwise JSON.")
+  ap.add_argument('--pipeline', action='store_true',
+                  help="Simulate on a thread of its own, drawing the last "
+                       "tick while the next one runs (not when replaying).")
+  ap.add_argument('-P', '--profile', type=int, metavar='FRAMES',
+                  help="Profile the first FRAMES frames (F10 profiles the "
+                       "next 300, or FRAMES, at any time).")
+  ap.add_argument('--profile-mode', choices=Profiler.MODES,
+                  help="Profile with a low-overhead statistical sampler "
+                       "(sample) or with cProfile (cprofile).")
+  ap.add_argument('--profile-out', metavar='PREFIX',
+                  help="Where to write profiles: PREFIX.txt for the table of "
+                       "hot functions, plus PREFIX.collapsed (sample) or "
+                       "PREFIX.prof (cprofile).")
+  args = ap.parse_args(argv)
 
   try:
     args.size = map(int, args.size.split('x'))
@@ -1249,6 +4315,15 @@ def parse_args():
     if len(args.size) != 2:
       ap.error('Invalid size parameter: "%s"' % 'x'.join(args.size))
 
+  if args.replay is not None:
+    try:
+      log = InputLog.load(args.replay)
+    except (IOError, ValueError), e:
+      ap.error(str(e))
+    for k in InputLog.SETTINGS:
+      setattr(args, k, log.settings[k])
+    args.seed = log.seed
+
   if args.min_fps > args.fps:
     print 'Warning! min_fps:%d > fps:%d' % (args.min_fps, args.fps)
     args.min_fps = args.fps
@@ -1257,4 +4332,10 @@ def parse_args():
 
 
 if __name__ == '__main__':
-  Main.get_main(parse_args()).run()
+  options = parse_args()
+  if options.headless:
+    Main.get_main(options).run_headless(options.ticks)
+  elif options.pipeline and options.replay is None:
+    Main.get_main(options).run_pipelined()
+  else:
+    Main.get_main(options).run()
@@ -0,0 +1,900 @@
+#!/usr/bin/env python
+#
+# Line Battles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Runs a game as an authoritative server, streaming its state to clients
+over TCP.
+
+The server simulates one headless `main.Main` at its tick rate.  Any client
+may steer the player, by sending frames of input as an `main.InputLog`
+records them; every client gets, each tick, the state of what is in its
+area of interest (its view, centered on the player or on a point of its
+choosing):
+
+  - positions quantized to 1/`SCALE` of a pixel and headings to a byte,
+  - as deltas against what that client was last sent: new entities in
+    full, known ones only if they changed (moves of under 32 pixels in a
+    byte per axis), and the handles of the ones that left its view,
+  - at most `MAX_RECORDS` entities and `MAX_BULLETS` bullets per tick.
+    Changes over budget are not lost, only late: the ones put off longest
+    go first in the next update.
+
+Which entities are in a view is found with the game\'s own broadphase (the
+bin grid, by default), so the cost of an update grows with what is in the
+view rather than with everything in the arena.  Updates are not even
+encoded for a client that has more than `MAX_BACKLOG` bytes still unsent.
+
+The server reports bytes sent per client per tick, and the time spent
+simulating and encoding each tick.
+
+Usage:
+  server.py serve [--port 7777] [-S SEED] [--baddies N] ...
+  server.py client [--port 7777] [--view 400x300] [--at X,Y] [--bot spin]
+  server.py loadtest [-c CLIENTS] [-t TICKS] [--baddies N] [-o out.json]
+'''
+
+import sys
+import json
+import math
+import time
+import random
+import socket
+import struct
+import asyncore
+import argparse
+import itertools
+import collections
+from timeit import default_timer as timer
+
+import numpy
+
+import main
+import bench
+
+
+################################################################################
+#                                   Protocol                                   #
+################################################################################
+
+VERSION = 1
+
+MESSAGE = struct.Struct('<IB')
+'''Every message: the length of its body, its type, then the body.'''
+
+MAX_MESSAGE = 1 << 20
+
+# Client to server.
+VIEW = 1    # VIEW_BODY: the client\'s area of interest.
+INPUT = 2   # One frame of input (see `main.InputLog.pack`), without the
+            # quality actions (`LOCAL_ACTIONS`).
+
+# Server to client.
+WELCOME = 1  # JSON: the game\'s settings and how to decode states.
+STATE = 2    # One tick (see `StateEncoder`).
+
+VIEW_BODY = struct.Struct('<hhHH')
+'''The center (or -1,-1 to follow the player), width and height of a view.'''
+
+STATE_HEADER = struct.Struct('<IHHBBBBIHHH')
+'''The tick number; the player\'s position, heading, shields (up to 255),
+explosion progress and flags (`EXPLODING`, `WINNER`, `PAUSED`) and score;
+then the number of removed handles (uint32 each), entity records and bullets
+(`BULLET` each) that follow, in that order.'''
+
+EXPLODING, WINNER, PAUSED = 1, 2, 4
+
+# The parts of an entity record, after its uint32 handle and uint8 mask.
+NEW = 0x80     # uint8 kind (see `main.Snapshot.KINDS`), uint16 x, y, uint8
+               # heading: an entity the client does not know yet.
+MOVED = 0x01   # int8 dx, dy: moved by less than 128 / `SCALE` pixels.
+JUMPED = 0x02  # uint16 x, y: moved farther.
+TURNED = 0x04  # uint8 heading.
+
+RECORDS = { NEW: struct.Struct('<IBBHHB') }
+for mask in xrange(8):
+  if not mask & MOVED or not mask & JUMPED:
+    RECORDS[mask] = struct.Struct('<IB' + ('bb' if mask & MOVED else '') +
+                                  ('HH' if mask & JUMPED else '') +
+                                  ('B' if mask & TURNED else ''))
+RECORD_HEAD = RECORDS[0]
+
+BULLET = numpy.dtype([('x', '<u2'), ('y', '<u2'), ('heading', 'u1'),
+                      ('side', 'u1')])
+
+SCALE = 4
+'''Positions are sent in 1/SCALE pixels.'''
+
+KINDS = [getattr(main, k) for k in main.Snapshot.KINDS]
+KIND_CODES = dict((k, i) for i, k in enumerate(KINDS))
+
+DEFAULT_VIEW = (800, 600)
+
+LOCAL_ACTIONS = frozenset(main.Main.ACTIONS.index(a) for a in
+                          ('quality_down', 'quality_up'))
+'''Actions clients may not send: they shed work to keep up a frame rate,
+which the (headless) server does not have.'''
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def quantize(v):
+  '''Quantizes a coordinate (in pixels) to a uint16.'''
+  return min(max(int(v * SCALE + .5), 0), 0xffff)
+
+
+def quantize_heading(heading):
+  '''Quantizes a `main.ShipGeometry` heading index to a byte.'''
+  return heading * 256 // main.ShipGeometry.STEPS
+
+
+################################################################################
+#                                   Encoding                                   #
+################################################################################
+
+class TickState(object):
+  '''The parts of one tick that every client\'s update is made of, quantized
+  once for all of them.  Entities are only quantized once some client needs
+  them.'''
+
+  def __init__(self, game, tick, fresh=()):
+    '''
+    Args:
+      game, main.Main: The game, just ticked.
+      tick, int: The number of the tick.
+      fresh, [Entity]: Entities added since the broadphase was last updated
+                       (which the broadphase does not know of yet).
+    '''
+    space = game.space
+    self.index = space.baddies.index
+    self.handle = space.baddies.handle
+    self.fresh = fresh
+    self.cache = {}
+
+    n = space.bullets.n
+    self.bullet_pos = space.bullets.pos[:n]
+    self.bullets = numpy.empty(n, BULLET)
+    q = numpy.clip(self.bullet_pos * SCALE + .5, 0, 0xffff)
+    self.bullets['x'] = q[:,0]
+    self.bullets['y'] = q[:,1]
+    turns = numpy.mod(space.bullets.traj[:n], 2 * math.pi) / (2 * math.pi)
+    self.bullets['heading'] = (turns * 256).astype(numpy.intp) % 256
+    self.bullets['side'] = space.bullets.side[:n]
+
+    player = game.player
+    look = player.look()
+    flags = ((EXPLODING if player.exploding else 0) |
+             (WINNER if game.winner else 0) | (PAUSED if game.paused else 0))
+    self.head = (tick, quantize(player.pos[0]), quantize(player.pos[1]),
+                 quantize_heading(look[0]), min(player.shields, 255),
+                 min(int(player.expl_prog), 255), flags,
+                 min(player.score, 0xffffffff))
+    self.player_pos = (player.pos[0], player.pos[1])
+
+  def entity(self, e):
+    '''Gets (kind, x, y, heading) of the entity `e`, quantized.'''
+    q = self.cache.get(e)
+    if q is None:
+      q = self.cache[e] = (KIND_CODES[type(e)], quantize(e.pos[0]),
+          quantize(e.pos[1]),
+          quantize_heading(e.look()) if isinstance(e, main.Ship) else 0)
+    return q
+
+  def inside(self, e, box):
+    '''Whether the entity `e` is inside `box` (left, top, right, bottom).'''
+    left, top, right, bottom = box
+    return left <= e.pos[0] < right and top <= e.pos[1] < bottom
+
+  def bullets_in(self, box):
+    '''Gets the bullets inside `box` (left, top, right, bottom).'''
+    left, top, right, bottom = box
+    pos = self.bullet_pos
+    return self.bullets[(pos[:,0] >= left) & (pos[:,0] < right) &
+                        (pos[:,1] >= top) & (pos[:,1] < bottom)]
+
+
+class StateEncoder(object):
+  '''Encodes the updates for one client: what has changed in its view since
+  the last update it was sent.  A TCP connection delivers every update, in
+  order, so each is a delta against the last one sent.'''
+
+  MARGIN = 32
+  '''How far outside the view things are still sent (in pixels), so they do
+  not pop in at the edges.'''
+
+  MAX_RECORDS = 256
+  MAX_BULLETS = 256
+
+  def __init__(self, view=DEFAULT_VIEW):
+    self.sent = {}  # handle -> (kind, x, y, heading), as the client has it
+    self.waiting = {}  # handle -> the update its change was first put off
+    self.updates = 0
+    self.deferred = 0  # Changes left for later, over `MAX_RECORDS`.
+    self.most_changed = 0  # The most changes in any one update.
+    self.most_waited = 0  # The most updates any change was put off for.
+    self.set_view(-1, -1, *view)
+
+  def set_view(self, cx, cy, w, h):
+    '''Sets the area of interest (see `VIEW_BODY`).'''
+    self.center = None if cx < 0 else (cx, cy)
+    self.half = w / 2. + self.MARGIN, h / 2. + self.MARGIN
+
+  def box(self, player_pos):
+    '''Gets the area of interest as (left, top, right, bottom).'''
+    cx, cy = self.center or player_pos
+    hw, hh = self.half
+    return cx - hw, cy - hh, cx + hw, cy + hh
+
+  def longest_wait(self):
+    '''Gets the most updates any change has been put off for, sent or not.
+    The oldest changes going first, this is at most the most changes in one
+    update over `MAX_RECORDS`.'''
+    if not self.waiting:
+      return self.most_waited
+    return max(self.most_waited,
+               self.updates - min(self.waiting.itervalues()))
+
+  def encode(self, world, box, buckets):
+    '''Encodes an update, and takes it as sent.  If more than `MAX_RECORDS`
+    entities changed, the changes put off the longest go first, so every
+    change gets its turn however many entities keep changing.
+
+    Args:
+      world, TickState: The tick.
+      box, (float,float,float,float): The area of interest (see `box`).
+      buckets, [list]: Buckets of entities holding all of those in `box`
+                       (see `main.Broadphase`), but for
+                       `world.fresh`.
+
+    Returns:
+      str: The body of a `STATE` message.
+    '''
+    left, top, right, bottom = box
+    index, handle, entity = world.index, world.handle, world.entity
+    seen = {}
+    for cell in itertools.chain(buckets, (world.fresh,)):
+      for e in cell:
+        if e in index:
+          x, y = e.pos
+          if left <= x < right and top <= y < bottom:
+            seen[handle(e)] = entity(e)
+
+    sent = self.sent
+    removed = [h for h in sent if h not in seen]
+    for h in removed:
+      del sent[h]
+
+    changed = [h for h, q in seen.iteritems() if sent.get(h) != q]
+    waiting = self.waiting
+    if waiting:
+      for h in [h for h in waiting if h not in seen or sent.get(h) == seen[h]]:
+        del waiting[h]
+    self.most_changed = max(self.most_changed, len(changed))
+    if len(changed) > self.MAX_RECORDS:
+      changed.sort(key=lambda h: waiting.get(h, self.updates))
+      for h in changed[self.MAX_RECORDS:]:
+        waiting.setdefault(h, self.updates)
+      self.deferred += len(changed) - self.MAX_RECORDS
+      del changed[self.MAX_RECORDS:]
+
+    records = []
+    for h in changed:
+      since = waiting.pop(h, None)
+      if since is not None:
+        self.most_waited = max(self.most_waited, self.updates - since)
+      q, old = seen[h], sent.get(h)
+      if old is None:
+        records.append(RECORDS[NEW].pack(h, NEW, *q))
+      else:
+        mask, fields = 0, []
+        dx, dy = q[1] - old[1], q[2] - old[2]
+        if dx or dy:
+          if -128 <= dx < 128 and -128 <= dy < 128:
+            mask |= MOVED
+            fields += (dx, dy)
+          else:
+            mask |= JUMPED
+            fields += q[1:3]
+        if q[3] != old[3]:
+          mask |= TURNED
+          fields.append(q[3])
+        records.append(RECORDS[mask].pack(h, mask, *fields))
+      sent[h] = q
+
+    self.updates += 1
+
+    bullets = world.bullets_in(box)[:self.MAX_BULLETS]
+    head = STATE_HEADER.pack(*(world.head + (len(removed), len(records),
+                                             len(bullets))))
+    return ''.join([head, struct.pack('<%dI' % len(removed), *removed)] +
+                   records + [bullets.tobytes()])
+
+
+class StateDecoder(object):
+  '''Keeps a client\'s copy of what it can see up to date, from the updates
+  a `StateEncoder` sends it.'''
+
+  def __init__(self):
+    self.entities = {}  # handle -> (kind, x, y, heading), quantized
+    self.bullets = numpy.empty(0, BULLET)
+    self.tick = None
+    self.player = None  # (x, y, heading, shields, expl_prog, flags, score)
+
+  def decode(self, body):
+    '''Applies the update `body` (of a `STATE` message).
+
+    Throws:
+      ProtocolError: If the update is malformed or does not apply.
+    '''
+    try:
+      head = STATE_HEADER.unpack_from(body)
+      self.tick = head[0]
+      self.player = head[1:8]
+      n_removed, n_records, n_bullets = head[8:]
+      off = STATE_HEADER.size
+      entities = self.entities
+      for h in struct.unpack_from('<%dI' % n_removed, body, off):
+        del entities[h]
+      off += 4 * n_removed
+      for i in xrange(n_records):
+        mask = RECORD_HEAD.unpack_from(body, off)[1]
+        record = RECORDS[mask]
+        fields = record.unpack_from(body, off)
+        off += record.size
+        h = fields[0]
+        if mask == NEW:
+          entities[h] = fields[2:]
+          continue
+        kind, x, y, heading = entities[h]
+        if mask & MOVED:
+          x += fields[2]
+          y += fields[3]
+        elif mask & JUMPED:
+          x, y = fields[2:4]
+        if mask & TURNED:
+          heading = fields[-1]
+        entities[h] = (kind, x, y, heading)
+      self.bullets = numpy.frombuffer(body, BULLET, n_bullets, off)
+      off += BULLET.itemsize * n_bullets
+    except (struct.error, KeyError, ValueError), e:
+      raise ProtocolError('Bad state update: %r' % e)
+    if off != len(body):
+      raise ProtocolError('Bad state update: %d bytes too many' %
+                          (len(body) - off))
+
+
+################################################################################
+#                                 Connections                                  #
+################################################################################
+
+class Connection(asyncore.dispatcher):
+  '''Either end of a connection: frames messages (see `MESSAGE`) both ways,
+  handing each one received to `on_message(kind, body)`, which subclasses
+  must define.  It may raise `ProtocolError` to drop the connection.'''
+
+  def __init__(self, sock=None, map=None):
+    asyncore.dispatcher.__init__(self, sock, map)
+    self.inbuf = ''
+    self.outbox = []
+    self.backlog = 0  # Bytes queued but not yet sent.
+
+  def send_message(self, kind, body):
+    '''Queues a message.
+
+    Returns:
+      int: Its size, in bytes.
+    '''
+    data = MESSAGE.pack(len(body), kind) + body
+    self.outbox.append(data)
+    self.backlog += len(data)
+    return len(data)
+
+  def writable(self):
+    return self.connecting or bool(self.outbox)
+
+  def handle_write(self):
+    data = ''.join(self.outbox)
+    n = self.send(data)
+    self.outbox = [data[n:]] if n < len(data) else []
+    self.backlog -= n
+
+  def handle_read(self):
+    self.inbuf += self.recv(1 << 16)
+    buf, off = self.inbuf, 0
+    try:
+      while len(buf) - off >= MESSAGE.size:
+        n, kind = MESSAGE.unpack_from(buf, off)
+        if n > MAX_MESSAGE:
+          raise ProtocolError('Message too long: %d bytes' % n)
+        end = off + MESSAGE.size + n
+        if end > len(buf):
+          break
+        self.on_message(kind, buf[off + MESSAGE.size:end])
+        off = end
+    except ProtocolError, e:
+      print '%s: %s' % (self.addr, e)
+      self.close()
+    self.inbuf = buf[off:]
+
+  def handle_connect(self):
+    pass
+
+  def handle_close(self):
+    self.close()
+
+
+class Peer(Connection):
+  '''The server\'s end of a connection to one client.'''
+
+  def __init__(self, server, sock, map):
+    Connection.__init__(self, sock, map)
+    self.server = server
+    self.encoder = StateEncoder()
+    self.updates = 0
+
+  def on_message(self, kind, body):
+    if kind == VIEW:
+      try:
+        self.encoder.set_view(*VIEW_BODY.unpack(body))
+      except struct.error:
+        raise ProtocolError('Bad view')
+    elif kind == INPUT:
+      try:
+        axes, actions, end = main.InputLog.unpack_from(body)
+      except struct.error:
+        raise ProtocolError('Bad input')
+      if end != len(body) or any(a >= len(main.Main.ACTIONS) or
+                                 a in LOCAL_ACTIONS for a in actions):
+        raise ProtocolError('Bad input')
+      self.server.inputs.append((axes, actions))
+    else:
+      raise ProtocolError('Unknown message type: %d' % kind)
+
+  def handle_close(self):
+    print 'Client %s:%d left' % self.addr
+    self.close()
+
+
+class Server(asyncore.dispatcher):
+  '''Listens for clients, and runs the game for them.'''
+
+  MAX_BACKLOG = 1 << 16
+  '''Clients with more bytes than this still to send get no update.'''
+
+  WINDOW = 3000
+  '''How many of the latest update sizes to keep for `report`.'''
+
+  def __init__(self, game, host='127.0.0.1', port=0, scenario=None,
+               map=None):
+    '''Creates a server and starts listening.
+
+    Args:
+      game, main.Main: The game, started.
+      host, str: The address to listen on.
+      port, int: The port to listen on (0 picks a free one; see `port`).
+      scenario, bench.Scenario: Keeps the game topped up with baddies (if
+                                given).
+      map, dict: The asyncore socket map to use.
+    '''
+    self.map = {} if map is None else map
+    asyncore.dispatcher.__init__(self, map=self.map)
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(16)
+    self.port = self.getsockname()[1]
+
+    assert max(game.size) * SCALE <= 0xffff, \
+        'Arena too big to quantize: %dx%d' % tuple(game.size)
+    self.game = game
+    self.scenario = scenario
+    self.peers = []
+    self.inputs = []  # (axes, actions) received since the last tick
+    self.axes = None
+    self.fresh = []  # Entities added since the broadphase was updated.
+    self.ticks = 0
+    self.stats = game.stats
+    self.stats.enable_timing(True)
+    self.bytes = collections.deque(maxlen=self.WINDOW)
+    self.sent = self.skipped = 0
+    self.welcome = json.dumps({ 'version': VERSION,
+                                'size': list(game.size),
+                                'tick_rate': 1000. / game.clock.step,
+                                'scale': SCALE,
+                                'kinds': main.Snapshot.KINDS,
+                                'actions': main.Main.ACTIONS })
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+    sock, addr = pair
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    peer = Peer(self, sock, self.map)
+    peer.send_message(WELCOME, self.welcome)
+    self.peers.append(peer)
+    print 'Client %s:%d joined' % addr
+
+  def tick(self):
+    '''Runs one tick on the input received since the last, and sends every
+    client its update.  The latest axes received win (or the last ones, if
+    none were); every action received is done.'''
+    actions = []
+    for axes, acts in self.inputs:
+      self.axes = axes
+      actions.extend(acts)
+    del self.inputs[:]
+    self.stats.reset()
+    baddies = self.game.space.baddies
+    first = baddies.next_handle
+    self.game.step(self.axes, actions)
+    if self.scenario is not None:
+      self.scenario.fill(self.game)
+    # Most entities added this tick were added after the broadphase was
+    # updated (upgrades dropped by kills, spawns), so are looked up by handle.
+    self.fresh = [e for e in (baddies.get(h) for h in
+                              xrange(first, baddies.next_handle))
+                  if e is not None]
+    self.ticks += 1
+    with self.stats.phase('encode'):
+      self.broadcast()
+
+  def broadcast(self):
+    '''Sends every client (that is keeping up) its update.'''
+    self.peers = [p for p in self.peers if p.connected]
+    peers = [p for p in self.peers if p.backlog <= self.MAX_BACKLOG]
+    self.skipped += len(self.peers) - len(peers)
+    if not peers:
+      return
+    world = TickState(self.game, self.ticks, self.fresh)
+    boxes = [p.encoder.box(world.player_pos) for p in peers]
+    buckets = self.game.space.broadphase.query_boxes(
+        *numpy.array(boxes, dtype=float).T)
+    for peer, box, b in zip(peers, boxes, buckets):
+      n = peer.send_message(STATE, peer.encoder.encode(world, box, b))
+      peer.updates += 1
+      self.bytes.append(n)
+      self.sent += n
+
+  def run(self, ticks=None, report=None):
+    '''Ticks at the game\'s tick rate, serving clients between ticks.
+
+    Args:
+      ticks, int: The number of ticks to run for (forever if None).
+      report, float: Print a `report` every this many seconds (if given).
+    '''
+    step = self.game.clock.step / 1000.
+    due = timer()
+    next_report = due + report if report else None
+    while ticks is None or self.ticks < ticks:
+      delay = due - timer()
+      if delay > 0:
+        asyncore.loop(delay, map=self.map, count=1)
+        continue
+      self.tick()
+      due += step
+      if due < timer() - main.Main.MAX_TICKS_PER_FRAME * step:
+        due = timer()  # Too far behind to catch up: slow down instead.
+      if next_report is not None and timer() >= next_report:
+        print self.report()
+        sys.stdout.flush()
+        next_report += report
+
+  def summary(self):
+    '''Gets the server\'s metrics.
+
+    Returns:
+      {str: ...}: The bytes of each update ("bytes", see
+                  `bench.percentiles`), the time spent ticking and encoding
+                  each tick ("tick_ms", "encode_ms", see
+                  `main.PhaseTimer.summary`) and some totals.
+    '''
+    timings = dict(self.stats.timings())
+    space = self.game.space
+    return { 'ticks': self.ticks,
+             'clients': len(self.peers),
+             'entities': len(space.baddies),
+             'bullets': len(space.bullets),
+             'bytes': bench.percentiles(list(self.bytes)),
+             'tick_ms': timings.get('tick', {}),
+             'encode_ms': timings.get('encode', {}),
+             'sent': self.sent,
+             'skipped': self.skipped,
+             'deferred': sum(p.encoder.deferred for p in self.peers),
+             'longest_wait': max([p.encoder.longest_wait()
+                                  for p in self.peers] or [0]) }
+
+  def report(self):
+    '''Formats the latest metrics as one line.'''
+    s = self.summary()
+    b = s['bytes'] or dict.fromkeys(('p50', 'p95', 'max'), 0)
+    return ('tick %d: %d clients, %d entities, %d bullets | bytes/update '
+            'p50 %d p95 %d max %d | encode ms p50 %.3f p95 %.3f | '
+            'tick ms p50 %.3f p95 %.3f' % (s['ticks'], s['clients'],
+                s['entities'], s['bullets'], b['p50'], b['p95'], b['max'],
+                s['encode_ms'].get('p50', 0), s['encode_ms'].get('p95', 0),
+                s['tick_ms'].get('p50', 0), s['tick_ms'].get('p95', 0)))
+
+
+################################################################################
+#                                   Clients                                    #
+################################################################################
+
+class Client(Connection):
+  '''A headless client: keeps its copy of the game up to date (see
+  `StateDecoder`) and, if it has a bot, plays.'''
+
+  BOTS = ('watch', 'spin')
+  '''watch: sends no input.
+     spin: circles the arena, firing in a faster circle.'''
+
+  def __init__(self, host, port, view=DEFAULT_VIEW, at=None, bot='spin',
+               map=None):
+    '''Connects to a server.
+
+    Args:
+      host, str: The server\'s address.
+      port, int: The server\'s port.
+      view, (int,int): The width and height of the area of interest.
+      at, (int,int): Where its center is, or None to follow the player.
+      bot, str: One of `BOTS`.
+      map, dict: The asyncore socket map to use.
+    '''
+    assert bot in self.BOTS, 'Unknown bot: %s' % bot
+    Connection.__init__(self, map=map)
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.connect((host, port))
+    self.bot = bot
+    self.state = StateDecoder()
+    self.settings = None
+    self.updates = 0
+    self.bytes = []
+    self.decode_ms = []
+    cx, cy = at if at is not None else (-1, -1)
+    self.send_message(VIEW, VIEW_BODY.pack(cx, cy, *view))
+
+  def on_message(self, kind, body):
+    if kind == WELCOME:
+      self.settings = json.loads(body)
+      if self.settings.get('version') != VERSION:
+        raise ProtocolError('Server speaks version %s' %
+                            self.settings.get('version'))
+    elif kind == STATE:
+      t0 = timer()
+      self.state.decode(body)
+      self.decode_ms.append(1000. * (timer() - t0))
+      self.bytes.append(MESSAGE.size + len(body))
+      self.updates += 1
+      self.play()
+    else:
+      raise ProtocolError('Unknown message type: %d' % kind)
+
+  def play(self):
+    '''Sends the bot\'s input for the next tick.'''
+    if self.bot == 'watch':
+      return
+    t = self.state.tick
+    axes = (math.cos(t / 50.), math.sin(t / 50.),
+            math.cos(t / 7.), math.sin(t / 7.))
+    self.send_message(INPUT, main.InputLog.pack(axes, ())[0])
+
+  def summary(self):
+    return { 'updates': self.updates,
+             'bytes': bench.percentiles(self.bytes),
+             'decode_ms': bench.percentiles(self.decode_ms),
+             'entities': len(self.state.entities),
+             'bullets': len(self.state.bullets) }
+
+
+################################################################################
+#                                   Commands                                   #
+################################################################################
+
+def build_game(args):
+  '''Creates and starts the game to serve.
+
+  Returns:
+    (main.Main, bench.Scenario): The game, and the scenario keeping it full
+                                 of baddies (None for the usual levels).
+  '''
+  if args.baddies:
+    scenario = bench.Scenario(args.kind, args.baddies, 0, args.size,
+                              1 if args.seed is None else args.seed,
+                              args.broadphase)
+    return scenario.build(), scenario
+  argv = ['--headless', '--size', args.size, '--broadphase', args.broadphase,
+          '--tick-rate', str(args.tick_rate)]
+  if args.seed is not None:
+    argv += ['--seed', str(args.seed)]
+  if args.record is not None:
+    argv += ['--record', args.record]
+  if args.load_state is not None:
+    argv += ['--load-state', args.load_state]
+  game = main.Main.get_main(main.parse_args(argv))
+  game.start()
+  return game, None
+
+
+def write_results(path, args, results):
+  with open(path, 'w') as f:
+    json.dump({ 'meta': dict(vars(args), fn=None, time=time.time()),
+                'results': results }, f, indent=1, sort_keys=True)
+  print 'Wrote', path
+
+
+def cmd_serve(args):
+  game, scenario = build_game(args)
+  server = Server(game, args.host, args.port, scenario)
+  print 'Serving on %s:%d' % (args.host, server.port)
+  try:
+    server.run(args.ticks, args.report)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if game.recorder is not None:
+      game.recorder.close()
+  print server.report()
+  if args.output is not None:
+    write_results(args.output, args, { 'server': server.summary() })
+
+
+def cmd_client(args):
+  at = tuple(map(int, args.at.split(','))) if args.at else None
+  client = Client(args.host, args.port, parse_size(args.view), at, args.bot)
+  try:
+    while client.connected or client.connecting:
+      asyncore.loop(1., count=1)
+      if args.ticks is not None and client.updates >= args.ticks:
+        break
+  except KeyboardInterrupt:
+    pass
+  s = client.summary()
+  if s['bytes']:
+    print ('%d updates | bytes/update p50 %d p95 %d max %d | decode ms p50 '
+           '%.3f | %d entities, %d bullets in view' % (s['updates'],
+           s['bytes']['p50'], s['bytes']['p95'], s['bytes']['max'],
+           s['decode_ms']['p50'], s['entities'], s['bullets']))
+
+
+def drain(clients, peers, map, timeout=5):
+  '''Serves until every client has every update its peer sent it.'''
+  deadline = timer() + timeout
+  while timer() < deadline and any(c.updates < p.updates
+                                   for c, p in zip(clients, peers)):
+    asyncore.loop(.01, map=map, count=1)
+
+
+def check(server, client, peer):
+  '''Checks that `client`\'s copy of the game is the game as it is, in its
+  view: the entities (as quantized), the bullets and the player; and that
+  no change for it was ever put off for longer than it should have been
+  (see `StateEncoder.longest_wait`).'''
+  encoder = peer.encoder
+  if (encoder.longest_wait() >
+      encoder.most_changed // StateEncoder.MAX_RECORDS + 1):
+    print 'A change was put off for %d updates' % encoder.longest_wait()
+    return False
+  world = TickState(server.game, server.ticks, server.fresh)
+  box = encoder.box(world.player_pos)
+  truth = dict((world.handle(e), world.entity(e))
+               for e in server.game.space.baddies if world.inside(e, box))
+  bullets = world.bullets_in(box)[:StateEncoder.MAX_BULLETS]
+  return (client.state.entities == truth and
+          client.state.player == world.head[1:] and
+          numpy.array_equal(client.state.bullets, bullets))
+
+
+def cmd_loadtest(args):
+  '''Runs a server and `args.clients` clients in this process, over
+  localhost.  The first client plays, following the player; the others
+  watch random places.  Once done, the game stops, and the server keeps
+  sending updates for long enough to send every change put off; then every
+  client\'s copy of the game must match the game itself.'''
+  game, scenario = build_game(args)
+  map = {}
+  server = Server(game, '127.0.0.1', 0, scenario, map)
+  view = parse_size(args.view)
+  rng = random.Random(args.seed)
+  w, h = game.size
+  clients = [Client('127.0.0.1', server.port, view, None, 'spin', map)]
+  for i in xrange(1, args.clients):
+    clients.append(Client('127.0.0.1', server.port, view,
+        (rng.randrange(w), rng.randrange(h)), 'watch', map))
+  while len(server.peers) < len(clients):
+    asyncore.loop(.1, map=map, count=1)
+
+  ports = dict((p.addr[1], p) for p in server.peers)
+  peers = [ports[c.socket.getsockname()[1]] for c in clients]
+
+  server.run(args.ticks, args.report)
+  drain(clients, peers, map)
+  print server.report()
+  # Oldest changes go first, so this many updates send every change.
+  for i in xrange(len(game.space.baddies) // StateEncoder.MAX_RECORDS + 2):
+    server.broadcast()
+    drain(clients, peers, map)
+  matching = sum(1 for c, p in zip(clients, peers) if check(server, c, p))
+  print '%d of %d clients\' copies match the game' % (matching, len(clients))
+  results = { 'server': server.summary(),
+              'clients': [c.summary() for c in clients],
+              'matching': matching }
+  for c in clients: c.close()
+  server.close()
+  if args.output is not None:
+    write_results(args.output, args, results)
+  return 0 if matching == len(clients) else 1
+
+
+def parse_size(text):
+  w, h = map(int, text.split('x'))
+  return w, h
+
+
+def parse_args():
+  ap = argparse.ArgumentParser(description='Serve a game over TCP.')
+  sub = ap.add_subparsers()
+
+  for name, fn in (('serve', cmd_serve), ('loadtest', cmd_loadtest)):
+    sp = sub.add_parser(name)
+    sp.set_defaults(fn=fn)
+    sp.add_argument('-s', '--size', default='800x600',
+                    help="The arena size, as WxH.")
+    sp.add_argument('-S', '--seed', type=int)
+    sp.add_argument('--tick-rate', type=int, default=30)
+    sp.add_argument('-b', '--broadphase', default='grid',
+                    choices=main.CollisionSpace.BROADPHASES)
+    sp.add_argument('-n', '--baddies', type=int,
+                    help="Instead of playing the levels, keep this many "
+                         "baddies in the arena (see bench.py).")
+    sp.add_argument('--kind', default='mix', choices=sorted(bench.KINDS),
+                    help="The kind of baddies, with --baddies.")
+    sp.add_argument('-t', '--ticks', type=int,
+                    help="Stop after this many ticks.")
+    sp.add_argument('--report', type=float, default=5,
+                    help="Print the metrics every this many seconds.")
+    sp.add_argument('-o', '--output',
+                    help="Write the metrics as JSON to this file.")
+  sp = sub.choices['serve']
+  sp.add_argument('--host', default='127.0.0.1')
+  sp.add_argument('-p', '--port', type=int, default=7777)
+  sp.add_argument('-r', '--record', metavar='FILE',
+                  help="Record the game's input to this file (see main.py "
+                       "--replay).")
+  sp.add_argument('-L', '--load-state', metavar='FILE',
+                  help="Start from this snapshot (see main.py --save-state).")
+  sp = sub.choices['loadtest']
+  sp.set_defaults(record=None, load_state=None, ticks=300)
+  sp.add_argument('-c', '--clients', type=int, default=8)
+  sp.add_argument('--view', default='400x300',
+                  help="Each client's view, as WxH.")
+
+  sp = sub.add_parser('client')
+  sp.set_defaults(fn=cmd_client)
+  sp.add_argument('--host', default='127.0.0.1')
+  sp.add_argument('-p', '--port', type=int, default=7777)
+  sp.add_argument('--view', default='%dx%d' % DEFAULT_VIEW,
+                  help="The area of interest, as WxH.")
+  sp.add_argument('--at', metavar='X,Y',
+                  help="Center the view here, instead of on the player.")
+  sp.add_argument('--bot', choices=Client.BOTS, default='spin')
+  sp.add_argument('-t', '--ticks', type=int,
+                  help="Disconnect after this many updates.")
+  return ap.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  sys.exit(args.fn(args) or 0)